@@ -0,0 +1,237 @@
+"""In-memory message broker
+Stands in for RabbitMQ behind the blocking agents of core/system/mq: a
+Connector hands out connections exposing the subset of the pika
+BlockingConnection and channel API the agents use. Fanout, direct and
+consistent hash (x-consistent-hash, binding keys are weights) exchanges are
+supported, deliveries are acknowledged and limited by the channel prefetch
+count like on the real broker.
+"""
+import zlib
+import time
+import bisect
+import threading
+import itertools
+import collections
+
+
+def _hash(value):
+    return zlib.crc32(value.encode("utf-8")) & 0xffffffff
+
+
+class _Queue(object):
+    """Message queue waking up its consumers on every new message"""
+    def __init__(self, name):
+        self.name = name
+        self.messages = collections.deque()
+        self.listeners = set()
+
+    def put(self, message):
+        self.messages.append(message)
+        for listener in list(self.listeners):
+            listener.set()
+
+    def get(self):
+        """Returns the oldest message, None if the queue is empty"""
+        try:
+            return self.messages.popleft()
+        except IndexError:
+            return None
+
+
+class Broker(object):
+    """In-memory broker shared by all the connections of a process"""
+    _POINTS = 100
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._exchanges = {}
+        self._bindings = collections.defaultdict(list)
+        self._rings = collections.defaultdict(list)
+        self._queues = {}
+        self._names = itertools.count(1)
+
+    def declare_exchange(self, name, exchange_type):
+        with self._lock:
+            self._exchanges.setdefault(name, exchange_type)
+
+    def declare_queue(self, name=''):
+        """Declares a queue, a name is generated if none is given"""
+        with self._lock:
+            if not name:
+                name = "mem.gen-{}".format(next(self._names))
+            if name not in self._queues:
+                self._queues[name] = _Queue(name)
+            return name
+
+    def bind(self, exchange, queue, routing_key=''):
+        with self._lock:
+            binding = (routing_key, self._queues[queue])
+            if binding in self._bindings[exchange]:
+                return
+            self._bindings[exchange].append(binding)
+            if self._exchanges.get(exchange) == "x-consistent-hash":
+                # Places the queue on the hash ring, weight x _POINTS times
+                ring = self._rings[exchange]
+                for point in range(int(routing_key or 1) * Broker._POINTS):
+                    ring.append((_hash("{}:{}".format(queue, point)), queue))
+                ring.sort()
+
+    def queue(self, name):
+        with self._lock:
+            return self._queues[name]
+
+    def publish(self, exchange, routing_key, body, properties):
+        """Routes a message to the queues bound to an exchange
+        Returns False if the message could not be routed anywhere.
+        """
+        with self._lock:
+            exchange_type = self._exchanges.get(exchange)
+            if exchange_type == "x-consistent-hash":
+                queues = []
+                ring = self._rings[exchange]
+                if ring:
+                    index = bisect.bisect(ring, (_hash(routing_key), ''))
+                    queues = [self._queues[ring[index % len(ring)][1]]]
+            else:
+                fanout = exchange_type == "fanout"
+                queues = [queue for key, queue in self._bindings[exchange]
+                          if fanout or key == routing_key]
+        for queue in queues:
+            queue.put((body, properties))
+        return bool(queues)
+
+
+class Connector(object):
+    """Connector to an in-memory broker (in place of mq.Connector)"""
+    def __init__(self, broker):
+        self.broker = broker
+
+    def connect(self):
+        """Opens a new connection to the broker"""
+        return Connection(self.broker)
+
+
+class Connection(object):
+    """Blocking connection to an in-memory broker"""
+    def __init__(self, broker):
+        self.broker = broker
+        self.is_open = True
+        self._callbacks = collections.deque()
+        self._wakeup = threading.Event()
+
+    def channel(self):
+        return Channel(self)
+
+    def add_callback_threadsafe(self, callback):
+        """Requests a call to callback on the connection thread"""
+        self._callbacks.append(callback)
+        self._wakeup.set()
+
+    def process_data_events(self, time_limit=0):
+        """Runs the pending threadsafe callbacks"""
+        while self._callbacks:
+            self._callbacks.popleft()()
+
+    def sleep(self, duration):
+        """Sleeps for duration seconds, running the threadsafe callbacks"""
+        deadline = time.time() + duration
+        remaining = duration
+        while remaining > 0:
+            self._wakeup.clear()
+            self.process_data_events()
+            self._wakeup.wait(remaining)
+            remaining = deadline - time.time()
+        self.process_data_events()
+
+    def close(self):
+        self.is_open = False
+
+
+class _Method(object):
+    def __init__(self, delivery_tag=None, queue=None):
+        self.delivery_tag = delivery_tag
+        self.queue = queue
+
+
+class _Frame(object):
+    def __init__(self, method):
+        self.method = method
+
+
+class Channel(object):
+    """Channel of an in-memory broker connection"""
+    _IDLE_WAIT = 0.5
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.broker = connection.broker
+        self.is_open = True
+        self._consumers = []
+        self._consuming = False
+        self._prefetch = 0
+        self._unacked = {}
+        self._tags = itertools.count(1)
+
+    def exchange_declare(self, exchange, exchange_type="direct", **_):
+        self.broker.declare_exchange(exchange, exchange_type)
+
+    def confirm_delivery(self):
+        pass
+
+    def queue_declare(self, queue='', **_):
+        return _Frame(_Method(queue=self.broker.declare_queue(queue)))
+
+    def queue_bind(self, queue, exchange, routing_key=''):
+        self.broker.bind(exchange, queue, routing_key)
+
+    def basic_qos(self, prefetch_count=0):
+        self._prefetch = prefetch_count
+
+    def basic_consume(self, consumer_callback, queue, no_ack=False):
+        consumed = self.broker.queue(queue)
+        consumed.listeners.add(self.connection._wakeup)
+        self._consumers.append((consumer_callback, consumed, no_ack))
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        self.broker.publish(exchange, routing_key, body, properties)
+        return True
+
+    def basic_ack(self, delivery_tag):
+        self._unacked.pop(delivery_tag, None)
+
+    def basic_nack(self, delivery_tag, requeue=True):
+        delivery = self._unacked.pop(delivery_tag, None)
+        if delivery is not None and requeue:
+            queue, message = delivery
+            queue.put(message)
+
+    def _deliver(self):
+        """Delivers at most one message per consumer, returns the count"""
+        delivered = 0
+        for callback, queue, no_ack in self._consumers:
+            if not no_ack and self._prefetch and len(self._unacked) >= self._prefetch:
+                continue
+            message = queue.get()
+            if message is None:
+                continue
+            body, properties = message
+            tag = next(self._tags)
+            if not no_ack:
+                self._unacked[tag] = (queue, message)
+            callback(self, _Method(delivery_tag=tag), properties, body)
+            delivered += 1
+        return delivered
+
+    def start_consuming(self):
+        """Delivers messages to the consumers until stop_consuming is called"""
+        self._consuming = True
+        wakeup = self.connection._wakeup
+        while self._consuming:
+            wakeup.clear()
+            self.connection.process_data_events()
+            if not self._deliver():
+                wakeup.wait(Channel._IDLE_WAIT)
+
+    def stop_consuming(self):
+        self._consuming = False
+        self.connection._wakeup.set()
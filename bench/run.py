@@ -0,0 +1,341 @@
+"""Pipeline benchmark
+Runs the mktpub -> mktagg -> ingesticks and schedprice -> portprice chains in
+one process on an in-memory broker, against an in-memory store (default) or
+a Postgres database, and reports the throughput of each stage with the
+tick-to-DB and job-to-balance latencies as JSON:
+
+    PYTHONPATH=<directory holding saifu> python -m saifu.bench.run \\
+        --duration 30 --rate 2000 --output bench.json
+
+With --database, the settings are read from the conf.app.database section
+of an application configuration file and the portfolios already in the
+database are priced (ticks are generated for --symbols).
+"""
+import os
+import sys
+import math
+import time
+import json
+import argparse
+import threading
+import subprocess
+import yaml
+
+from saifu.core import models, utils, runtime, pricing, dbac
+from saifu.core.system import db
+from saifu.mktpub import app as mktpub
+from saifu.mktagg import app as mktagg
+from saifu.ingesticks import app as ingesticks
+from saifu.schedprice import app as schedprice
+from saifu.portprice import app as portprice
+from saifu.bench import broker, store
+
+_LOGGING = {
+    "category": "bench",
+    "format": "%(asctime)s [%(levelname)s] [@%(name)s] %(message)s",
+    "level": "warning"
+}
+
+_STAGES = ["mktpub", "mktagg", "ingesticks", "schedprice", "portprice"]
+
+
+def _percentile(ordered, percent):
+    """Nearest rank percentile of an ordered list"""
+    index = int(math.ceil(percent / 100.0 * len(ordered))) - 1
+    return ordered[max(0, index)]
+
+
+class Probe(object):
+    """Counts the messages going through a stage and samples their latency"""
+    def __init__(self):
+        self.count = 0
+        self.latencies = []
+        self._lock = threading.Lock()
+
+    def record(self, count, latencies=()):
+        with self._lock:
+            self.count += count
+            self.latencies.extend(latencies)
+
+    def report(self, duration):
+        """Returns the stage throughput and latency percentiles"""
+        with self._lock:
+            count = self.count
+            latencies = sorted(self.latencies)
+        report = {"count": count, "per_second": count / duration}
+        if latencies:
+            report["p50_ms"] = _percentile(latencies, 50) * 1000
+            report["p99_ms"] = _percentile(latencies, 99) * 1000
+            report["max_ms"] = latencies[-1] * 1000
+        return report
+
+
+class CountingSource(object):
+    """Quote source counting the generated quotes"""
+    def __init__(self, source, probe):
+        self.source = source
+        self.probe = probe
+
+    def get(self):
+        quotes = self.source.get()
+        self.probe.record(len(quotes))
+        return quotes
+
+    def close(self):
+        self.source.close()
+
+
+class CountingJobsRepository(object):
+    """Jobs repository counting the dispatched jobs"""
+    def __init__(self, jobsrepo, probe):
+        self.jobsrepo = jobsrepo
+        self.probe = probe
+
+    def persist_many(self, jobs, dispatch=None):
+        self.jobsrepo.persist_many(jobs, dispatch)
+        self.probe.record(len(jobs))
+
+
+class TimedIngester(ingesticks.BulkIngester):
+    """Bulk ingester measuring the tick-to-DB latency
+    Writes to the memory store if one is given, to the database otherwise.
+    """
+    def __init__(self, logger, pool, flush_size, flush_interval, probe, memory=None):
+        super(TimedIngester, self).__init__(logger, pool, flush_size, flush_interval)
+        self.probe = probe
+        self.memory = memory
+
+    def _write(self, batch):
+        if self.memory is None:
+            super(TimedIngester, self)._write(batch)
+        else:
+            self.memory.insert_ticks(batch)
+        now = utils.to_microseconds(utils.utc_time())
+        self.probe.record(
+            len(batch), [(now - timestamp) / 1e6 for timestamp in batch.timestamps])
+
+
+class TimedPricer(pricing.BatchPricer):
+    """Batch pricer measuring the job-to-balance latency"""
+    def __init__(self, logger, pricingrepo, probe):
+        super(TimedPricer, self).__init__(logger, pricingrepo)
+        self.probe = probe
+
+    def price(self, jobs):
+        results = super(TimedPricer, self).price(jobs)
+        now = utils.utc_time()
+        self.probe.record(
+            len(results),
+            [(now - job.start_time).total_seconds() for job, _ in results])
+        return results
+
+
+def _settings(app, log_key="logging"):
+    """Builds an application settings store"""
+    return {"conf": {log_key: _LOGGING, "app": app}}
+
+
+def _git_revision():
+    """Returns the current commit of the working tree (None if unknown)"""
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _seed(memory, symbols, options):
+    """Creates the benchmark portfolios in the memory store"""
+    for portfolio_id in range(1, options.portfolios + 1):
+        positions = [
+            (symbols[(portfolio_id + i) % len(symbols)], 1.0 + i)
+            for i in range(min(options.positions, len(symbols)))]
+        memory.add_portfolio(
+            portfolio_id, positions, options.target_ccy, options.pricing_interval)
+
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(description="Saifu pipeline benchmark")
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--rate", type=float, default=1000,
+                        help="generated quotes per second")
+    parser.add_argument("--tickers", type=int, default=50)
+    parser.add_argument("--symbols", help="comma separated symbols (overrides --tickers)")
+    parser.add_argument("--target-ccy", default="USD")
+    parser.add_argument("--codec", default="json")
+    parser.add_argument("--pull-delay", type=float, default=0.05)
+    parser.add_argument("--window", type=float, default=0.5,
+                        help="mktagg aggregation window (seconds)")
+    parser.add_argument("--shards", type=int, default=0,
+                        help="sharded ingesters (a single fanout ingester if 0)")
+    parser.add_argument("--flush-size", type=int, default=500)
+    parser.add_argument("--flush-interval", type=float, default=0.5)
+    parser.add_argument("--portfolios", type=int, default=500)
+    parser.add_argument("--positions", type=int, default=5)
+    parser.add_argument("--pricing-interval", type=int, default=1)
+    parser.add_argument("--dispatch-batch-size", type=int, default=50)
+    parser.add_argument("--prefetch", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--database", help="configuration file holding the database settings")
+    parser.add_argument("--output", help="file the JSON results are written to")
+    return parser.parse_args(argv)
+
+
+def run(options):
+    """Runs the benchmark, returns the results"""
+    logging_settings = models.LoggingSettings()
+    logging_settings.from_json(_LOGGING)
+    logger = runtime.create_logger(logging_settings)
+
+    if options.symbols:
+        symbols = options.symbols.split(",")
+    else:
+        symbols = ["S{:03d}".format(i) for i in range(options.tickers)]
+    probes = dict((stage, Probe()) for stage in _STAGES)
+
+    memory = None
+    pool = None
+    database = {"credentials": {}}
+    if options.database is None:
+        memory = store.MemoryStore()
+        _seed(memory, symbols, options)
+        pricingrepo = store.MemoryPricingRepository(memory)
+        jobsrepo = store.MemoryJobsRepository(memory)
+    else:
+        with open(options.database) as settings_file:
+            database = yaml.load(settings_file)["conf"]["app"]["database"]
+        settings = models.DatabaseSettings()
+        settings.from_json(database)
+        pool = db.Pool(settings)
+        pricingrepo = dbac.PricingRepository(pool)
+        jobsrepo = dbac.JobsRepository(pool)
+
+    connector = broker.Connector(broker.Broker())
+    mq = {"credentials": {}, "codec": options.codec}
+
+    # Consumers
+    if options.shards:
+        aggregation_publisher = mktagg.ShardedPublisher(
+            logger.getChild("agg-pub"), "mktaggshard", connector, codec=options.codec)
+    else:
+        aggregation_publisher = mktagg.Publisher(
+            logger.getChild("agg-pub"), "mktaggupd", connector, codec=options.codec)
+
+    def notify(quotes):
+        probes["mktagg"].record(len(quotes))
+        aggregation_publisher.notify(quotes)
+    aggregator = mktagg.WindowAggregator(logger.getChild("wagg"), options.window, notify)
+
+    ingesters = [TimedIngester(
+        logger.getChild("ingest"),
+        pool,
+        options.flush_size,
+        options.flush_interval,
+        probes["ingesticks"],
+        memory) for _ in range(max(1, options.shards))]
+
+    if options.shards:
+        ingest_subscribers = [
+            ingesticks.Subscriber(
+                logger.getChild("ingest-sub"), "mktaggshard", connector, ingester, 1)
+            for ingester in ingesters]
+    else:
+        ingest_subscribers = [ingesticks.Subscriber(
+            logger.getChild("ingest-sub"), "mktaggupd", connector, ingesters[0])]
+
+    consumers = ingest_subscribers + [
+        mktagg.Subscriber(logger.getChild("agg-sub"), "mktupd", aggregator, connector),
+        portprice.Worker(
+            logger.getChild("prc"),
+            TimedPricer(logger.getChild("bpr"), pricingrepo, probes["portprice"]),
+            "bench-pricing",
+            connector,
+            models.WorkerSettings(options.prefetch, options.concurrency))
+    ]
+    helpers = [
+        aggregation_publisher,
+        mktagg.WindowTimer(logger.getChild("tmr"), aggregator),
+    ] + [
+        ingesticks.Flusher(logger.getChild("flush"), ingester, min(options.flush_interval, 1))
+        for ingester in ingesters
+    ]
+
+    # Producers
+    publisher_settings = mktpub.Settings(_settings({
+        "pull_delay": options.pull_delay,
+        "exchange": "mktupd",
+        "mq": mq,
+        "publisher": {"buffer_size": 1},
+        "source": {
+            "type": "random",
+            "rate": options.rate,
+            "tickers": [symbol + options.target_ccy for symbol in symbols]
+        }
+    }))
+    scheduler_settings = schedprice.Settings(_settings({
+        "max_sleep": 0.1,
+        "work_queue": "bench-pricing",
+        "dispatch_batch_size": options.dispatch_batch_size,
+        "database": database,
+        "mq": mq
+    }, "log"))
+    producers = [
+        mktpub.Publisher(
+            logger.getChild("pub"),
+            publisher_settings,
+            connector,
+            CountingSource(
+                mktpub.create_source(logger.getChild("src"), publisher_settings, []),
+                probes["mktpub"])),
+        schedprice.Dispatcher(
+            logger.getChild("sch"),
+            scheduler_settings,
+            pricingrepo,
+            CountingJobsRepository(jobsrepo, probes["schedprice"]),
+            connector)
+    ]
+
+    for thread in consumers + helpers:
+        thread.daemon = True
+        thread.start()
+    # Lets the consumers bind their queues before anything is published
+    time.sleep(0.5)
+
+    started_at = utils.utc_time()
+    start = time.time()
+    for thread in producers:
+        thread.daemon = True
+        thread.start()
+    time.sleep(options.duration)
+    for thread in producers + helpers + consumers:
+        thread.stop()
+    duration = time.time() - start
+    for thread in producers + helpers + consumers:
+        thread.join(10)
+
+    if pool is not None:
+        pool.close()
+
+    return {
+        "revision": _git_revision(),
+        "started_at": started_at.isoformat(),
+        "duration": duration,
+        "parameters": vars(options),
+        "stages": dict(
+            (stage, probes[stage].report(duration)) for stage in _STAGES)
+    }
+
+
+def main():
+    """Benchmark entry-point"""
+    options = _parse_args(sys.argv[1:])
+    results = json.dumps(run(options), indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, "w") as output:
+            output.write(results + "\n")
+    print(results)
+
+if __name__ == "__main__":
+    main()
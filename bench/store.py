@@ -0,0 +1,75 @@
+"""In-memory stand-in for saifudb
+Implements the repository methods used by the pricing chain on top of plain
+dictionaries, ticks being kept in a quote cache so that prices can be looked
+up as of a snapshot time.
+"""
+import uuid
+import threading
+
+from saifu.core import quotecache
+
+
+class MemoryStore(object):
+    """Portfolios, ticks, pricing jobs and balances kept in memory"""
+    def __init__(self, ring_size=64):
+        self.ticks = quotecache.QuoteCache(ring_size)
+        self.positions = {}
+        self.pricing_settings = []
+        self.last_job_times = {}
+        self.balance_count = 0
+        self.tick_count = 0
+        self._lock = threading.Lock()
+
+    def add_portfolio(self, portfolio_id, positions, target_ccy, pricing_interval):
+        """Adds a portfolio from its (ticker, size) positions"""
+        with self._lock:
+            self.positions[portfolio_id] = list(positions)
+            self.pricing_settings.append((portfolio_id, target_ccy, pricing_interval))
+
+    def insert_ticks(self, quotes):
+        """Inserts a batch of quotes"""
+        self.ticks.update(quotes)
+        with self._lock:
+            self.tick_count += len(quotes)
+
+
+class MemoryJobsRepository(object):
+    """dbac.JobsRepository on a memory store"""
+    def __init__(self, store):
+        self.store = store
+
+    def persist_many(self, jobs, dispatch=None):
+        for job in jobs:
+            job.identifier = uuid.uuid1().hex
+        if dispatch is not None:
+            dispatch(jobs)
+        with self.store._lock:
+            for job in jobs:
+                self.store.last_job_times[job.portfolio_id] = job.start_time
+
+
+class MemoryPricingRepository(object):
+    """dbac.PricingRepository on a memory store"""
+    def __init__(self, store):
+        self.store = store
+
+    def find_pricing_schedule(self):
+        with self.store._lock:
+            return [
+                (portfolio_id, target_ccy, interval,
+                 self.store.last_job_times.get(portfolio_id))
+                for portfolio_id, target_ccy, interval in self.store.pricing_settings]
+
+    def get_portfolios_positions(self, portfolio_ids):
+        with self.store._lock:
+            return dict(
+                (portfolio_id, list(self.store.positions.get(portfolio_id, [])))
+                for portfolio_id in portfolio_ids)
+
+    def get_latest_prices(self, tickers, snapshot_time):
+        prices, _ = self.store.ticks.prices_as_of(tickers, snapshot_time)
+        return prices
+
+    def persist_portfolio_pricings(self, rows):
+        with self.store._lock:
+            self.store.balance_count += len(rows)
@@ -0,0 +1,117 @@
+"""Message codecs
+Messages are encoded with a codec selected by name (json, msgpack) and tagged
+with the codec content type, which is sent along as the AMQP content type so
+that consumers can decode each message with the right codec. JSON stays the
+default, and the fallback for untagged messages.
+
+A type may take over the decoding of a list of objects into one container by
+defining from_json_many/from_wire_many class methods. Columnar containers are
+encoded with to_columns and decoded with the from_columns class method.
+"""
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = "application/json"
+MSGPACK = "application/x-msgpack"
+
+
+class Message(bytes):
+    """Encoded message body tagged with its content type"""
+    def __new__(cls, body, content_type=JSON):
+        if not isinstance(body, bytes):
+            body = body.encode("utf-8")
+        message = super(Message, cls).__new__(cls, body)
+        message.content_type = content_type
+        return message
+
+
+class JsonCodec(object):
+    """Human readable codec, objects are encoded with to_json/from_json"""
+    content_type = JSON
+
+    def encode(self, obj):
+        if type(obj) is list:
+            return Message(json.dumps([o.to_json() for o in obj]), self.content_type)
+        return Message(json.dumps(obj.to_json()), self.content_type)
+
+    def decode(self, body, The_type):
+        def decode_one(data):
+            instance = The_type()
+            instance.from_json(data)
+            return instance
+        data = json.loads(body)
+        if hasattr(The_type, "from_json_many"):
+            return The_type.from_json_many(data if type(data) is list else [data])
+        if type(data) is list:
+            return [decode_one(one) for one in data]
+        return decode_one(data)
+
+
+class MsgpackCodec(object):
+    """Compact binary codec, objects are encoded as positional arrays with
+    to_wire/from_wire, wrapped in a [kind, payload] envelope
+    """
+    content_type = MSGPACK
+
+    _ONE, _MANY, _COLUMNS = 0, 1, 2
+
+    def __init__(self):
+        if msgpack is None:
+            raise RuntimeError("msgpack codec requires the msgpack package")
+
+    def encode(self, obj):
+        if type(obj) is list:
+            payload = [MsgpackCodec._MANY, [o.to_wire() for o in obj]]
+        elif hasattr(obj, "to_columns"):
+            payload = [MsgpackCodec._COLUMNS, obj.to_columns()]
+        else:
+            payload = [MsgpackCodec._ONE, obj.to_wire()]
+        return Message(msgpack.packb(payload, use_bin_type=True), self.content_type)
+
+    def decode(self, body, The_type):
+        def decode_one(data):
+            instance = The_type()
+            instance.from_wire(data)
+            return instance
+        kind, data = msgpack.unpackb(body, raw=False)
+        if kind == MsgpackCodec._COLUMNS:
+            if not hasattr(The_type, "from_columns"):
+                raise ValueError("{} cannot be decoded from columns".format(
+                    The_type.__name__))
+            return The_type.from_columns(data)
+        if hasattr(The_type, "from_wire_many"):
+            return The_type.from_wire_many(data if kind == MsgpackCodec._MANY else [data])
+        if kind == MsgpackCodec._MANY:
+            return [decode_one(one) for one in data]
+        return decode_one(data)
+
+
+_CODECS = {
+    "json": JsonCodec,
+    JSON: JsonCodec,
+    "msgpack": MsgpackCodec,
+    MSGPACK: MsgpackCodec,
+}
+
+_instances = {}
+
+
+def get(name):
+    """Returns the codec registered under a name or content type
+    Unknown or missing content types fall back to JSON.
+    """
+    codec_type = _CODECS.get(name, JsonCodec)
+    if codec_type not in _instances:
+        _instances[codec_type] = codec_type()
+    return _instances[codec_type]
+
+
+def tag(body, content_type):
+    """Tags a received message body with its content type"""
+    if content_type is None:
+        return body
+    return Message(body, content_type)
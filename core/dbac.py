@@ -1,105 +1,448 @@
 """Database access layer"""
 import uuid
+import psycopg2.extras
+
+from saifu.core.system import db
 
 
 class BaseRepository(object):
-    def __init__(self, connector):
-        self._conn = connector.connect()
+    def __init__(self, pool):
+        self._pool = pool
 
-    def _get_conn(self):
-        return self._conn
+    def _connection(self):
+        """Checks a connection out of the pool for one operation"""
+        return self._pool.connection()
 
 class JobsRepository(BaseRepository):
-    def __init__(self, connector):
-        super(JobsRepository, self).__init__(connector)
+    def __init__(self, pool):
+        super(JobsRepository, self).__init__(pool)
 
-    def _persist_new(self, cursor, job):
+    def _persist_new(self, cursor, jobs):
         query = """
             INSERT INTO saifu_portfolio_pricing_jobs
                 (id, portfolio_id, status, target_ccy, started_by, snapshot_time, start_time)
-            VALUES
-                (%s, %s, %s, %s, %s, %s, %s)
+            VALUES %s
         """
-        job.identifier = uuid.uuid1().hex
-        cursor.execute(query,
-            (
+        for job in jobs:
+            job.identifier = uuid.uuid1().hex
+        psycopg2.extras.execute_values(cursor, query,
+            [(
                 job.identifier,
                 job.portfolio_id,
                 job.status,
                 job.target_ccy,
                 job.started_by,
                 job.snapshot_time,
-                job.start_time))
+                job.start_time) for job in jobs],
+            page_size=1000)
 
     def persist(self, job):
         """Persist one job"""
         self.persist_many([job])
 
-    def persist_many(self, jobs):
-        """Persist many jobs"""
-        with self._get_conn().cursor() as cursor:
-            for job in jobs:
-                if job.identifier is None:
-                    self._persist_new(cursor, job)
-                else:
-                    raise RuntimeError("Not implemented")
-            self._get_conn().commit()
+    def persist_many(self, jobs, dispatch=None):
+        """Persist many jobs (new jobs are inserted in multi-row statements)
+        If given, dispatch is called with the inserted jobs before the
+        transaction commits: the jobs are only recorded once dispatched.
+        """
+        if any(job.identifier is not None for job in jobs):
+            raise RuntimeError("Not implemented")
+        if not jobs:
+            return
+        with self._connection() as conn:
+            with conn.cursor() as cursor:
+                self._persist_new(cursor, jobs)
+            if dispatch is not None:
+                dispatch(jobs)
+            conn.commit()
 
 class PricingRepository(BaseRepository):
-    def __init__(self, connector):
-        super(PricingRepository, self).__init__(connector)
+    def __init__(self, pool):
+        super(PricingRepository, self).__init__(pool)
 
-    def find_portfolios_to_price(self):
-        """Find all the portfolios identifiers that need pricing"""
+    def find_pricing_schedule(self):
+        """Find the pricing settings of all the portfolios with the start time
+        of their last pricing job
+        """
         query = """
-            SELECT sp.id as portfolio_id,
-                   spps.target_ccy as target_currency
-              FROM saifu_portfolios sp
-              JOIN saifu_portfolio_pricing_settings spps ON sp.id = spps.portfolio_id
-         LEFT JOIN (SELECT portfolio_id,
-                           MAX(start_time) as last_start_time
-                      FROM saifu_portfolio_pricing_jobs
-                  GROUP BY portfolio_id) sppj ON sp.id = sppj.portfolio_id
-             WHERE EXTRACT(
-                       EPOCH FROM (
-                           now() - coalesce(
-                                       sppj.last_start_time,
-                                       to_timestamp(0)
-                               ))) > spps.pricing_interval
-        """
-        with self._get_conn().cursor() as cursor:
-            cursor.execute(query)
-            results = [(row[0], row[1]) for row in cursor.fetchall()]
-            self._get_conn().commit()
+            SELECT spps.portfolio_id,
+                   spps.target_ccy,
+                   spps.pricing_interval,
+                   sppj.start_time
+              FROM saifu_portfolio_pricing_settings spps
+              JOIN saifu_portfolios sp ON sp.id = spps.portfolio_id
+         LEFT JOIN LATERAL (SELECT start_time
+                              FROM saifu_portfolio_pricing_jobs
+                             WHERE portfolio_id = spps.portfolio_id
+                          ORDER BY start_time DESC
+                             LIMIT 1) sppj ON true
+        """
+        with self._connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(query)
+                results = [(row[0], row[1], row[2], row[3]) for row in cursor.fetchall()]
+            conn.commit()
             return results
 
-    def get_portfolio_positions_prices(self, portfolio_id, snapshot_time, target_ccy):
+    def get_portfolios_positions(self, portfolio_ids=None):
+        """Returns the positions (ticker, size) of many portfolios, by
+        portfolio, or of all the portfolios if portfolio_ids is None (then
+        the portfolios without positions are left out)
+        """
+        query = """
+            SELECT portfolio_id,
+                   ticker,
+                   size
+              FROM saifu_portfolio_positions
+             WHERE %s::int[] IS NULL OR portfolio_id = ANY(%s::int[])
+        """
+        ids = list(portfolio_ids) if portfolio_ids is not None else None
+        positions = dict((portfolio_id, []) for portfolio_id in ids or ())
+        with self._connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(query, (ids, ids))
+                for row in cursor.fetchall():
+                    positions.setdefault(row[0], []).append((row[1], row[2]))
+            conn.commit()
+            return positions
+
+    def find_pricing_settings(self, portfolio_ids=None):
+        """Returns the pricing settings (target_ccy, interval) by portfolio,
+        of all the portfolios if portfolio_ids is None
+        """
         query = """
-            SELECT schp.ticker,
-                   schp.price,
-                   spp.size,
-                   (schp.price * spp.size) as total
-              FROM saifu_ccy_historical_prices schp
-              JOIN saifu_portfolio_positions spp ON (spp.ticker || %s) = schp.ticker
-              JOIN (SELECT ticker, MAX(quote_time) quote_time
-                      FROM saifu_ccy_historical_prices
-                     WHERE quote_time <= %s
-                  GROUP BY ticker) schp_j ON (    schp.ticker = schp_j.ticker
-                                              AND schp.quote_time = schp_j.quote_time)
-             WHERE spp.portfolio_id = %s;
-        """
-        with self._get_conn().cursor() as cursor:
-            cursor.execute(query, (target_ccy, snapshot_time, portfolio_id))
-            results = [[row[0], row[1], row[2], row[3]] for row in cursor.fetchall()]
-            self._get_conn().commit()
+            SELECT spps.portfolio_id,
+                   spps.target_ccy,
+                   spps.pricing_interval
+              FROM saifu_portfolio_pricing_settings spps
+              JOIN saifu_portfolios sp ON sp.id = spps.portfolio_id
+             WHERE %s::int[] IS NULL OR spps.portfolio_id = ANY(%s::int[])
+        """
+        ids = list(portfolio_ids) if portfolio_ids is not None else None
+        settings = {}
+        with self._connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(query, (ids, ids))
+                for row in cursor.fetchall():
+                    settings.setdefault(row[0], []).append((row[1], row[2]))
+            conn.commit()
+            return settings
+
+    def get_latest_prices(self, tickers, snapshot_time):
+        """Returns the last known price of each ticker as of snapshot_time"""
+        query = """
+            SELECT t.ticker,
+                   schp.price
+              FROM unnest(%s::varchar[]) AS t(ticker)
+              JOIN LATERAL (SELECT price
+                              FROM saifu_ccy_historical_prices
+                             WHERE ticker = t.ticker
+                               AND quote_time <= %s
+                          ORDER BY quote_time DESC
+                             LIMIT 1) schp ON true
+        """
+        with self._connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(query, (list(tickers), snapshot_time))
+                results = dict((row[0], row[1]) for row in cursor.fetchall())
+            conn.commit()
             return results
 
+    def persist_portfolio_pricings(self, pricings):
+        """Persists many (portfolio_id, snapshot_time, balance, target_ccy)
+        pricings in one statement
+        """
+        query = """
+            INSERT INTO saifu_portfolio_historical_prices
+                (portfolio_id, quote_time, balance, currency)
+                 VALUES %s
+        """
+        with self._connection() as conn:
+            with conn.cursor() as cursor:
+                psycopg2.extras.execute_values(cursor, query, pricings)
+            conn.commit()
+
+    def persist_latest_portfolio_pricings(self, pricings):
+        """Records many (portfolio_id, snapshot_time, balance, target_ccy)
+        pricings as the latest balances, in one statement (a balance older
+        than the recorded one is ignored)
+        """
+        query = """
+            INSERT INTO saifu_portfolio_latest_prices
+                (portfolio_id, quote_time, balance, currency)
+                 VALUES %s
+            ON CONFLICT (portfolio_id, currency) DO UPDATE
+                    SET balance = EXCLUDED.balance,
+                        quote_time = EXCLUDED.quote_time
+                  WHERE saifu_portfolio_latest_prices.quote_time <= EXCLUDED.quote_time
+        """
+        with self._connection() as conn:
+            with conn.cursor() as cursor:
+                psycopg2.extras.execute_values(cursor, query, pricings)
+            conn.commit()
+
+    def iter_prices(self, tickers, from_time, to_time, fetch_size=10000):
+        """Streams the (ticker, price, quote_time) ticks of tickers in
+        (from_time, to_time] ordered by time, fetch_size rows at a time
+        """
+        query = """
+            SELECT ticker,
+                   price,
+                   quote_time
+              FROM saifu_ccy_historical_prices
+             WHERE ticker = ANY(%s)
+               AND quote_time > %s
+               AND quote_time <= %s
+          ORDER BY quote_time
+        """
+        with self._connection() as conn:
+            with conn.cursor(name="saifu_prices_sweep") as cursor:
+                cursor.itersize = fetch_size
+                cursor.execute(query, (list(tickers), from_time, to_time))
+                for row in cursor:
+                    yield row[0], row[1], row[2]
+            conn.commit()
+
+    def replace_portfolio_pricings(self, portfolio_ids, target_ccy, from_time, to_time,
+                                   pricings, page_size=1000):
+        """Replaces the balances of portfolios in [from_time, to_time] by
+        (portfolio_id, snapshot_time, balance, target_ccy) pricings in one
+        transaction (pricings can be a generator, it is written page by page)
+        """
+        query = """
+            DELETE FROM saifu_portfolio_historical_prices
+                  WHERE portfolio_id = ANY(%s)
+                    AND currency = %s
+                    AND quote_time >= %s
+                    AND quote_time <= %s
+        """
+        insert = """
+            INSERT INTO saifu_portfolio_historical_prices
+                (portfolio_id, quote_time, balance, currency)
+                 VALUES %s
+        """
+        with self._connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(query, (list(portfolio_ids), target_ccy, from_time, to_time))
+                psycopg2.extras.execute_values(cursor, insert, pricings, page_size=page_size)
+            conn.commit()
+
     def persist_portfolio_pricing(self, portfolio_id, snapshot_time, balance, target_ccy):
         query = """
             INSERT INTO saifu_portfolio_historical_prices
                 (portfolio_id, balance, currency, quote_time)
                  VALUES (%s, %s, %s, %s)
         """
-        with self._get_conn().cursor() as cursor:
-            cursor.execute(query, (portfolio_id, balance, target_ccy, snapshot_time))
-            self._get_conn().commit()
+        with self._connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(query, (portfolio_id, balance, target_ccy, snapshot_time))
+            conn.commit()
+
+class MaintenanceRepository(BaseRepository):
+    def __init__(self, pool):
+        super(MaintenanceRepository, self).__init__(pool)
+
+    def create_ccy_prices_partitions(self, from_time, to_time):
+        """Creates the market data partitions covering [from_time, to_time)"""
+        with self._connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "SELECT saifu_create_ccy_prices_partitions(%s, %s)",
+                    (from_time, to_time))
+            conn.commit()
+
+    def downsample_ccy_prices(self, older_than, bucket_seconds):
+        """Rolls the ticks older than older_than into coarser buckets,
+        returns the number of ticks removed
+        """
+        with self._connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "SELECT saifu_downsample_ccy_prices(%s, %s)",
+                    (older_than, bucket_seconds))
+                removed = cursor.fetchone()[0]
+            conn.commit()
+            return removed
+
+
+class PortfolioRepository(BaseRepository):
+    """Read side of the portfolio balances"""
+    def __init__(self, pool):
+        super(PortfolioRepository, self).__init__(pool)
+
+    def get_latest_balance(self, portfolio_id, currency):
+        """Returns the latest (balance, quote_time) of a portfolio (None if
+        it was never priced), from the last pricing or the balance kept up
+        to date by revalue, whichever is the most recent
+        """
+        query = """
+            SELECT balance,
+                   quote_time
+              FROM (SELECT balance,
+                           quote_time
+                      FROM saifu_portfolio_latest_prices
+                     WHERE portfolio_id = %(portfolio_id)s
+                       AND currency = %(currency)s
+                 UNION ALL
+                   (SELECT balance,
+                           quote_time
+                      FROM saifu_portfolio_historical_prices
+                     WHERE portfolio_id = %(portfolio_id)s
+                       AND currency = %(currency)s
+                  ORDER BY quote_time DESC
+                     LIMIT 1)) latest
+          ORDER BY quote_time DESC
+             LIMIT 1
+        """
+        with self._connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(query, {
+                    "portfolio_id": portfolio_id,
+                    "currency": currency
+                })
+                row = cursor.fetchone()
+            conn.commit()
+            return (row[0], row[1]) if row is not None else None
+
+    def get_balance_history(self, portfolio_id, currency, from_time, to_time, bucket_seconds):
+        """Returns the balances of a portfolio in [from_time, to_time)
+        downsampled to one (bucket_time, last, low, high) row per bucket
+        """
+        query = """
+            SELECT to_timestamp(floor(extract(EPOCH FROM quote_time) / %(bucket)s) * %(bucket)s)
+                       AT TIME ZONE 'UTC' AS bucket_time,
+                   (array_agg(balance ORDER BY quote_time DESC))[1],
+                   MIN(balance),
+                   MAX(balance)
+              FROM saifu_portfolio_historical_prices
+             WHERE portfolio_id = %(portfolio_id)s
+               AND currency = %(currency)s
+               AND quote_time >= %(from_time)s
+               AND quote_time < %(to_time)s
+          GROUP BY bucket_time
+          ORDER BY bucket_time
+        """
+        with self._connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(query, {
+                    "bucket": bucket_seconds,
+                    "portfolio_id": portfolio_id,
+                    "currency": currency,
+                    "from_time": from_time,
+                    "to_time": to_time
+                })
+                results = [(row[0], row[1], row[2], row[3]) for row in cursor.fetchall()]
+            conn.commit()
+            return results
+
+
+class PortfolioSnapshot(object):
+    """Positions and pricing settings of all the portfolios at one version
+    A snapshot is never modified, edits produce a new version.
+    """
+    __slots__ = ("version", "positions", "settings")
+
+    def __init__(self, version, positions, settings):
+        self.version = version
+        self.positions = positions
+        self.settings = settings
+
+    def get_portfolios_positions(self, portfolio_ids):
+        """Returns the positions (ticker, size) of many portfolios, by portfolio"""
+        return dict((portfolio_id, list(self.positions.get(portfolio_id, ())))
+                    for portfolio_id in portfolio_ids)
+
+    def pricing_settings(self):
+        """Returns the (portfolio_id, target_ccy, interval) pricing settings"""
+        return [(portfolio_id, target_ccy, interval)
+                for portfolio_id, rows in self.settings.items()
+                for target_ccy, interval in rows]
+
+
+class PortfolioCache(object):
+    """In-memory positions and pricing settings, kept consistent with the
+    database through the notifications sent on saifu_portfolio_changes
+    Everything is loaded once the listener connection LISTENs, then only the
+    edited portfolios are reloaded and published as a new snapshot version.
+    Until the first load, and whenever the notifications connection is lost,
+    the cache is bypassed and reads go to the database; a full refresh is
+    done on every (re)connection.
+    The cache is run as an agent (run/stop), by its listener.
+    """
+    CHANNEL = "saifu_portfolio_changes"
+
+    def __init__(self, logger, settings, pricingrepo, reconnect_delay=5):
+        self.logger = logger
+        self.pricingrepo = pricingrepo
+        self._snapshot = None
+        self._version = 0
+        self.listener = db.Listener(
+            logger,
+            settings,
+            PortfolioCache.CHANNEL,
+            on_connect=self._refresh,
+            on_notify=self._notified,
+            on_disconnect=self._bypass,
+            reconnect_delay=reconnect_delay)
+
+    def snapshot(self):
+        """Returns the current snapshot (None while the cache is bypassed)"""
+        return self._snapshot
+
+    def get_portfolios_positions(self, portfolio_ids):
+        """Returns the positions (ticker, size) of many portfolios, by portfolio"""
+        snapshot = self._snapshot
+        if snapshot is None:
+            return self.pricingrepo.get_portfolios_positions(portfolio_ids)
+        return snapshot.get_portfolios_positions(portfolio_ids)
+
+    def _publish(self, positions, settings):
+        self._version += 1
+        self._snapshot = PortfolioSnapshot(self._version, positions, settings)
+
+    def _refresh(self):
+        """Reloads everything"""
+        self._publish(self.pricingrepo.get_portfolios_positions(),
+                      self.pricingrepo.find_pricing_settings())
+        self.logger.debug("Loaded {} portfolio(s) (version {})".format(
+            len(self._snapshot.settings), self._version))
+
+    def _apply(self, changes):
+        """Reloads the edited portfolios, changes are (kind, portfolio_id)
+        pairs (a None portfolio_id means all portfolios)
+        """
+        if any(portfolio_id is None for _, portfolio_id in changes):
+            self._refresh()
+            return
+        positions = dict(self._snapshot.positions)
+        settings = dict(self._snapshot.settings)
+        for kind, current, find in (
+                ("positions", positions, self.pricingrepo.get_portfolios_positions),
+                ("settings", settings, self.pricingrepo.find_pricing_settings)):
+            portfolio_ids = set(
+                portfolio_id for change, portfolio_id in changes if change == kind)
+            if not portfolio_ids:
+                continue
+            for portfolio_id in portfolio_ids:
+                current.pop(portfolio_id, None)
+            current.update(find(portfolio_ids))
+        self._publish(positions, settings)
+        self.logger.debug("Reloaded {} portfolio change(s) (version {})".format(
+            len(changes), self._version))
+
+    def _notified(self, payloads):
+        """Applies the <kind>:<portfolio_id> change notifications"""
+        changes = set()
+        for payload in payloads:
+            kind, _, portfolio_id = payload.partition(":")
+            changes.add((kind, int(portfolio_id) if portfolio_id else None))
+        self._apply(changes)
+
+    def _bypass(self):
+        self._snapshot = None
+
+    def run(self):
+        self.listener.run()
+
+    def stop(self):
+        self.listener.stop()
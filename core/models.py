@@ -1,9 +1,36 @@
 """Saifu business objects"""
+import array
+
 from saifu.core import utils
 
+try:
+    array.array("q")
+    _INT64 = "q"
+except ValueError:
+    _INT64 = "l"
+
+
+def _array_bytes(values):
+    """Returns the raw content of an array"""
+    if hasattr(values, "tobytes"):
+        return values.tobytes()
+    return values.tostring()
+
+
+def _array_from_bytes(typecode, data):
+    """Creates an array from raw content"""
+    values = array.array(typecode)
+    if hasattr(values, "frombytes"):
+        values.frombytes(data)
+    else:
+        values.fromstring(data)
+    return values
+
 
 class Quote(object):
     """Represents a quote"""
+    __slots__ = ("ticker", "price", "timestamp")
+
     def __init__(self, ticker=None, price=None, timestamp=None):
         self.ticker = ticker
         self.price = price
@@ -21,7 +48,214 @@ class Quote(object):
         self.price = data.get("price")
         self.timestamp = utils.utc_from_timestamp(data.get("timestamp"))
 
+    def to_wire(self):
+        return [self.ticker, self.price, utils.to_timestamp(self.timestamp)]
+
+    def from_wire(self, data):
+        self.ticker, self.price, timestamp = data
+        self.timestamp = utils.utc_from_timestamp(timestamp)
+
+
+class QuoteBatch(object):
+    """Columnar batch of quotes
+    Tickers are interned in a symbol table and referenced by id, prices and
+    timestamps (microseconds since epoch) are kept in typed arrays. Iterating
+    over rows() does not create any Quote.
+    """
+    __slots__ = ("tickers", "_ticker_ids", "ids", "prices", "timestamps")
+
+    def __init__(self, quotes=None):
+        self.tickers = []
+        self._ticker_ids = {}
+        self.ids = array.array("I")
+        self.prices = array.array("d")
+        self.timestamps = array.array(_INT64)
+        if quotes is not None:
+            self.extend(quotes)
+
+    def __len__(self):
+        return len(self.prices)
+
+    def __iter__(self):
+        for ticker, price, timestamp in self.rows():
+            yield Quote(ticker, price, timestamp)
+
+    def _ticker_id(self, ticker):
+        ticker_id = self._ticker_ids.get(ticker)
+        if ticker_id is None:
+            ticker_id = len(self.tickers)
+            self._ticker_ids[ticker] = ticker_id
+            self.tickers.append(ticker)
+        return ticker_id
+
+    def append(self, ticker, price, timestamp):
+        """Appends one quote"""
+        self.ids.append(self._ticker_id(ticker))
+        self.prices.append(price)
+        self.timestamps.append(utils.to_microseconds(timestamp))
+
+    def extend(self, quotes):
+        """Appends a batch or an iterable of quotes"""
+        if isinstance(quotes, QuoteBatch):
+            self.ids.extend(array.array(
+                "I", [self._ticker_id(quotes.tickers[i]) for i in quotes.ids]))
+            self.prices.extend(quotes.prices)
+            self.timestamps.extend(quotes.timestamps)
+            return
+        for quote in quotes:
+            self.append(quote.ticker, quote.price, quote.timestamp)
+
+    def slice(self, start, stop):
+        """Returns the quotes [start, stop) as a new batch"""
+        batch = QuoteBatch()
+        batch.tickers = list(self.tickers)
+        batch._ticker_ids = dict(self._ticker_ids)
+        batch.ids = self.ids[start:stop]
+        batch.prices = self.prices[start:stop]
+        batch.timestamps = self.timestamps[start:stop]
+        return batch
+
+    def rows(self):
+        """Iterates over the (ticker, price, timestamp) rows"""
+        tickers = self.tickers
+        for ticker_id, price, timestamp in zip(self.ids, self.prices, self.timestamps):
+            yield tickers[ticker_id], price, utils.utc_from_microseconds(timestamp)
+
+    def to_json(self):
+        return [quote.to_json() for quote in self]
+
+    @classmethod
+    def from_json_many(cls, data):
+        batch = cls()
+        for one in data:
+            batch.append(
+                one.get("ticker"),
+                one.get("price"),
+                utils.utc_from_timestamp(one.get("timestamp")))
+        return batch
+
+    @classmethod
+    def from_wire_many(cls, data):
+        batch = cls()
+        for ticker, price, timestamp in data:
+            batch.append(ticker, price, utils.utc_from_timestamp(timestamp))
+        return batch
+
+    def to_columns(self):
+        return [
+            self.tickers,
+            _array_bytes(self.ids),
+            _array_bytes(self.prices),
+            _array_bytes(self.timestamps)
+        ]
+
+    @classmethod
+    def from_columns(cls, data):
+        tickers, ids, prices, timestamps = data
+        batch = cls()
+        batch.tickers = list(tickers)
+        batch._ticker_ids = dict((t, i) for i, t in enumerate(batch.tickers))
+        batch.ids = _array_from_bytes("I", ids)
+        batch.prices = _array_from_bytes("d", prices)
+        batch.timestamps = _array_from_bytes(_INT64, timestamps)
+        return batch
+
+
+class QuoteSummary(object):
+    """Summary of the quotes of one ticker over a time window"""
+    __slots__ = (
+        "ticker",
+        "open",
+        "high",
+        "low",
+        "close",
+        "count",
+        "average",
+        "start_time",
+        "end_time")
+
+    def __init__(self,
+            ticker=None,
+            open=None,
+            high=None,
+            low=None,
+            close=None,
+            count=None,
+            average=None,
+            start_time=None,
+            end_time=None):
+        self.ticker = ticker
+        self.open = open
+        self.high = high
+        self.low = low
+        self.close = close
+        self.count = count
+        self.average = average
+        self.start_time = start_time
+        self.end_time = end_time
+
+    def to_json(self):
+        return {
+            "ticker": self.ticker,
+            "open": self.open,
+            "high": self.high,
+            "low": self.low,
+            "close": self.close,
+            "count": self.count,
+            "average": self.average,
+            "start_time": utils.to_timestamp(self.start_time),
+            "end_time": utils.to_timestamp(self.end_time),
+        }
+
+    def from_json(self, data):
+        self.ticker = data.get("ticker")
+        self.open = data.get("open")
+        self.high = data.get("high")
+        self.low = data.get("low")
+        self.close = data.get("close")
+        self.count = data.get("count")
+        self.average = data.get("average")
+        self.start_time = utils.utc_from_timestamp(data.get("start_time"))
+        self.end_time = utils.utc_from_timestamp(data.get("end_time"))
+
+    def to_wire(self):
+        return [
+            self.ticker,
+            self.open,
+            self.high,
+            self.low,
+            self.close,
+            self.count,
+            self.average,
+            utils.to_timestamp(self.start_time),
+            utils.to_timestamp(self.end_time)
+        ]
+
+    def from_wire(self, data):
+        (self.ticker,
+         self.open,
+         self.high,
+         self.low,
+         self.close,
+         self.count,
+         self.average,
+         start_time,
+         end_time) = data
+        self.start_time = utils.utc_from_timestamp(start_time)
+        self.end_time = utils.utc_from_timestamp(end_time)
+
+
 class PricingJob(object):
+    __slots__ = (
+        "identifier",
+        "portfolio_id",
+        "snapshot_time",
+        "target_ccy",
+        "started_by",
+        "status",
+        "start_time",
+        "end_time")
+
     def __init__(self,
             identifier=None,
             portfolio_id=None,
@@ -62,6 +296,31 @@ class PricingJob(object):
         self.start_time = utils.utc_from_timestamp(data.get("start_time"))
         self.end_time = utils.utc_from_timestamp(data.get("end_time"))
 
+    def to_wire(self):
+        return [
+            self.identifier,
+            self.portfolio_id,
+            utils.to_timestamp(self.snapshot_time),
+            self.target_ccy,
+            self.started_by,
+            self.status,
+            utils.to_timestamp(self.start_time),
+            utils.to_timestamp(self.end_time)
+        ]
+
+    def from_wire(self, data):
+        (self.identifier,
+         self.portfolio_id,
+         snapshot_time,
+         self.target_ccy,
+         self.started_by,
+         self.status,
+         start_time,
+         end_time) = data
+        self.snapshot_time = utils.utc_from_timestamp(snapshot_time)
+        self.start_time = utils.utc_from_timestamp(start_time)
+        self.end_time = utils.utc_from_timestamp(end_time)
+
 
 class BasicCredentials(object):
     """Basic credentials (Username, password)"""
@@ -91,12 +350,29 @@ class LoggingSettings(object):
         self.level = data.get("level")
 
 
+class PoolSettings(object):
+    """Database connection pool settings"""
+    def __init__(self, min_size=1, max_size=4, idle_timeout=300, check_interval=30):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+
+    def from_json(self, data):
+        """Hydrate the current instance with json data"""
+        self.min_size = data.get("min_size", self.min_size)
+        self.max_size = data.get("max_size", self.max_size)
+        self.idle_timeout = data.get("idle_timeout", self.idle_timeout)
+        self.check_interval = data.get("check_interval", self.check_interval)
+
+
 class DatabaseSettings(object):
     """Database connection settings"""
-    def __init__(self, host=None, database=None, credentials=None):
+    def __init__(self, host=None, database=None, credentials=None, pool=None):
         self.host = host
         self.database = database
         self.credentials = credentials
+        self.pool = pool or PoolSettings()
 
     def from_json(self, data):
         """Hydrate the current instance with json data"""
@@ -105,13 +381,107 @@ class DatabaseSettings(object):
         self.credentials = BasicCredentials()
         self.credentials.from_json(
             data.get("credentials"))
+        self.pool = PoolSettings()
+        self.pool.from_json(data.get("pool", {}))
+
+
+class PublisherSettings(object):
+    """Publisher outbound buffer and delivery settings"""
+    def __init__(self, confirms=False, buffer_size=1, flush_interval=None):
+        self.confirms = confirms
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+
+    def from_json(self, data):
+        """Hydrate the current instance with json data"""
+        self.confirms = data.get("confirms", self.confirms)
+        self.buffer_size = data.get("buffer_size", self.buffer_size)
+        self.flush_interval = data.get("flush_interval", self.flush_interval)
+
+
+class WorkerSettings(object):
+    """Worker consumption settings"""
+    def __init__(self, prefetch=1, concurrency=1, requeue_on_error=True):
+        self.prefetch = prefetch
+        self.concurrency = concurrency
+        self.requeue_on_error = requeue_on_error
+
+    def from_json(self, data):
+        """Hydrate the current instance with json data"""
+        self.prefetch = data.get("prefetch", self.prefetch)
+        self.concurrency = data.get("concurrency", self.concurrency)
+        self.requeue_on_error = data.get("requeue_on_error", self.requeue_on_error)
+
+
+class RequesterSettings(object):
+    """HTTP quotes requester settings"""
+    def __init__(self, shard_size=20, concurrency=4, timeout=5, retries=2, backoff=0.5, rate_limit=None):
+        self.shard_size = shard_size
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.rate_limit = rate_limit
+
+    def from_json(self, data):
+        """Hydrate the current instance with json data"""
+        self.shard_size = data.get("shard_size", self.shard_size)
+        self.concurrency = data.get("concurrency", self.concurrency)
+        self.timeout = data.get("timeout", self.timeout)
+        self.retries = data.get("retries", self.retries)
+        self.backoff = data.get("backoff", self.backoff)
+        self.rate_limit = data.get("rate_limit", self.rate_limit)
+
+
+class QuoteSourceSettings(object):
+    """Quote source settings
+    kind is one of http (provider requests), replay (recorded ticks file) or
+    random (random walk generator).
+    """
+    def __init__(self, kind="http", path=None, speed=1.0, loop=True, rate=100,
+                 tickers=None, start_price=100.0, volatility=0.001, seed=None):
+        self.kind = kind
+        self.path = path
+        self.speed = speed
+        self.loop = loop
+        self.rate = rate
+        self.tickers = tickers
+        self.start_price = start_price
+        self.volatility = volatility
+        self.seed = seed
+
+    def from_json(self, data):
+        """Hydrate the current instance with json data"""
+        self.kind = data.get("type", self.kind)
+        self.path = data.get("path", self.path)
+        self.speed = data.get("speed", self.speed)
+        self.loop = data.get("loop", self.loop)
+        self.rate = data.get("rate", self.rate)
+        self.tickers = data.get("tickers", self.tickers)
+        self.start_price = data.get("start_price", self.start_price)
+        self.volatility = data.get("volatility", self.volatility)
+        self.seed = data.get("seed", self.seed)
+
+
+class MetricsSettings(object):
+    """Metrics export settings (nothing is exported by default)"""
+    def __init__(self, port=None, log_interval=None):
+        self.port = port
+        self.log_interval = log_interval
+
+    def from_json(self, data):
+        """Hydrate the current instance with json data"""
+        self.port = data.get("port", self.port)
+        self.log_interval = data.get("log_interval", self.log_interval)
 
 
 class MQSettings(object):
     """Message queue connection settings"""
-    def __init__(self, host=None, credentials=None):
+    def __init__(self, host=None, credentials=None, transport="blocking", codec="json"):
         self.host = host
         self.credentials = credentials
+        self.transport = transport
+        self.codec = codec
 
     def from_json(self, data):
         """Hydrate the current instance with json data"""
@@ -119,3 +489,5 @@ class MQSettings(object):
         self.credentials = BasicCredentials()
         self.credentials.from_json(
             data.get("credentials"))
+        self.transport = data.get("transport", "blocking")
+        self.codec = data.get("codec", "json")
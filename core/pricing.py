@@ -0,0 +1,271 @@
+"""Portfolio pricing components"""
+import itertools
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+PIVOT_CCY = "USD"
+
+
+def _snapshot_time(job):
+    return job.snapshot_time
+
+
+class PricingKernel(object):
+    """Balances of many portfolios in many currencies at once
+    The positions are held as a sizes matrix (portfolios x assets) and the
+    prices as one vector of asset prices per target currency, so that all the
+    balances are one matrix product (vectorized with NumPy when installed).
+    When an asset has no direct price in a currency, the cross rate through
+    the pivot currency is used (e.g. BTCEUR = BTCUSD / EURUSD). Assets
+    without any price are valued at 0.
+    """
+    def __init__(self, positions, pivot=PIVOT_CCY):
+        self.pivot = pivot
+        self.portfolio_ids = sorted(positions)
+        self.assets = sorted(set(
+            ticker for portfolio_positions in positions.values()
+            for ticker, _ in portfolio_positions))
+        columns = dict((asset, column) for column, asset in enumerate(self.assets))
+        if numpy is not None:
+            self.sizes = numpy.zeros((len(self.portfolio_ids), len(self.assets)))
+        else:
+            self.sizes = [[0.0] * len(self.assets) for _ in self.portfolio_ids]
+        for row, portfolio_id in enumerate(self.portfolio_ids):
+            for ticker, size in positions[portfolio_id]:
+                self.sizes[row][columns[ticker]] += size
+
+    def leg_tickers(self, asset, currency):
+        """Returns the tickers the price of an asset in currency depends on
+        (the direct pair, then the pivot pairs of the cross rate)
+        """
+        if asset == currency:
+            return set()
+        tickers = set([asset + currency])
+        if currency != self.pivot:
+            tickers.update((currency + self.pivot, self.pivot + currency))
+        if asset != self.pivot:
+            tickers.add(asset + self.pivot)
+        return tickers
+
+    def tickers(self, currencies):
+        """Returns the tickers whose prices are needed to value the assets in
+        the currencies (direct and pivot pairs)
+        """
+        tickers = set()
+        for currency in currencies:
+            for asset in self.assets:
+                tickers.update(self.leg_tickers(asset, currency))
+        return tickers
+
+    def _pivot_rate(self, prices, currency):
+        """Price of one unit of the pivot currency in currency"""
+        if currency == self.pivot:
+            return 1.0
+        direct = prices.get(self.pivot + currency)
+        if direct is not None:
+            return direct
+        inverse = prices.get(currency + self.pivot)
+        if inverse:
+            return 1.0 / inverse
+        return None
+
+    def _price(self, prices, asset, currency, pivot_rate):
+        """Price of an asset in currency (None if unknown)"""
+        if asset == currency:
+            return 1.0
+        price = prices.get(asset + currency)
+        if price is not None or pivot_rate is None:
+            return price
+        if asset == self.pivot:
+            return pivot_rate
+        pivot_price = prices.get(asset + self.pivot)
+        if pivot_price is None:
+            return None
+        return pivot_price * pivot_rate
+
+    def price(self, prices, asset, currency, default=0.0):
+        """Price of an asset in currency (default if unknown)"""
+        price = self._price(prices, asset, currency, self._pivot_rate(prices, currency))
+        return default if price is None else price
+
+    def price_vectors(self, prices, currencies):
+        """Returns the (assets x currencies) price matrix"""
+        vectors = []
+        for currency in currencies:
+            pivot_rate = self._pivot_rate(prices, currency)
+            vectors.append([
+                self._price(prices, asset, currency, pivot_rate) or 0.0
+                for asset in self.assets])
+        if numpy is not None:
+            return numpy.array(vectors, dtype=float).reshape(
+                len(currencies), len(self.assets)).T
+        return [list(column) for column in zip(*vectors)]
+
+    def balances(self, prices, currencies):
+        """Returns the balances by (portfolio_id, currency)"""
+        currencies = sorted(set(currencies))
+        vectors = self.price_vectors(prices, currencies)
+        if numpy is not None:
+            matrix = numpy.dot(self.sizes, vectors).tolist()
+        else:
+            matrix = [
+                [sum(size * price for size, price in zip(row, column))
+                 for column in zip(*vectors)] if vectors else [0.0] * len(currencies)
+                for row in self.sizes]
+        balances = {}
+        for portfolio_id, row in zip(self.portfolio_ids, matrix):
+            for currency, balance in zip(currencies, row):
+                balances[(portfolio_id, currency)] = balance
+        return balances
+
+
+class BatchPricer(object):
+    """Prices many portfolios at once
+    Jobs are grouped by snapshot time: the positions of all the portfolios of
+    a group are loaded at once, the latest price of every ticker they hold is
+    resolved once, and the balances of all the target currencies are
+    computed by a PricingKernel. All the balances are then persisted with
+    one bulk insert.
+    If a quote cache is provided, prices are looked up in the cache first and
+    only the tickers it cannot resolve are read from the database. Positions
+    are read from portfolios (e.g. a dbac.PortfolioCache) when provided.
+    """
+    def __init__(self, logger, pricingrepo, cache=None, pivot=PIVOT_CCY, portfolios=None):
+        self.logger = logger
+        self.pricingrepo = pricingrepo
+        self.cache = cache
+        self.pivot = pivot
+        self.portfolios = portfolios or pricingrepo
+
+    def _get_latest_prices(self, tickers, snapshot_time):
+        """Resolves the latest prices from the cache, then the database"""
+        if self.cache is None:
+            return self.pricingrepo.get_latest_prices(tickers, snapshot_time)
+        prices, missing = self.cache.prices_as_of(tickers, snapshot_time)
+        if missing:
+            self.logger.debug("{} price(s) not in cache".format(len(missing)))
+            prices.update(self.pricingrepo.get_latest_prices(missing, snapshot_time))
+        return prices
+
+    def _price_snapshot(self, snapshot_time, jobs):
+        """Prices jobs sharing the same snapshot time"""
+        kernel = PricingKernel(self.portfolios.get_portfolios_positions(
+            set(job.portfolio_id for job in jobs)), self.pivot)
+        currencies = set(job.target_ccy for job in jobs)
+        prices = self._get_latest_prices(kernel.tickers(currencies), snapshot_time)
+
+        balances = kernel.balances(prices, currencies)
+        for job in jobs:
+            yield job, balances[(job.portfolio_id, job.target_ccy)]
+
+    def price(self, jobs):
+        """Prices and persists a batch of jobs, returns (job, balance) pairs"""
+        results = []
+        for snapshot_time, group in itertools.groupby(
+                sorted(jobs, key=_snapshot_time), key=_snapshot_time):
+            results.extend(self._price_snapshot(snapshot_time, list(group)))
+
+        self.pricingrepo.persist_portfolio_pricings([
+            (job.portfolio_id, job.snapshot_time, balance, job.target_ccy)
+            for job, balance in results])
+
+        self.logger.debug("Priced {} portfolio(s)".format(len(results)))
+        return results
+
+
+def snapshot_times(from_time, to_time, interval):
+    """Returns the snapshot times from from_time to to_time (included) every
+    interval (a timedelta)
+    """
+    times = []
+    snapshot_time = from_time
+    while snapshot_time <= to_time:
+        times.append(snapshot_time)
+        snapshot_time += interval
+    return times
+
+
+class HistoricalPricer(object):
+    """Prices portfolios at every snapshot time of a range in one pass
+    The prices as of the first snapshot time are loaded once, then the ticks
+    of the range are swept in time order keeping the as of price of every
+    ticker. At each snapshot time, only the portfolios holding an asset whose
+    price legs ticked since the previous one are revalued. All the balances
+    are written with one bulk replace of the range.
+    The current positions are used for the whole range.
+    """
+    def __init__(self, logger, pricingrepo, fetch_size=10000, pivot=PIVOT_CCY):
+        self.logger = logger
+        self.pricingrepo = pricingrepo
+        self.fetch_size = fetch_size
+        self.pivot = pivot
+
+    def sweep(self, positions, target_ccy, times):
+        """Yields the (portfolio_id, snapshot_time, balance, target_ccy)
+        pricings of positions (by portfolio) at each of the ordered times
+        Assets are valued with the PricingKernel price model (direct pair,
+        else the cross rate through the pivot currency).
+        """
+        kernel = PricingKernel(positions, self.pivot)
+        legs = {}
+        for asset in kernel.assets:
+            for ticker in kernel.leg_tickers(asset, target_ccy):
+                legs.setdefault(ticker, set()).add(asset)
+        holders = {}
+        for portfolio_id, portfolio_positions in positions.items():
+            for ticker, _ in portfolio_positions:
+                holders.setdefault(ticker, set()).add(portfolio_id)
+
+        prices = self.pricingrepo.get_latest_prices(legs.keys(), times[0])
+        ticks = self.pricingrepo.iter_prices(
+            legs.keys(), times[0], times[-1], self.fetch_size)
+        tick = next(ticks, None)
+        asset_prices = {}
+        balances = {}
+        moved = set(kernel.assets)
+        dirty = set(positions)
+        for snapshot_time in times:
+            while tick is not None and tick[2] <= snapshot_time:
+                prices[tick[0]] = tick[1]
+                moved.update(legs[tick[0]])
+                tick = next(ticks, None)
+
+            for asset in moved:
+                asset_prices[asset] = kernel.price(prices, asset, target_ccy)
+                dirty.update(holders[asset])
+            moved.clear()
+
+            for portfolio_id in dirty:
+                balances[portfolio_id] = sum(
+                    asset_prices[ticker] * size
+                    for ticker, size in positions[portfolio_id])
+            dirty.clear()
+
+            for portfolio_id, balance in balances.items():
+                yield portfolio_id, snapshot_time, balance, target_ccy
+        ticks.close()
+
+    def backfill(self, portfolio_ids, target_ccy, from_time, to_time, interval):
+        """Reprices portfolios every interval from from_time to to_time,
+        replacing their balances in the range. Returns the number of balances
+        written
+        """
+        times = snapshot_times(from_time, to_time, interval)
+        if not times or not portfolio_ids:
+            return 0
+        positions = self.pricingrepo.get_portfolios_positions(portfolio_ids)
+        written = [0]
+
+        def pricings():
+            for pricing in self.sweep(positions, target_ccy, times):
+                written[0] += 1
+                yield pricing
+
+        self.pricingrepo.replace_portfolio_pricings(
+            portfolio_ids, target_ccy, from_time, to_time, pricings())
+        self.logger.debug("Backfilled {} balance(s) of {} portfolio(s)".format(
+            written[0], len(portfolio_ids)))
+        return written[0]
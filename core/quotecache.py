@@ -0,0 +1,110 @@
+"""In-memory latest quotes cache"""
+import bisect
+import threading
+import collections
+
+from saifu.core import models, utils
+from saifu.core.system import mq, amq
+
+
+class QuoteCache(object):
+    """Thread safe cache of the most recent quotes of each ticker
+    A short ring of recent quotes is kept per ticker so that prices can be
+    looked up as of a time slightly in the past. The cache only knows the
+    quotes received since it was last reset: a price as of a given time is
+    only returned if a quote at or before that time is still in the ring.
+    Rings hold (microseconds since epoch, price) pairs read from the columns
+    of the quote batches, no Quote is built on update.
+    """
+    def __init__(self, ring_size=64):
+        self.ring_size = ring_size
+        self._rings = {}
+        self._lock = threading.Lock()
+
+    def reset(self):
+        """Forgets all the quotes"""
+        with self._lock:
+            self._rings = {}
+
+    def update(self, quotes):
+        """Inserts a batch of new quotes in the cache"""
+        tickers = quotes.tickers
+        rows = zip(quotes.ids, quotes.prices, quotes.timestamps)
+        with self._lock:
+            for ticker_id, price, timestamp in rows:
+                ticker = tickers[ticker_id]
+                ring = self._rings.get(ticker)
+                if ring is None:
+                    ring = collections.deque(maxlen=self.ring_size)
+                    self._rings[ticker] = ring
+                if not ring or ring[-1][0] <= timestamp:
+                    ring.append((timestamp, price))
+                else:
+                    ordered = list(ring)
+                    position = bisect.bisect(
+                        [entry[0] for entry in ordered], timestamp)
+                    ordered.insert(position, (timestamp, price))
+                    ring.clear()
+                    ring.extend(ordered)
+
+    def latest(self, ticker):
+        """Returns the most recent quote of a ticker (None if unknown)"""
+        with self._lock:
+            ring = self._rings.get(ticker)
+            entry = ring[-1] if ring else None
+        if entry is None:
+            return None
+        return models.Quote(ticker, entry[1], utils.utc_from_microseconds(entry[0]))
+
+    def recent(self, ticker):
+        """Returns the recent quotes of a ticker, oldest first"""
+        with self._lock:
+            entries = list(self._rings.get(ticker, []))
+        return [models.Quote(ticker, price, utils.utc_from_microseconds(timestamp))
+                for timestamp, price in entries]
+
+    def prices_as_of(self, tickers, snapshot_time):
+        """Returns the last known prices of tickers as of snapshot_time
+        Returns the prices found by ticker and the set of tickers that could
+        not be resolved from the cache.
+        """
+        prices = {}
+        missing = set()
+        snapshot_us = utils.to_microseconds(snapshot_time)
+        with self._lock:
+            for ticker in tickers:
+                price = None
+                for timestamp, candidate in reversed(self._rings.get(ticker, ())):
+                    if timestamp <= snapshot_us:
+                        price = candidate
+                        break
+                if price is None:
+                    missing.add(ticker)
+                else:
+                    prices[ticker] = price
+        return prices, missing
+
+
+class Feeder(mq.GenericSubscriber):
+    """Keeps a quote cache hot from an aggregated quotes exchange
+    The cache is reset on every (re)connection as quotes published while
+    disconnected are lost.
+    """
+    def __init__(self, logger, exchange, connector, cache):
+        super(Feeder, self).__init__(exchange, connector)
+        self.logger = logger
+        self.cache = cache
+
+    def _initialize(self):
+        self.cache.reset()
+        super(Feeder, self)._initialize()
+
+    def received(self, message):
+        self.cache.update(utils.unserialize(message, models.QuoteBatch))
+
+
+class AsyncFeeder(amq.AsyncSubscriber, Feeder):
+    """Feeder running on a shared event loop"""
+    def _initialize(self):
+        self.cache.reset()
+        amq.AsyncSubscriber._initialize(self)
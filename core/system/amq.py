@@ -0,0 +1,385 @@
+"""Asynchronous message queue components module
+All the agents attached to an EventLoop share one broker connection driven by
+a single I/O thread, so a process can consume and publish on many exchanges
+and queues at once. The agent hooks (work, received, handle) keep running on
+the agent own thread, a slow hook never stalls the I/O loop.
+
+The asynchronous agents are mixins placed in front of a threaded agent
+implementation, the user code is left untouched:
+
+    class AsyncSubscriber(amq.AsyncSubscriber, Subscriber):
+        pass
+
+    loop = amq.EventLoop(mq.Connector(settings))
+    subscriber = AsyncSubscriber(logger, exchange, amq.Connector(loop))
+"""
+import time
+import logging
+import functools
+import threading
+import Queue
+from multiprocessing.pool import ThreadPool
+import pika
+
+from saifu.core import codec
+from saifu.core.system import mq
+
+_logger = logging.getLogger("saifu.amq")
+
+
+class Connector(object):
+    """Connector to a shared event loop (in place of mq.Connector)"""
+    def __init__(self, loop):
+        self.loop = loop
+
+
+class EventLoop(threading.Thread):
+    """Drives one asynchronous broker connection shared by many agents"""
+    def __init__(self, connector, reconnect=True, reconnect_delay=5):
+        super(EventLoop, self).__init__()
+        self._connector = connector
+        self._reconnect = reconnect
+        self._reconnect_delay = reconnect_delay
+        self._agents = []
+        self._connection = None
+        self._ioloop = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def running(self):
+        """Indicates whether the loop should be running."""
+        return not self._stopped.is_set()
+
+    def register(self, agent):
+        """Attaches an agent to the loop, a channel is opened for it on the
+        current connection (and on every new connection after reconnecting)
+        An agent run again after a failure keeps its channel.
+        """
+        with self._lock:
+            if agent in self._agents:
+                return
+            self._agents.append(agent)
+            connection = self._connection
+        if connection is not None:
+            self.call_threadsafe(lambda: self._open_channel(connection, agent))
+
+    def call_threadsafe(self, callback):
+        """Requests a call to callback on the I/O thread
+        Returns False if the loop is not connected (the call is dropped).
+        """
+        with self._lock:
+            connection = self._connection
+        if connection is None:
+            return False
+        connection.ioloop.add_callback_threadsafe(callback)
+        return True
+
+    def _open_channel(self, connection, agent):
+        """Opens a channel for an agent (I/O thread)"""
+        if connection.is_open:
+            connection.channel(on_open_callback=agent._on_channel_open)
+
+    def _on_open(self, connection):
+        """Called when the connection is opened (I/O thread)"""
+        with self._lock:
+            self._connection = connection
+            agents = list(self._agents)
+        for agent in agents:
+            self._open_channel(connection, agent)
+
+    def _on_open_error(self, connection, error):
+        """Called when the connection cannot be opened (I/O thread)"""
+        connection.ioloop.stop()
+
+    def _on_closed(self, connection, reply_code, reply_text):
+        """Called when the connection is closed (I/O thread)"""
+        with self._lock:
+            self._connection = None
+            agents = list(self._agents)
+        for agent in agents:
+            agent._on_disconnected()
+        connection.ioloop.stop()
+
+    def run(self):
+        """Starts the loop thread"""
+        while self.running():
+            connection = pika.SelectConnection(
+                self._connector.parameters(),
+                on_open_callback=self._on_open,
+                on_open_error_callback=self._on_open_error,
+                on_close_callback=self._on_closed,
+                stop_ioloop_on_close=False)
+            self._ioloop = connection.ioloop
+            connection.ioloop.start()
+            if not self._reconnect:
+                break
+            self._stopped.wait(self._reconnect_delay)
+
+    def stop(self):
+        """Stops the loop, closing the connection"""
+        self._stopped.set()
+        with self._lock:
+            connection = self._connection
+        if connection is not None:
+            connection.ioloop.add_callback_threadsafe(connection.close)
+        elif self._ioloop is not None:
+            self._ioloop.add_callback_threadsafe(self._ioloop.stop)
+
+
+class _AsyncMQAgent(object):
+    """Asynchronous agent mixin"""
+    _POLL_INTERVAL = 1
+
+    def __init__(self, *args, **kwargs):
+        super(_AsyncMQAgent, self).__init__(*args, **kwargs)
+        self._ready = threading.Event()
+        self._inbox = Queue.Queue()
+        self._dropped = self._metrics.counter("dropped")
+        self._metrics.gauge("inbox", self._inbox.qsize)
+
+    def _loop(self):
+        """Returns the event loop the agent is attached to"""
+        return self._connector.loop
+
+    def _on_channel_open(self, channel):
+        """Called when the agent channel is opened (I/O thread)"""
+        self._channel = channel
+        self._initialize()
+
+    def _on_disconnected(self):
+        """Called when the loop connection is lost (I/O thread)"""
+        self._ready.clear()
+        self._channel = None
+
+    def _on_ready(self, *_):
+        """Called once the agent channel is fully initialized (I/O thread)"""
+        self._ready.set()
+
+    def _wait_ready(self):
+        """Waits until the agent channel is ready, False if stopped"""
+        while self.running():
+            if self._ready.wait(_AsyncMQAgent._POLL_INTERVAL):
+                return True
+        return False
+
+    def _on_message(self, channel, method, properties, body):
+        """Queues an incoming message for the agent thread (I/O thread)"""
+        self._inbox.put((channel, method, properties, body))
+
+    def _consume_inbox(self, handler):
+        """Calls handler for each incoming message until stopped"""
+        while self.running():
+            try:
+                item = self._inbox.get(timeout=_AsyncMQAgent._POLL_INTERVAL)
+            except Queue.Empty:
+                continue
+            if item is not None:
+                handler(*item)
+
+    def _basic_publish(self, exchange, messages):
+        """Publishes from the I/O thread, returns False if disconnected"""
+        channel = self._channel
+        if channel is None or not channel.is_open:
+            return False
+        try:
+            for routing_key, body in messages:
+                channel.basic_publish(
+                    exchange=exchange,
+                    routing_key=routing_key,
+                    body=body,
+                    properties=mq._properties(body))
+        except pika.exceptions.AMQPError:
+            return False
+        return True
+
+    def _publish_threadsafe(self, exchange, messages):
+        """Hands over (routing_key, body) messages to the I/O thread and waits
+        until they are published. Raises ConnectionClosed (like the blocking
+        agents) if they could not be, the messages are then dropped.
+        """
+        if not messages:
+            return
+        published = []
+        done = threading.Event()
+
+        def publish():
+            try:
+                published.append(self._basic_publish(exchange, messages))
+            finally:
+                done.set()
+
+        if self._wait_ready():
+            channel = self._channel
+            if self._loop().call_threadsafe(publish):
+                # The callback is never run if the connection is lost meanwhile
+                while not done.wait(_AsyncMQAgent._POLL_INTERVAL):
+                    if self._channel is not channel:
+                        break
+        if not published or not published[0]:
+            self._dropped.inc(len(messages))
+            _logger.warn("Dropped {} message(s) to {}: not connected".format(
+                len(messages), exchange))
+            raise pika.exceptions.ConnectionClosed()
+
+    def run(self):
+        """Attaches the agent to the loop and serves it until stopped"""
+        self._loop().register(self)
+        self._serve()
+
+    def _serve(self):
+        """Agent thread implementation"""
+        pass
+
+    def _work(self):
+        """Runs the user work once the channel is ready, again if a publish
+        failed on a lost connection (like the blocking agents)
+        """
+        while self._wait_ready():
+            try:
+                self.work()
+                return
+            except pika.exceptions.ConnectionClosed:
+                if not self._reconnect:
+                    raise
+                self._reconnects.inc()
+
+    def stop(self):
+        """Stops the agent"""
+        self._running = False
+        self._inbox.put(None)
+
+
+class AsyncPublisher(_AsyncMQAgent):
+    """Asynchronous publisher mixin (see GenericPublisher)"""
+    def _initialize(self):
+        self._channel.exchange_declare(
+            self._on_ready,
+            exchange=self._exchange,
+            exchange_type=self._exchange_type)
+
+    def _serve(self):
+        self._work()
+
+    def publish(self, data):
+        """Publishes data to the exchange"""
+        self.publish_many([data])
+
+    def publish_many(self, messages):
+        """Publishes a batch of messages to the exchange
+        Messages are handed over to the I/O thread at once, the call returns
+        when they are published (raises ConnectionClosed if they could not
+        be). Publisher confirms are not supported on the shared loop.
+        """
+        self._publish_threadsafe(
+            self._exchange,
+            [(mq._routing_key(message), message) for message in messages])
+        self._published += len(messages)
+
+    def flush(self):
+        """Nothing is buffered on the agent side"""
+        pass
+
+    def sleep(self, duration):
+        """Sleeps for duration seconds (the loop services the connection)"""
+        time.sleep(duration)
+
+
+class AsyncSubscriber(_AsyncMQAgent):
+    """Asynchronous subscriber mixin (see GenericSubscriber)"""
+    def _initialize(self):
+        self._channel.exchange_declare(
+            self._on_exchange_declared,
+            exchange=self._exchange,
+            exchange_type=self._exchange_type)
+
+    def _on_exchange_declared(self, _):
+        self._channel.queue_declare(self._on_queue_declared, exclusive=True)
+
+    def _on_queue_declared(self, frame):
+        queue_name = frame.method.queue
+        self._channel.basic_consume(self._on_message, queue=queue_name, no_ack=True)
+        self._channel.queue_bind(
+            self._on_ready,
+            queue=queue_name,
+            exchange=self._exchange,
+            routing_key=self._binding_key)
+
+    def _serve(self):
+        self._consume_inbox(self._received)
+
+
+class AsyncDispatcher(_AsyncMQAgent):
+    """Asynchronous work dispatcher mixin (see GenericDispatcher)"""
+    def _initialize(self):
+        self._channel.exchange_declare(
+            self._on_ready,
+            exchange="Direct-X",
+            exchange_type="direct")
+
+    def _serve(self):
+        self._work()
+
+    def dispatch(self, job):
+        """Dispatch a job to the queue"""
+        self._publish_threadsafe("Direct-X", [("Key1", job)])
+        self._dispatched.inc()
+
+    def sleep(self, duration):
+        """Sleeps for duration seconds (the loop services the connection)"""
+        time.sleep(duration)
+
+
+class AsyncWorker(_AsyncMQAgent):
+    """Asynchronous worker mixin (see GenericWorker)
+    Jobs are handed over by the agent thread to a pool of concurrency
+    threads, their deliveries are settled on the I/O thread.
+    """
+    def _initialize(self):
+        self._channel.exchange_declare(
+            self._on_exchange_declared,
+            exchange="Direct-X",
+            exchange_type="direct")
+
+    def _on_exchange_declared(self, _):
+        self._channel.queue_declare(
+            self._on_queue_declared,
+            queue=self._queue,
+            durable=True)
+
+    def _on_queue_declared(self, _):
+        self._channel.queue_bind(
+            self._on_queue_bound,
+            queue=self._queue,
+            exchange="Direct-X",
+            routing_key="Key1")
+
+    def _on_queue_bound(self, _):
+        self._channel.basic_qos(
+            self._on_qos, prefetch_count=self._settings.prefetch)
+
+    def _on_qos(self, _):
+        self._channel.basic_consume(self._on_message, queue=self._queue, no_ack=False)
+        self._on_ready()
+
+    def _handle_one(self, channel, method, properties, body):
+        """Hands over one job to the handlers pool (agent thread)"""
+        self._deliveries += 1
+        self._pool.apply_async(
+            self._execute,
+            (channel, method.delivery_tag, self._requeue(method),
+             codec.tag(body, properties.content_type)))
+
+    def _execute(self, channel, delivery_tag, requeue, body):
+        """Handles one job and settles its delivery (pool thread)"""
+        success = self._handle_safely(body)
+        self._loop().call_threadsafe(functools.partial(
+            self._settle, channel, delivery_tag, success, requeue))
+
+    def _serve(self):
+        if self._pool is None:
+            self._pool = ThreadPool(self._settings.concurrency)
+        self._consume_inbox(self._handle_one)
+        if not self.running():
+            # The loop is stopped after the agent, the acks are still sent
+            self._pool.close()
+            self._pool.join()
@@ -1,5 +1,10 @@
 """Database components module"""
+import time
+import select
+import threading
+import contextlib
 import psycopg2
+import psycopg2.extensions
 
 class Connector(object):
     """Connector to PG database"""
@@ -13,3 +18,191 @@ class Connector(object):
             user=self.settings.credentials.username,
             password=self.settings.credentials.password,
             host=self.settings.host)
+
+
+class Pool(object):
+    """Thread safe pool of connections to a PG database
+    Connections are opened lazily up to max_size and checked out for the
+    duration of one operation. Idle connections are health checked on
+    checkout (and transparently replaced if the server went away), and the
+    ones idle for longer than idle_timeout are closed down to min_size.
+    """
+    def __init__(self, settings):
+        self.connector = Connector(settings)
+        self.min_size = settings.pool.min_size
+        self.max_size = settings.pool.max_size
+        self.idle_timeout = settings.pool.idle_timeout
+        self.check_interval = settings.pool.check_interval
+        self._idle = []
+        self._size = 0
+        self._cond = threading.Condition()
+
+    def _reap(self):
+        """Closes the connections idle for too long (lock must be held)"""
+        now = time.time()
+        while (self._idle
+               and self._size > self.min_size
+               and now - self._idle[0][1] > self.idle_timeout):
+            conn, _ = self._idle.pop(0)
+            self._size -= 1
+            _close_quietly(conn)
+
+    def _is_healthy(self, conn, last_used):
+        """Determines if an idle connection can be handed out
+        Every checkout polls the socket, which notices a connection closed
+        by the server without a round-trip. A SELECT 1 round-trip is only
+        made if the connection was idle for check_interval.
+        """
+        if conn.closed:
+            return False
+        try:
+            conn.poll()
+        except psycopg2.Error:
+            return False
+        if conn.closed:
+            return False
+        if time.time() - last_used < self.check_interval:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _release_slot(self):
+        """Gives back a connection slot (connection was closed)"""
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def checkout(self):
+        """Checks a connection out of the pool
+        Blocks until a connection is available if the pool is exhausted.
+        """
+        with self._cond:
+            self._reap()
+            while not self._idle and self._size >= self.max_size:
+                self._cond.wait()
+            if self._idle:
+                conn, last_used = self._idle.pop()
+            else:
+                conn, last_used = None, None
+                self._size += 1
+
+        if conn is not None and not self._is_healthy(conn, last_used):
+            _close_quietly(conn)
+            conn = None
+
+        if conn is None:
+            try:
+                conn = self.connector.connect()
+            except psycopg2.Error:
+                self._release_slot()
+                raise
+        return conn
+
+    def checkin(self, conn, discard=False):
+        """Returns a connection to the pool
+        Any pending transaction is rolled back. Broken connections are
+        discarded.
+        """
+        if not discard and not conn.closed:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                discard = True
+        if discard or conn.closed:
+            _close_quietly(conn)
+            self._release_slot()
+            return
+        with self._cond:
+            self._idle.append((conn, time.time()))
+            self._cond.notify()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Checks out a connection for the duration of a with block"""
+        conn = self.checkout()
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            self.checkin(conn, discard=True)
+            raise
+        except:
+            self.checkin(conn)
+            raise
+        else:
+            self.checkin(conn)
+
+    def close(self):
+        """Closes all the idle connections"""
+        with self._cond:
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._size -= 1
+                _close_quietly(conn)
+
+
+class Listener(threading.Thread):
+    """Receives the notifications of a channel on a dedicated connection
+    on_connect is called once the connection LISTENs (notifications may have
+    been missed before), on_notify with the payloads received together and
+    on_disconnect when the connection is lost. The listener reconnects after
+    reconnect_delay seconds until stopped; a psycopg2 error raised by a
+    callback also makes it reconnect.
+    """
+    def __init__(self, logger, settings, channel, on_connect=None, on_notify=None,
+                 on_disconnect=None, reconnect_delay=5):
+        super(Listener, self).__init__()
+        self.logger = logger
+        self.connector = Connector(settings)
+        self.channel = channel
+        self.on_connect = on_connect
+        self.on_notify = on_notify
+        self.on_disconnect = on_disconnect
+        self.reconnect_delay = reconnect_delay
+        self._stopped = threading.Event()
+
+    def _listen(self):
+        connection = self.connector.connect()
+        try:
+            connection.set_isolation_level(
+                psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            with connection.cursor() as cursor:
+                cursor.execute("LISTEN " + self.channel)
+            if self.on_connect is not None:
+                self.on_connect()
+            while not self._stopped.is_set():
+                if select.select([connection], [], [], 1) == ([], [], []):
+                    continue
+                connection.poll()
+                payloads = []
+                while connection.notifies:
+                    payloads.append(connection.notifies.pop(0).payload)
+                if payloads and self.on_notify is not None:
+                    self.on_notify(payloads)
+        finally:
+            if self.on_disconnect is not None:
+                self.on_disconnect()
+            _close_quietly(connection)
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                self._listen()
+            except psycopg2.Error as err:
+                self.logger.warn("Lost the {} notifications ({})".format(self.channel, err))
+                self._stopped.wait(self.reconnect_delay)
+
+    def stop(self):
+        self._stopped.set()
+
+
+def _close_quietly(conn):
+    """Closes a connection, ignoring errors"""
+    try:
+        conn.close()
+    except psycopg2.Error:
+        pass
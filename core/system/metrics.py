@@ -0,0 +1,267 @@
+"""Metrics components module
+Counters, gauges and histograms are registered by name in a process wide
+registry and exported either on a local HTTP /metrics endpoint (Prometheus
+text format) or as a periodic log snapshot.
+
+Recording is meant for hot paths: a counter increment or a histogram
+observation is a lock and an addition. Values the code already tracks
+(queue sizes, internal counters) are exported with callback gauges, read
+only when a snapshot is taken.
+"""
+import re
+import json
+import bisect
+import threading
+import BaseHTTPServer
+
+_BUCKETS = (
+    0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5,
+    1, 2.5, 5, 10)
+
+
+class Counter(object):
+    """Monotonic counter"""
+    kind = "counter"
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge(object):
+    """Value set by the code, or read from a callback when snapshotted"""
+    kind = "gauge"
+
+    def __init__(self, callback=None):
+        self.value = 0
+        self.callback = callback
+
+    def set(self, value):
+        self.value = value
+
+    def snapshot(self):
+        if self.callback is not None:
+            return self.callback()
+        return self.value
+
+
+class Histogram(object):
+    """Distribution of observed values (durations in seconds by default)"""
+    kind = "histogram"
+
+    def __init__(self, buckets=_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q quantile (None if empty)"""
+        with self._lock:
+            counts = list(self.counts)
+            count = self.count
+        if not count:
+            return None
+        rank = q * count
+        seen = 0
+        for index, bucket_count in enumerate(counts):
+            seen += bucket_count
+            if seen >= rank:
+                break
+        if index < len(self.buckets):
+            return self.buckets[index]
+        return float("inf")
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99)
+        }
+
+
+class Registry(object):
+    """Named metrics of a process"""
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, name, factory):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = factory()
+                self._metrics[name] = metric
+            return metric
+
+    def counter(self, name):
+        return self._get(name, Counter)
+
+    def histogram(self, name):
+        return self._get(name, Histogram)
+
+    def gauge(self, name, callback=None):
+        """Returns a gauge, a callback replaces the one already registered"""
+        gauge = self._get(name, Gauge)
+        if callback is not None:
+            gauge.callback = callback
+        return gauge
+
+    def scope(self, prefix):
+        return Scope(self, prefix)
+
+    def metrics(self):
+        """Returns the (name, metric) pairs ordered by name"""
+        with self._lock:
+            return sorted(self._metrics.items())
+
+    def snapshot(self):
+        """Returns the current value of every metric"""
+        return dict((name, metric.snapshot()) for name, metric in self.metrics())
+
+
+class Scope(object):
+    """Registers metrics under a common name prefix"""
+    def __init__(self, registry, prefix):
+        self.registry = registry
+        self.prefix = prefix
+
+    def _name(self, name):
+        return "{}.{}".format(self.prefix, name)
+
+    def counter(self, name):
+        return self.registry.counter(self._name(name))
+
+    def histogram(self, name):
+        return self.registry.histogram(self._name(name))
+
+    def gauge(self, name, callback=None):
+        return self.registry.gauge(self._name(name), callback)
+
+
+REGISTRY = Registry()
+
+
+def scope(prefix):
+    """Returns a scope of the process registry"""
+    return REGISTRY.scope(prefix)
+
+
+def _exposition_name(name):
+    return "saifu_" + re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+def exposition(registry=REGISTRY):
+    """Renders the metrics in the Prometheus text format"""
+    lines = []
+    for name, metric in registry.metrics():
+        name = _exposition_name(name)
+        lines.append("# TYPE {} {}".format(name, metric.kind))
+        if metric.kind != "histogram":
+            lines.append("{} {}".format(name, metric.snapshot()))
+            continue
+        with metric._lock:
+            counts = list(metric.counts)
+            total = metric.sum
+        cumulated = 0
+        for bucket, bucket_count in zip(list(metric.buckets) + ["+Inf"], counts):
+            cumulated += bucket_count
+            lines.append('{}_bucket{{le="{}"}} {}'.format(name, bucket, cumulated))
+        lines.append("{}_sum {}".format(name, total))
+        lines.append("{}_count {}".format(name, cumulated))
+    return "\n".join(lines) + "\n"
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the registry exposition on /metrics"""
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = exposition(self.server.registry)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *_):
+        pass
+
+
+class MetricsServer(threading.Thread):
+    """Serves the metrics on http://<host>:<port>/metrics"""
+    def __init__(self, port, host="0.0.0.0", registry=REGISTRY):
+        super(MetricsServer, self).__init__()
+        self.daemon = True
+        self.server = BaseHTTPServer.HTTPServer((host, port), _Handler)
+        self.server.registry = registry
+        self._serving = threading.Event()
+        self._stopped = False
+        self._lock = threading.Lock()
+
+    def run(self):
+        with self._lock:
+            if self._stopped:
+                return
+            self._serving.set()
+        self.server.serve_forever()
+
+    def stop(self):
+        # shutdown blocks until serve_forever returns, it must not be called
+        # if the server is not serving
+        with self._lock:
+            self._stopped = True
+            serving = self._serving.is_set()
+        if serving:
+            self.server.shutdown()
+        self.server.server_close()
+
+
+class MetricsReporter(threading.Thread):
+    """Logs a snapshot of the metrics every interval seconds"""
+    def __init__(self, logger, interval, registry=REGISTRY):
+        super(MetricsReporter, self).__init__()
+        self.daemon = True
+        self.logger = logger
+        self.interval = interval
+        self.registry = registry
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self.logger.info("Metrics: {}".format(
+                json.dumps(self.registry.snapshot(), sort_keys=True)))
+
+    def stop(self):
+        self._stopped.set()
+
+
+def exporters(logger, settings):
+    """Creates the exporter threads enabled by the metrics settings"""
+    threads = []
+    if settings.port is not None:
+        logger.info("Serving metrics on port {}".format(settings.port))
+        threads.append(MetricsServer(settings.port))
+    if settings.log_interval is not None:
+        threads.append(MetricsReporter(logger, settings.log_interval))
+    return threads
@@ -1,30 +1,65 @@
 """Message queue components module"""
+import sys
+import time
+import functools
+import collections
 import threading
+from multiprocessing.pool import ThreadPool
 import pika
 
+from saifu.core import models, codec
+from saifu.core.system import metrics
+
 class Connector(object):
     """Connector to RMQ broker (Blocking)"""
     def __init__(self, settings):
         self.settings = settings
 
+    def parameters(self):
+        """Builds the broker connection parameters from settings"""
+        return pika.ConnectionParameters(
+            host=self.settings.host,
+            credentials=pika.credentials.PlainCredentials(
+                username=self.settings.credentials.username,
+                password=self.settings.credentials.password))
+
     def connect(self):
         """Creates a connection to message queue broker from settings"""
-        conn = pika.BlockingConnection(
-            pika.ConnectionParameters(
-                host=self.settings.host,
-                credentials=pika.credentials.PlainCredentials(
-                    username=self.settings.credentials.username,
-                    password=self.settings.credentials.password)))
+        conn = pika.BlockingConnection(self.parameters())
         return conn
 
 
+def routed(body, routing_key):
+    """Tags an encoded message body with the routing key to publish it with"""
+    message = codec.Message(body)
+    message.content_type = getattr(body, "content_type", None)
+    message.routing_key = routing_key
+    return message
+
+
+def _routing_key(body):
+    """Returns the routing key a message body is tagged with"""
+    return getattr(body, "routing_key", '')
+
+
+def _properties(body):
+    """Returns the message properties carrying the body content type"""
+    content_type = getattr(body, "content_type", None)
+    if content_type is None:
+        return None
+    return pika.BasicProperties(content_type=content_type)
+
+
 class _GenericMQAgent(threading.Thread):
-    def __init__(self, connector, reconnect=True):
+    def __init__(self, connector, reconnect=True, name=None):
         super(_GenericMQAgent, self).__init__()
         self._connector = connector
         self._reconnect = reconnect
+        self._connection = None
         self._channel = None
         self._running = True
+        self._metrics = metrics.scope(name or type(self).__name__.lower())
+        self._reconnects = self._metrics.counter("reconnects")
 
     def _get_channel(self):
         """Returns the connection channel"""
@@ -42,10 +77,23 @@ class _GenericMQAgent(threading.Thread):
         """Additional stop operations"""
         pass
 
+    def _disconnect(self):
+        """Closes the current broker connection, if any (it is usually
+        already lost when the agent reconnects)
+        """
+        connection, self._connection, self._channel = self._connection, None, None
+        if connection is None or connection.is_closed:
+            return
+        try:
+            connection.close()
+        except pika.exceptions.AMQPError:
+            pass
+
     def _connect(self):
         """Connects the agent to the message queue broker"""
-        connection = self._connector.connect()
-        self._channel = connection.channel()
+        self._disconnect()
+        self._connection = self._connector.connect()
+        self._channel = self._connection.channel()
 
     def running(self):
         """Indicates whether the agent should be running."""
@@ -66,6 +114,7 @@ class _GenericMQAgent(threading.Thread):
             except pika.exceptions.ConnectionClosed:
                 if not self._reconnect:
                     raise
+                self._reconnects.inc()
 
     def stop(self):
         """Stops the agent.
@@ -76,16 +125,41 @@ class _GenericMQAgent(threading.Thread):
 
 
 class GenericPublisher(_GenericMQAgent):
-    """Generic threaded publisher"""
-    def __init__(self, exchange, connector, reconnect=True):
-        super(GenericPublisher, self).__init__(connector, reconnect)
+    """Generic threaded publisher
+    Published messages go through an outbound buffer flushed once it holds
+    buffer_size messages or its oldest message is flush_interval seconds old.
+    With publisher confirms enabled, nacked messages stay in the buffer and
+    are retried on the next flush, buffered messages survive reconnections.
+    Confirmed publishing is synchronous: the blocking channel waits for the
+    broker ack of each message, so a flush costs one round-trip per message
+    and the buffer only saves the publishing calls. Keep confirms off where
+    throughput matters more than delivery guarantees.
+    """
+    def __init__(self, exchange, connector, reconnect=True, settings=None,
+                 exchange_type='fanout'):
+        super(GenericPublisher, self).__init__(
+            connector, reconnect, "publisher." + exchange)
         self._exchange = exchange
+        self._exchange_type = exchange_type
+        self._settings = settings or models.PublisherSettings()
+        self._pending = collections.deque()
+        self._pending_since = None
+        self._published = 0
+        self._confirmed = 0
+        self._nacked = 0
+        self._flush_time = self._metrics.histogram("flush_seconds")
+        self._metrics.gauge("pending", lambda: len(self._pending))
+        self._metrics.gauge("published", lambda: self._published)
+        self._metrics.gauge("confirmed", lambda: self._confirmed)
+        self._metrics.gauge("nacked", lambda: self._nacked)
 
     def _initialize(self):
         """Publisher agent initialization (internal)"""
         self._get_channel().exchange_declare(
             exchange=self._exchange,
-            type='fanout')
+            exchange_type=self._exchange_type)
+        if self._settings.confirms:
+            self._get_channel().confirm_delivery()
 
     def _dispatch(self):
         """Dispatch to user implementation"""
@@ -99,28 +173,105 @@ class GenericPublisher(_GenericMQAgent):
 
     def publish(self, data):
         """Publishes data to the exchange"""
-        self._get_channel().basic_publish(
-            exchange=self._exchange,
-            routing_key='',
-            body=data)
+        self.publish_many([data])
+
+    def publish_many(self, messages):
+        """Publishes a batch of messages to the exchange"""
+        if not self._pending:
+            self._pending_since = time.time()
+        self._pending.extend(messages)
+        if self._flush_due():
+            self.flush()
+
+    def _flush_due(self):
+        """Determines if the outbound buffer must be flushed"""
+        if not self._pending:
+            return False
+        if len(self._pending) >= self._settings.buffer_size:
+            return True
+        interval = self._settings.flush_interval
+        return interval is not None and time.time() - self._pending_since >= interval
+
+    def flush(self):
+        """Publishes all the buffered messages"""
+        if not self._pending:
+            return
+        start = time.time()
+        nacked = []
+        try:
+            while self._pending:
+                body = self._pending[0]
+                delivered = self._get_channel().basic_publish(
+                    exchange=self._exchange,
+                    routing_key=_routing_key(body),
+                    body=body,
+                    properties=_properties(body))
+                self._pending.popleft()
+                self._published += 1
+                if not self._settings.confirms:
+                    continue
+                if delivered:
+                    self._confirmed += 1
+                else:
+                    self._nacked += 1
+                    nacked.append(body)
+        finally:
+            self._pending.extendleft(reversed(nacked))
+            self._pending_since = time.time() if self._pending else None
+            self._flush_time.observe(time.time() - start)
+
+    def sleep(self, duration):
+        """Sleeps for duration seconds
+        The connection keeps being serviced and the outbound buffer is flushed
+        when due.
+        """
+        deadline = time.time() + duration
+        remaining = duration
+        while remaining > 0:
+            if self._flush_due():
+                self.flush()
+            step = remaining
+            if self._pending and self._settings.flush_interval is not None:
+                step = min(step, self._settings.flush_interval)
+            self._connection.sleep(step)
+            remaining = deadline - time.time()
+
+    def stats(self):
+        """Returns the publishing counters"""
+        return {
+            "pending": len(self._pending),
+            "published": self._published,
+            "confirmed": self._confirmed,
+            "nacked": self._nacked
+        }
 
 
 class GenericSubscriber(_GenericMQAgent):
     """Generic threaded subscriber
     A subscriber subscribes to an exchange and receives broadcasted updates
+    (or its share of them, depending on the exchange type and binding key)
     """
-    def __init__(self, exchange, connector, reconnect=True):
-        super(GenericSubscriber, self).__init__(connector, reconnect)
+    def __init__(self, exchange, connector, reconnect=True, exchange_type='fanout',
+                 binding_key=''):
+        super(GenericSubscriber, self).__init__(
+            connector, reconnect, "subscriber." + exchange)
         self._exchange = exchange
+        self._exchange_type = exchange_type
+        self._binding_key = binding_key
+        self._received_count = self._metrics.counter("received")
+        self._handler_time = self._metrics.histogram("handler_seconds")
 
     def _initialize(self):
         """Publisher agent initialization (internal)"""
         self._get_channel().exchange_declare(
             exchange=self._exchange,
-            type='fanout')
+            exchange_type=self._exchange_type)
         queue_name = self._channel.queue_declare(exclusive=True).method.queue
         self._channel.basic_consume(self._received, queue=queue_name, no_ack=True)
-        self._channel.queue_bind(exchange=self._exchange, queue=queue_name)
+        self._channel.queue_bind(
+            exchange=self._exchange,
+            queue=queue_name,
+            routing_key=self._binding_key)
 
     def _dispatch(self):
         """Starts to consumme incomming updates"""
@@ -133,7 +284,10 @@ class GenericSubscriber(_GenericMQAgent):
 
     def _received(self, channel, method, properties, body):
         """Called when a new message is received"""
-        self.received(body)
+        self._received_count.inc()
+        start = time.time()
+        self.received(codec.tag(body, properties.content_type))
+        self._handler_time.observe(time.time() - start)
 
     def received(self, message):
         """User defined handler called when a message is received"""
@@ -146,8 +300,10 @@ class GenericDispatcher(_GenericMQAgent):
     single worker agent
     """
     def __init__(self, queue, connector, reconnect=True):
-        super(GenericDispatcher, self).__init__(connector, reconnect)
+        super(GenericDispatcher, self).__init__(
+            connector, reconnect, "dispatcher." + queue)
         self._queue = queue
+        self._dispatched = self._metrics.counter("dispatched")
 
     def _initialize(self):
         """Publisher agent initialization (internal)"""
@@ -159,10 +315,18 @@ class GenericDispatcher(_GenericMQAgent):
 
     def dispatch(self, job):
         """Dispatch a job to the queue"""
+        self._dispatched.inc()
         self._get_channel().basic_publish(
             exchange="Direct-X",
             routing_key="Key1",
-            body=job)
+            body=job,
+            properties=_properties(job))
+
+    def sleep(self, duration):
+        """Sleeps for duration seconds, the connection keeps being serviced
+        (heartbeats)
+        """
+        self._connection.sleep(duration)
 
     def work(self):
         """Publisher implementation
@@ -172,21 +336,85 @@ class GenericDispatcher(_GenericMQAgent):
 
 class GenericWorker(_GenericMQAgent):
     """Generic threaded worker
-    A worker picks up work from a work queue and execute it
+    A worker picks up work from a work queue and execute it. Jobs are handled
+    on a pool of concurrency threads, at most prefetch jobs are delivered
+    ahead of time and a job is only acknowledged once handled, the
+    acknowledgement being marshalled back to the connection thread.
+    With requeue_on_error, a failed job is requeued once: it is rejected for
+    good (counted in rejected) if it fails again once redelivered.
     """
-    def __init__(self, queue, connector, reconnect=True):
-        super(GenericWorker, self).__init__(connector, reconnect)
+    def __init__(self, queue, connector, reconnect=True, settings=None):
+        super(GenericWorker, self).__init__(
+            connector, reconnect, "worker." + queue)
         self._queue = queue
+        self._settings = settings or models.WorkerSettings()
+        self._pool = None
+        self._deliveries = 0
+        self._settled = 0
+        self._failed = self._metrics.counter("failed")
+        self._rejected = self._metrics.counter("rejected")
+        self._handler_time = self._metrics.histogram("handler_seconds")
+        self._metrics.gauge("received", lambda: self._deliveries)
+        self._metrics.gauge("in_flight", lambda: self._deliveries - self._settled)
 
     def _handle(self, ch, method, properties, body):
-        self.handle(body)
+        """Hands over a delivery to the handlers pool (connection thread)"""
+        self._deliveries += 1
+        self._pool.apply_async(
+            self._execute,
+            (self._connection, ch, method.delivery_tag, self._requeue(method),
+             codec.tag(body, properties.content_type)))
+
+    def _requeue(self, method):
+        """Determines if a delivery is requeued if its job fails"""
+        return self._settings.requeue_on_error and not method.redelivered
+
+    def _execute(self, connection, channel, delivery_tag, requeue, body):
+        """Handles one job and settles its delivery (pool thread)"""
+        success = self._handle_safely(body)
+        try:
+            connection.add_callback_threadsafe(functools.partial(
+                self._settle, channel, delivery_tag, success, requeue))
+        except pika.exceptions.ConnectionClosed:
+            pass
+
+    def _handle_safely(self, body):
+        """Calls the user handler, returns False if it failed"""
+        start = time.time()
+        try:
+            self.handle(body)
+            return True
+        except Exception:
+            self._failed.inc()
+            self.failed(body, sys.exc_info())
+            return False
+        finally:
+            self._handler_time.observe(time.time() - start)
+
+    def _settle(self, channel, delivery_tag, success, requeue):
+        """Acks or rejects a delivery (connection thread)
+        Deliveries received on a previous channel are redelivered by the
+        broker anyway and are ignored.
+        """
+        self._settled += 1
+        if channel is not self._get_channel() or not channel.is_open:
+            return
+        if success:
+            channel.basic_ack(delivery_tag=delivery_tag)
+        else:
+            if not requeue:
+                self._rejected.inc()
+            channel.basic_nack(delivery_tag=delivery_tag, requeue=requeue)
 
     def _initialize(self):
         """Publisher agent initialization (internal)"""
+        if self._pool is None:
+            self._pool = ThreadPool(self._settings.concurrency)
         self._get_channel().exchange_declare(exchange="Direct-X", exchange_type="direct")
         self._get_channel().queue_declare(queue=self._queue, durable=True)
         self._get_channel().queue_bind(exchange="Direct-X",queue=self._queue, routing_key="Key1")
-        self._get_channel().basic_consume(self._handle, queue=self._queue, no_ack=True)
+        self._get_channel().basic_qos(prefetch_count=self._settings.prefetch)
+        self._get_channel().basic_consume(self._handle, queue=self._queue, no_ack=False)
 
     def _post_stop(self):
         """Stop consumming after stop is called"""
@@ -195,9 +423,24 @@ class GenericWorker(_GenericMQAgent):
 
     def _dispatch(self):
         self._get_channel().start_consuming()
-
-    def handle(self, job, ack):
-        """Handles the job. ack must be called (with no argument) after the
-        job is executer.
+        if not self.running():
+            self._drain()
+
+    def _drain(self):
+        """Waits for the jobs in progress and sends their acknowledgements"""
+        self._pool.close()
+        self._pool.join()
+        self._connection.process_data_events()
+
+    def handle(self, job):
+        """Handles the job
+        Must be implemented by user. The job is acknowledged if handle
+        returns, rejected if it raises.
         """
         raise RuntimeError("handle is not implemented")
+
+    def failed(self, job, exc_info):
+        """Called when handle raised for a job
+        May be overriden.
+        """
+        pass
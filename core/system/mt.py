@@ -1,37 +1,274 @@
 """MulThreading components module"""
+import sys
 import time
+import signal
+import logging
+import threading
+import collections
+import Queue
+
+from saifu.core.system import metrics
+
+
+class BoundedQueue(object):
+    """Bounded handoff queue between threads
+    When the queue is full, put applies the overflow policy:
+    - block: waits for room (backpressure on the producer)
+    - drop-oldest: discards the oldest item to make room
+    - coalesce: merges the item into the newest one with merge(older, newer)
+    get raises Queue.Empty on timeout, like Queue.Queue.
+    """
+    BLOCK = "block"
+    DROP_OLDEST = "drop-oldest"
+    COALESCE = "coalesce"
+
+    def __init__(self, maxsize, policy=BLOCK, merge=None):
+        if policy not in (self.BLOCK, self.DROP_OLDEST, self.COALESCE):
+            raise ValueError("Unknown overflow policy {}".format(policy))
+        if policy == self.COALESCE and merge is None:
+            raise ValueError("The coalesce policy requires a merge function")
+        self.maxsize = max(1, maxsize)
+        self.policy = policy
+        self.merge = merge
+        self.dropped = 0
+        self.coalesced = 0
+        self._items = collections.deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+
+    def qsize(self):
+        return len(self._items)
+
+    def put(self, item):
+        """Queues an item, applying the overflow policy if full"""
+        with self._lock:
+            if len(self._items) >= self.maxsize:
+                if self.policy == self.BLOCK:
+                    while len(self._items) >= self.maxsize:
+                        self._not_full.wait()
+                elif self.policy == self.DROP_OLDEST:
+                    self._items.popleft()
+                    self.dropped += 1
+                else:
+                    self._items[-1] = self.merge(self._items[-1], item)
+                    self.coalesced += 1
+                    return
+            self._items.append(item)
+            self._not_empty.notify()
+
+    def get(self, timeout=None):
+        """Returns the oldest item, waits at most timeout seconds"""
+        with self._lock:
+            if timeout is not None:
+                deadline = time.time() + timeout
+            while not self._items:
+                if timeout is None:
+                    self._not_empty.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise Queue.Empty()
+                self._not_empty.wait(remaining)
+            item = self._items.popleft()
+            self._not_full.notify()
+            return item
+
+
+class _Runner(threading.Thread):
+    """Runs a supervised agent once and notifies the supervisor on exit"""
+    def __init__(self, child, events):
+        super(_Runner, self).__init__(name=child.name)
+        self.daemon = True
+        self.child = child
+        self.events = events
+
+    def run(self):
+        exc_info = None
+        try:
+            self.child.agent.run()
+        except Exception:
+            exc_info = sys.exc_info()
+        self.events.put((self.child, self, exc_info))
+
+
+class _Child(object):
+    """Supervision state of one agent"""
+    def __init__(self, name, agent):
+        self.name = name
+        self.agent = agent
+        self.state = "new"
+        self.runner = None
+        self.started_at = None
+        self.restart_at = None
+        self.failures = 0
+        self.restarts = 0
+        self.failure_times = collections.deque()
+        self.last_error = None
+
+    def report(self):
+        return {
+            "state": self.state,
+            "restarts": self.restarts,
+            "last_error": self.last_error
+        }
+
+
+def _names(threads):
+    """Names the agents after their type (suffixed if the type repeats)"""
+    seen = collections.Counter()
+    for thread in threads:
+        name = type(thread).__name__
+        seen[name] += 1
+        yield name if seen[name] == 1 else "{}-{}".format(name, seen[name])
+
 
 class ThreadManager(object):
-    """Manages a group of threads"""
-    def __init__(self, *threads):
+    """Supervises a group of agents
+    Each agent is run on a runner thread which notifies the manager as soon
+    as the agent exits. An agent that fails (or returns while the group is
+    running) is restarted alone by running it again after an exponential
+    backoff, reset once the agent ran for stable_after seconds. If an agent
+    fails more than max_restarts times within restart_window seconds, the
+    whole group is stopped.
+    SIGTERM and SIGINT stop the agents one at a time in reverse order, waiting
+    for each one to drain before stopping the next (drain_timeout seconds at
+    most overall): an agent feeding another one must be registered after it.
+    """
+    _POLL_INTERVAL = 0.5
+
+    def __init__(self, *threads, **options):
         self.threads = threads
+        self.logger = options.get("logger") or logging.getLogger("saifu.mt")
+        self.backoff = options.get("backoff", 1)
+        self.max_backoff = options.get("max_backoff", 60)
+        self.stable_after = options.get("stable_after", 60)
+        self.max_restarts = options.get("max_restarts", 10)
+        self.restart_window = options.get("restart_window", 300)
+        self.drain_timeout = options.get("drain_timeout", 30)
+        self._children = [
+            _Child(name, thread) for name, thread in zip(_names(threads), threads)]
+        self._events = Queue.Queue()
+        self._stopping = False
+        self._signaled = None
 
-    def _monitor_one(self, thread):
-        thread.join()
+        scope = metrics.scope("supervisor")
+        for child in self._children:
+            scope.gauge(child.name + ".up",
+                        lambda child=child: int(child.state == "running"))
+            scope.gauge(child.name + ".restarts", lambda child=child: child.restarts)
 
-    def _monitor(self):
-        """Monitors a group of threads
-        If one of the monitored threads goes down, all the threads are stopped.
-        """
-        if len(self.threads) == 1:
-            self._monitor_one(self.threads[0])
+    def states(self):
+        """Returns the supervision state of every agent"""
+        return dict((child.name, child.report()) for child in self._children)
+
+    def _on_signal(self, signum, _):
+        # Only flags the signal, the monitor loop does the work
+        self._signaled = signum
+
+    def _install_signal_handlers(self):
+        """Handles SIGTERM and SIGINT (only possible from the main thread)"""
+        if not isinstance(threading.current_thread(), threading._MainThread):
             return
+        signal.signal(signal.SIGTERM, self._on_signal)
+        signal.signal(signal.SIGINT, self._on_signal)
+
+    def _launch(self, child):
+        """Runs an agent on a new runner thread"""
+        child.runner = _Runner(child, self._events)
+        child.started_at = time.time()
+        child.restart_at = None
+        child.state = "running"
+        child.runner.start()
 
-        all_alive = True
-        while all_alive:
-            if not all([t.isAlive() for t in self.threads]):
-                for thread in self.threads:
-                    thread.stop()
-                all_alive = False
-            else:
-                time.sleep(5)
+    def _exited(self, child, runner, exc_info):
+        """Handles the exit of an agent, returns False if the group must stop"""
+        if runner is not child.runner or self._stopping:
+            return True
+        now = time.time()
+        if exc_info is not None:
+            child.last_error = str(exc_info[1])
+            self.logger.error("Agent {} failed".format(child.name), exc_info=exc_info)
+        else:
+            child.last_error = "exited"
+            self.logger.error("Agent {} exited unexpectedly".format(child.name))
+
+        if now - child.started_at >= self.stable_after:
+            child.failures = 0
+        child.failures += 1
+        child.failure_times.append(now)
+        while child.failure_times and now - child.failure_times[0] > self.restart_window:
+            child.failure_times.popleft()
+        if len(child.failure_times) > self.max_restarts:
+            child.state = "failed"
+            self.logger.error("Agent {} failed {} times in {}s, stopping all agents".format(
+                child.name, len(child.failure_times), self.restart_window))
+            return False
+
+        delay = min(self.max_backoff, self.backoff * 2 ** (child.failures - 1))
+        child.state = "backoff"
+        child.restart_at = now + delay
+        self.logger.warn("Will restart agent {} in {}s".format(child.name, delay))
+        return True
+
+    def _restart_due(self):
+        """Restarts the agents whose backoff is over"""
+        now = time.time()
+        for child in self._children:
+            if child.state == "backoff" and child.restart_at <= now:
+                child.restarts += 1
+                self.logger.info("Restarting agent {} (restart #{})".format(
+                    child.name, child.restarts))
+                self._launch(child)
+
+    def _monitor(self):
+        """Supervises the agents until a signal or a restart escalation"""
+        while self._signaled is None:
+            timeout = ThreadManager._POLL_INTERVAL
+            restart_times = [child.restart_at for child in self._children
+                             if child.state == "backoff"]
+            if restart_times:
+                timeout = max(0.01, min(timeout, min(restart_times) - time.time()))
+            try:
+                event = self._events.get(timeout=timeout)
+            except Queue.Empty:
+                event = None
+            if event is not None and not self._exited(*event):
+                return
+            self._restart_due()
+        self.logger.info("Received signal {}, stopping".format(self._signaled))
+
+    def _shutdown(self):
+        """Stops the agents one at a time in reverse order, each one drained
+        before the next is stopped
+        """
+        self._stopping = True
+        deadline = time.time() + self.drain_timeout
+        for child in reversed(self._children):
+            try:
+                child.agent.stop()
+            except Exception:
+                self.logger.warn("Failed to stop agent {}".format(child.name),
+                                 exc_info=sys.exc_info())
+            if child.runner is not None:
+                child.runner.join(max(0, deadline - time.time()))
+                if child.runner.is_alive():
+                    self.logger.warn("Agent {} did not drain in time".format(child.name))
+                    continue
+            if child.state != "failed":
+                child.state = "stopped"
+        self.logger.info("Agents stopped: {}".format(self.states()))
 
     def _start_all(self):
         """Starts all threads in the thread group"""
-        for thread in self.threads:
-            thread.start()
+        for child in self._children:
+            self._launch(child)
 
     def start(self):
-        """Starts the group of threads and monitors them"""
+        """Starts the group of threads and supervises them until stopped"""
+        self._install_signal_handlers()
         self._start_all()
-        self._monitor()
+        try:
+            self._monitor()
+        finally:
+            self._shutdown()
@@ -1,8 +1,15 @@
 """General utility function module"""
-import datetime
 import time
+import datetime
 import logging
-import json
+
+from saifu.core import codec as codecs
+from saifu.core.system import metrics
+
+_encode_time = metrics.REGISTRY.histogram("codec.encode_seconds")
+_decode_time = metrics.REGISTRY.histogram("codec.decode_seconds")
+
+_EPOCH = datetime.datetime(1970, 1, 1)
 
 def utc_time():
     """Returns the current timestamp in UTC timezone"""
@@ -19,25 +26,33 @@ def utc_from_timestamp(ts):
     return datetime.datetime.utcfromtimestamp(ts)
 
 def to_timestamp(dt):
-    """Returns timestamp from date time"""
+    """Returns timestamp from (UTC) date time"""
     if dt is None:
         return None
-    return time.mktime(dt.timetuple())
+    return (dt - _EPOCH).total_seconds()
+
+def to_microseconds(dt):
+    """Returns the number of microseconds since epoch of a (UTC) date time"""
+    delta = dt - _EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+def utc_from_microseconds(us):
+    """Returns UTC date time from a number of microseconds since epoch"""
+    return _EPOCH + datetime.timedelta(microseconds=us)
 
-def serialize(obj):
-    if type(obj) is list:
-        lst = obj
-        output = []
-        return json.dumps([o.to_json() for o in lst])
-    return json.dumps(obj.to_json())
+def serialize(obj, codec="json"):
+    """Encodes one object or a list of objects with the given codec"""
+    start = time.time()
+    message = codecs.get(codec).encode(obj)
+    _encode_time.observe(time.time() - start)
+    return message
 
 def unserialize(one_or_many_obj, The_type):
-    def unserialize_one(one_obj):
-        instance = The_type()
-        instance.from_json(one_obj)
-        return instance
-    one_or_many_obj = json.loads(one_or_many_obj)
-    if type(one_or_many_obj) is list:
-        many_obj = one_or_many_obj
-        return [unserialize_one(one_obj) for one_obj in many_obj]
-    return unserialize_one(one_or_many_obj)
+    """Decodes one object or a list of objects, with the codec matching the
+    message content type (JSON if the message is not tagged)
+    """
+    content_type = getattr(one_or_many_obj, "content_type", codecs.JSON)
+    start = time.time()
+    decoded = codecs.get(content_type).decode(one_or_many_obj, The_type)
+    _decode_time.observe(time.time() - start)
+    return decoded
@@ -1,13 +1,18 @@
 """Tick updates ingester (Updates saifudb with the last tick pricers)"""
 import sys
+import time
 import datetime
+import threading
 import contextlib
 import psycopg2
+import psycopg2.extras
 import pika
 import yaml
 
 from saifu.core import models, runtime, utils
-from saifu.core.system import mq, db, mt
+from saifu.core.system import mq, amq, db, mt, metrics
+
+_metrics = metrics.scope("ingester")
 
 class Settings(object):
     """Configuration for the current application"""
@@ -26,40 +31,220 @@ class Settings(object):
         self.mq = models.MQSettings()
         self.mq.from_json(app["mq"])
 
+        self.metrics = models.MetricsSettings()
+        self.metrics.from_json(app.get("metrics", {}))
+
+        shard = app.get("shard", {})
+        self.shard_exchange = shard.get("exchange")
+        self.shard_weight = shard.get("weight", 1)
+
+        ingest = app.get("ingest", {})
+        self.ingest_mode = ingest.get("mode", "row")
+        self.flush_size = ingest.get("flush_size", 500)
+        self.flush_interval = ingest.get("flush_interval", 5)
+        self.max_pending = ingest.get("max_pending")
+
 
 class Ingester(object):
     """Ingests quote updates"""
-    def __init__(self, logger, connector):
+    def __init__(self, logger, pool):
         self.logger = logger
-        self.connection = connector.connect()
+        self.pool = pool
 
     def ingest(self, quotes):
         """Ingests the provided quotes"""
         self.logger.debug("Will ingest {} updates".format(len(quotes)))
-        with self.connection.cursor() as cursor:
-            for quote in quotes:
-                try:
-                    cursor.execute(
-                        """INSERT INTO saifu_ccy_historical_prices (
-                              ticker, price, quote_time)
-                                VALUES (%s, %s, %s)""",
-                        (quote.ticker, quote.price, quote.timestamp))
-                except psycopg2.Error as err:
-                    self.logger.warn("Failed to persist ticker {}: {}".format(
-                        quote.ticker, str(err)))
-            self.connection.commit()
+        start = time.time()
+        with self.pool.connection() as connection:
+            with connection.cursor() as cursor:
+                for ticker, price, timestamp in quotes.rows():
+                    try:
+                        cursor.execute(
+                            """INSERT INTO saifu_ccy_historical_prices (
+                                  ticker, price, quote_time)
+                                    VALUES (%s, %s, %s)""",
+                            (ticker, price, timestamp))
+                    except psycopg2.Error as err:
+                        self.logger.warn("Failed to persist ticker {}: {}".format(
+                            ticker, str(err)))
+            connection.commit()
+        _metrics.histogram("write_seconds").observe(time.time() - start)
+        _metrics.counter("rows").inc(len(quotes))
+
+
+class BulkIngester(object):
+    """Ingests quote updates in multi-row batches
+    Quotes are buffered across several messages and written with multi-row
+    INSERTs of at most flush_size quotes once flush_size quotes are pending or
+    flush_interval seconds have elapsed since the last flush.
+    ingest only buffers the quotes, the writes are done by the thread calling
+    flush (see Flusher), so the subscriber never waits for the database.
+    When the database is unreachable, the batch is kept pending and retried
+    every flush_interval. At most max_pending quotes are kept, the oldest ones
+    are dropped beyond that. A batch rejected by the database is bisected down
+    to the offending quotes, which are the only ones dropped.
+    """
+    _INSERT_QUERY = """
+        INSERT INTO saifu_ccy_historical_prices (ticker, price, quote_time)
+             VALUES %s
+    """
+
+    def __init__(self, logger, pool, flush_size, flush_interval, max_pending=None):
+        self.logger = logger
+        self.pool = pool
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending or 100 * flush_size
+        self.pending = models.QuoteBatch()
+        self.last_flush = time.time()
+        self.failing = False
+        self.full = threading.Event()
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        _metrics.gauge("pending", lambda: len(self.pending))
+
+    def ingest(self, quotes):
+        """Buffers the provided quotes, requests a flush if the batch is full"""
+        with self.lock:
+            self.pending.extend(quotes)
+            self._trim()
+            if len(self.pending) >= self.flush_size and not self.failing:
+                self.full.set()
+
+    def wait_full(self, timeout):
+        """Waits at most timeout seconds for a full batch"""
+        return self.full.wait(timeout)
+
+    def flush_if_due(self):
+        """Flushes the pending quotes if the batch is full or the flush
+        interval has elapsed
+        """
+        if self.full.is_set() or time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Writes all the pending quotes"""
+        with self.write_lock:
+            with self.lock:
+                batch, self.pending = self.pending, models.QuoteBatch()
+                self.last_flush = time.time()
+                self.full.clear()
+            if not batch:
+                return
+            self.logger.debug("Will ingest batch of {} updates".format(len(batch)))
+            start = time.time()
+            rejected, remaining = self._write_isolating(batch)
+            _metrics.counter("rows").inc(len(batch) - rejected - len(remaining))
+            _metrics.counter("rejected_rows").inc(rejected)
+            with self.lock:
+                self.failing = bool(remaining)
+                if remaining:
+                    _metrics.counter("failed_batches").inc()
+                    remaining.extend(self.pending)
+                    self.pending = remaining
+                    self._trim()
+            _metrics.histogram("write_seconds").observe(time.time() - start)
+
+    def _trim(self):
+        """Drops the oldest pending quotes beyond max_pending (lock must be held)"""
+        excess = len(self.pending) - self.max_pending
+        if excess <= 0:
+            return
+        self.pending = self.pending.slice(excess, len(self.pending))
+        _metrics.counter("dropped_rows").inc(excess)
+        self.logger.warn("Dropped {} pending updates (more than {} pending)".format(
+            excess, self.max_pending))
+
+    def _write_isolating(self, batch):
+        """Writes a batch in chunks of flush_size quotes, bisecting the parts
+        rejected by the database down to the offending quotes, which are
+        dropped. Stops on a connection error, returns the number of dropped
+        quotes and the batch of the quotes left to write
+        """
+        rejected = 0
+        chunks = [batch.slice(start, start + self.flush_size)
+                  for start in range(0, len(batch), self.flush_size)]
+        chunks.reverse()
+        while chunks:
+            chunk = chunks.pop()
+            try:
+                self._write(chunk)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as err:
+                chunks.append(chunk)
+                remaining = models.QuoteBatch()
+                for chunk in reversed(chunks):
+                    remaining.extend(chunk)
+                self.logger.warn("Failed to persist {} updates, will retry: {}".format(
+                    len(remaining), str(err)))
+                return rejected, remaining
+            except psycopg2.Error as err:
+                if len(chunk) == 1:
+                    rejected += 1
+                    self.logger.warn("Dropped update {}: {}".format(
+                        next(chunk.rows()), str(err)))
+                    continue
+                middle = len(chunk) // 2
+                chunks.append(chunk.slice(middle, len(chunk)))
+                chunks.append(chunk.slice(0, middle))
+        return rejected, models.QuoteBatch()
+
+    def _write(self, batch):
+        """Inserts a batch of quotes with one multi-row statement"""
+        with self.pool.connection() as connection:
+            with connection.cursor() as cursor:
+                psycopg2.extras.execute_values(
+                    cursor,
+                    BulkIngester._INSERT_QUERY,
+                    batch.rows(),
+                    page_size=len(batch))
+            connection.commit()
+
+
+class Flusher(threading.Thread):
+    """Writes the quotes of a bulk ingester as soon as a batch is full, or
+    periodically
+    """
+    def __init__(self, logger, ingester, period=1):
+        super(Flusher, self).__init__()
+        self.logger = logger
+        self.ingester = ingester
+        self.period = period
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            self.ingester.wait_full(self.period)
+            self.ingester.flush_if_due()
+        self.logger.debug("Flushing pending updates before stopping")
+        self.ingester.flush()
+
+    def stop(self):
+        self._stopped.set()
 
 
 class Subscriber(mq.GenericSubscriber):
-    """Subscribes to quote updates and ingests them"""
-    def __init__(self, logger, exchange, connector, ingester):
-        super(Subscriber, self).__init__(exchange, connector)
+    """Subscribes to quote updates and ingests them
+    With a shard weight, the subscriber binds to a consistent hash exchange
+    and only ingests its share of the tickers (see mktagg.ShardedPublisher).
+    The shares are rebalanced by the broker as ingesters come and go.
+    """
+    def __init__(self, logger, exchange, connector, ingester, shard_weight=None):
+        exchange_type, binding_key = "fanout", ""
+        if shard_weight is not None:
+            exchange_type, binding_key = "x-consistent-hash", str(shard_weight)
+        super(Subscriber, self).__init__(
+            exchange, connector, exchange_type=exchange_type, binding_key=binding_key)
         self.logger = logger
         self.ingester = ingester
 
     def received(self, message):
         self.ingester.ingest(
-            utils.unserialize(message, models.Quote))
+            utils.unserialize(message, models.QuoteBatch))
+
+
+class AsyncSubscriber(amq.AsyncSubscriber, Subscriber):
+    """Subscriber running on a shared event loop"""
+    pass
 
 
 def main():
@@ -71,15 +256,49 @@ def main():
     settings = Settings(settings_data)
     logger = runtime.create_logger(settings.logging)
 
-    subscriber = Subscriber(
-        logger.getChild("sub"),
-        settings.exchange,
-        mq.Connector(settings.mq),
-        Ingester(
+    if settings.ingest_mode == "bulk":
+        ingester = BulkIngester(
+            logger.getChild("ingest"),
+            db.Pool(settings.database),
+            settings.flush_size,
+            settings.flush_interval,
+            settings.max_pending)
+    else:
+        ingester = Ingester(
             logger.getChild("ingest"),
-            db.Connector(settings.database)))
+            db.Pool(settings.database))
+
+    threads = []
+    subscriber_type = Subscriber
+    connector = mq.Connector(settings.mq)
+    if settings.mq.transport == "async":
+        loop = amq.EventLoop(connector)
+        threads.append(loop)
+        subscriber_type = AsyncSubscriber
+        connector = amq.Connector(loop)
+
+    # The flusher is stopped after the subscriber, so that it writes the
+    # last delivered quotes
+    if settings.ingest_mode == "bulk":
+        threads.append(Flusher(logger.getChild("flush"), ingester))
+
+    if settings.shard_exchange is not None:
+        logger.info("Will ingest a shard of {}".format(settings.shard_exchange))
+        threads.append(subscriber_type(
+            logger.getChild("sub"),
+            settings.shard_exchange,
+            connector,
+            ingester,
+            settings.shard_weight))
+    else:
+        threads.append(subscriber_type(
+            logger.getChild("sub"),
+            settings.exchange,
+            connector,
+            ingester))
 
-    mt.ThreadManager(subscriber).start()
+    threads.extend(metrics.exporters(logger.getChild("mtr"), settings.metrics))
+    mt.ThreadManager(*threads, logger=logger.getChild("sup")).start()
 
 if __name__ == '__main__':
     main()
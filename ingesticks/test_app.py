@@ -0,0 +1,109 @@
+"""Tests of the bulk tick ingestion"""
+import logging
+import datetime
+import psycopg2
+import pytest
+
+from saifu.core import models
+from saifu.ingesticks import app
+
+_TIME = datetime.datetime(2018, 1, 1)
+
+
+def _batch(*tickers):
+    batch = models.QuoteBatch()
+    for index, ticker in enumerate(tickers):
+        batch.append(ticker, 1.0 + index, _TIME + datetime.timedelta(seconds=index))
+    return batch
+
+
+def _tickers(batch):
+    return [ticker for ticker, _, _ in batch.rows()]
+
+
+class FakeDatabase(object):
+    """Records the written batches, rejects the batches holding a bad ticker
+    and fails with a connection error while down
+    """
+    def __init__(self, bad=(), down=False):
+        self.bad = set(bad)
+        self.down = down
+        self.rows = []
+        self.statements = []
+
+    def write(self, batch):
+        tickers = _tickers(batch)
+        self.statements.append(len(tickers))
+        if self.down:
+            raise psycopg2.OperationalError("server closed the connection")
+        if self.bad.intersection(tickers):
+            raise psycopg2.DataError("invalid input")
+        self.rows.extend(tickers)
+
+
+@pytest.fixture
+def database():
+    return FakeDatabase()
+
+
+@pytest.fixture
+def ingester(database):
+    ingester = app.BulkIngester(logging.getLogger("test"), None, 4, 5)
+    ingester._write = database.write
+    return ingester
+
+
+def test_write_isolating_writes_in_flush_size_chunks(ingester, database):
+    rejected, remaining = ingester._write_isolating(_batch(*"abcdefghij"))
+    assert (rejected, len(remaining)) == (0, 0)
+    assert database.rows == list("abcdefghij")
+    assert database.statements == [4, 4, 2]
+
+
+def test_write_isolating_drops_only_the_bad_row(ingester, database):
+    database.bad.add("c")
+    rejected, remaining = ingester._write_isolating(_batch(*"abcdef"))
+    assert (rejected, len(remaining)) == (1, 0)
+    assert database.rows == list("abdef")
+
+
+def test_write_isolating_keeps_the_batch_on_connection_errors(ingester, database):
+    database.down = True
+    rejected, remaining = ingester._write_isolating(_batch(*"abcdef"))
+    assert rejected == 0
+    assert _tickers(remaining) == list("abcdef")
+    assert database.rows == []
+
+
+def test_write_isolating_keeps_the_unwritten_rows_on_connection_errors(ingester, database):
+    def write(batch):
+        if database.rows:
+            database.down = True
+        database.write(batch)
+    ingester._write = write
+    rejected, remaining = ingester._write_isolating(_batch(*"abcdef"))
+    assert rejected == 0
+    assert database.rows == list("abcd")
+    assert _tickers(remaining) == list("ef")
+
+
+def test_flush_retries_the_pending_rows_once_the_database_is_back(ingester, database):
+    database.down = True
+    ingester.ingest(_batch(*"abc"))
+    ingester.flush()
+    assert ingester.failing
+    assert _tickers(ingester.pending) == list("abc")
+
+    database.down = False
+    ingester.ingest(_batch("d"))
+    ingester.flush()
+    assert not ingester.failing
+    assert database.rows == list("abcd")
+
+
+def test_ingest_drops_the_oldest_rows_beyond_max_pending(ingester, database):
+    ingester.max_pending = 3
+    ingester.failing = True
+    ingester.ingest(_batch(*"abcde"))
+    assert _tickers(ingester.pending) == list("cde")
+    assert database.statements == []
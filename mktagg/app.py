@@ -1,14 +1,16 @@
 """Aggregates market data updates in a given time window"""
 import sys
+import zlib
+import time
 import threading
+import collections
 import Queue
-import copy
 import datetime
 import yaml
 import pika
 
 from saifu.core import utils, models, runtime
-from saifu.core.system import mq, mt
+from saifu.core.system import mq, amq, mt, metrics
 
 
 class Settings(object):
@@ -21,60 +23,151 @@ class Settings(object):
 
         app = conf["app"]
         self.aggregation_window = app["aggregation_window"]
+        self.aggregation_slide = app.get("aggregation_slide")
+        self.summary_exchange = app.get("summary_exchange")
         self.pub_exchange = app["pub_exchange"]
+
+        shard = app.get("shard", {})
+        self.shard_exchange = shard.get("exchange")
+        self.shard_buckets = shard.get("buckets", 64)
         self.sub_exchange = app["sub_exchange"]
 
         self.mq = models.MQSettings()
         self.mq.from_json(app["mq"])
 
+        self.metrics = models.MetricsSettings()
+        self.metrics.from_json(app.get("metrics", {}))
+
+        self.publisher = models.PublisherSettings()
+        self.publisher.from_json(app.get("publisher", {}))
+
+        handoff = app.get("handoff", {})
+        self.handoff_size = handoff.get("size", 16)
+        self.handoff_policy = handoff.get("policy", mt.BoundedQueue.COALESCE)
+
 
 class QuoteAggregation(object):
-    """Aggregates quotes over a period of time"""
-    def __init__(self):
+    """Aggregates quotes over a period of time
+    Keeps the last quote of each ticker and, optionally, its running
+    [open, high, low, close, count, total] summary.
+    """
+    def __init__(self, summarize=False):
         self.agg = {}
+        self.summary = {} if summarize else None
 
     def insert(self, quote):
         """Inserts a quote in the aggregation"""
         self.agg[quote.ticker] = quote
+        if self.summary is None:
+            return
+        price = quote.price
+        summary = self.summary.get(quote.ticker)
+        if summary is None:
+            self.summary[quote.ticker] = [price, price, price, price, 1, price]
+        else:
+            summary[1] = max(summary[1], price)
+            summary[2] = min(summary[2], price)
+            summary[3] = price
+            summary[4] += 1
+            summary[5] += price
 
-    def get_all(self):
-        """Returns a copy of the current aggregation"""
-        return copy.deepcopy(self.agg)
 
-    def reset(self):
-        """Clears the current aggregation"""
-        self.agg = {}
+def _merge_summaries(aggregations):
+    """Merges the summaries of consecutive aggregations (oldest first)"""
+    merged = {}
+    for aggregation in aggregations:
+        for ticker, summary in aggregation.summary.items():
+            current = merged.get(ticker)
+            if current is None:
+                merged[ticker] = list(summary)
+            else:
+                current[1] = max(current[1], summary[1])
+                current[2] = min(current[2], summary[2])
+                current[3] = summary[3]
+                current[4] += summary[4]
+                current[5] += summary[5]
+    return merged
 
 
 class WindowAggregator(object):
-    """Aggregates data over a pre-defined period of time"""
-    def __init__(self, logger, window_size, callback):
+    """Aggregates data over a pre-defined period of time
+    The window is closed by flush (called by a timer every slide seconds).
+    Every flush hands the quotes of the last slide over to the callback, so
+    that each quote is published once, a fresh aggregation taking its place.
+    With slide equal to the window size (the default), windows are tumbling.
+    With a shorter slide, windows are sliding: the last window_size / slide
+    aggregations are kept and their summaries merged on every flush.
+    """
+    def __init__(self, logger, window_size, callback, slide=None, summary_callback=None):
         self.logger = logger
         self.window_size = window_size
+        self.slide = slide or window_size
         self.callback = callback
-        self.aggregation = QuoteAggregation()
-        self.window_end = utils.utc_time()
+        self.summary_callback = summary_callback
+        self.panes = collections.deque(
+            maxlen=max(1, int(round(window_size / float(self.slide)))))
+        self.aggregation = self._new_aggregation()
+        self.lock = threading.Lock()
 
-    def next_window(self):
-        """Find the end of the next window from the current time"""
-        return utils.utc_time_with_offset(
-            datetime.timedelta(seconds=self.window_size))
-
-    def is_window_end(self):
-        """Determines if the current aggregation window is finished"""
-        return utils.utc_time() > self.window_end
+    def _new_aggregation(self):
+        return QuoteAggregation(self.summary_callback is not None)
 
     def aggregate(self, quote):
-        """Aggregates a new piece of data
-        Calls the callback with the full aggregation if the current window is
-        finished.
+        """Aggregates a new piece of data"""
+        with self.lock:
+            self.aggregation.insert(quote)
+
+    def flush(self):
+        """Closes the current aggregation window
+        Calls the callback with the last quote of each ticker since the
+        previous flush, and the summary callback with the tickers summaries
+        over the whole window.
         """
-        self.aggregation.insert(quote)
-        if self.is_window_end():
-            self.logger.debug("End of current aggregation window")
-            self.callback(self.aggregation.get_all())
-            self.aggregation.reset()
-            self.window_end = self.next_window()
+        with self.lock:
+            pane, self.aggregation = self.aggregation, self._new_aggregation()
+
+        quotes = pane.agg
+        self.logger.debug("End of current aggregation window ({} tickers)".format(
+            len(quotes)))
+        if quotes:
+            self.callback(quotes)
+
+        if self.summary_callback is not None:
+            self.panes.append(pane)
+            end_time = utils.utc_time()
+            start_time = end_time - datetime.timedelta(seconds=self.window_size)
+            summaries = [
+                models.QuoteSummary(
+                    ticker=ticker,
+                    open=summary[0],
+                    high=summary[1],
+                    low=summary[2],
+                    close=summary[3],
+                    count=summary[4],
+                    average=summary[5] / summary[4],
+                    start_time=start_time,
+                    end_time=end_time)
+                for ticker, summary in _merge_summaries(self.panes).items()]
+            if summaries:
+                self.summary_callback(summaries)
+
+
+class WindowTimer(threading.Thread):
+    """Flushes a window aggregator every slide seconds"""
+    def __init__(self, logger, aggregator):
+        super(WindowTimer, self).__init__()
+        self.logger = logger
+        self.aggregator = aggregator
+        self._stopped = threading.Event()
+
+    def run(self):
+        next_flush = time.time() + self.aggregator.slide
+        while not self._stopped.wait(max(0, next_flush - time.time())):
+            self.aggregator.flush()
+            next_flush += self.aggregator.slide
+
+    def stop(self):
+        self._stopped.set()
 
 
 class Subscriber(mq.GenericSubscriber):
@@ -86,24 +179,52 @@ class Subscriber(mq.GenericSubscriber):
         self.logger.info("Quotes subscriber is ready")
 
     def received(self, message):
-        quote = utils.unserialize(message, models.Quote)
-        self.logger.debug("Received quote {}@{}".format(
-            quote.ticker, quote.price))
+        quotes = utils.unserialize(message, models.Quote)
+        if type(quotes) is not list:
+            quotes = [quotes]
+        for quote in quotes:
+            self.logger.debug("Received quote {}@{}".format(
+                quote.ticker, quote.price))
 
-        self.aggregator.aggregate(quote)
+            self.aggregator.aggregate(quote)
 
 class Publisher(mq.GenericPublisher):
-    """publishes aggregated data updates to exchange"""
-    def __init__(self, logger, exchange, connector):
-        super(Publisher, self).__init__(exchange, connector)
+    """publishes aggregated data updates to exchange
+    Windows are handed over through a bounded queue of handoff_size windows,
+    the overflow policy decides what happens when the publisher lags behind
+    (see mt.BoundedQueue).
+    """
+    def __init__(self, logger, exchange, connector, settings=None, codec="json",
+                 handoff_size=16, handoff_policy=mt.BoundedQueue.COALESCE,
+                 exchange_type="fanout"):
+        super(Publisher, self).__init__(
+            exchange, connector, settings=settings, exchange_type=exchange_type)
         self.logger = logger
-        self.queue = Queue.Queue()
+        self.codec = codec
+        self.queue = mt.BoundedQueue(handoff_size, handoff_policy, self.merge)
+        self._metrics.gauge("queue_depth", self.queue.qsize)
+        self._metrics.gauge("dropped", lambda: self.queue.dropped)
+        self._metrics.gauge("coalesced", lambda: self.queue.coalesced)
         self.logger.info("Aggregated quotes publisher is ready")
 
     def notify(self, quote):
         """Notifies the publisher about a new quote"""
         self.queue.put(quote)
 
+    def merge(self, older, newer):
+        """Coalesces two pending windows, the newest quotes win"""
+        merged = dict(older)
+        merged.update(newer)
+        return merged
+
+    def encode(self, quotes):
+        """Serializes the aggregated quotes (ticker -> quote)"""
+        return utils.serialize(models.QuoteBatch(quotes.values()), self.codec)
+
+    def messages(self, window):
+        """Returns the messages publishing a window"""
+        return [self.encode(window)]
+
     def work(self):
         wait = 5
         while self.running():
@@ -112,9 +233,72 @@ class Publisher(mq.GenericPublisher):
                 self.logger.debug("Will publish {} quote updates".format(
                     len(quotes)))
 
-                self.publish(utils.serialize(quotes.values()))
+                self.publish_many(self.messages(quotes))
             except Queue.Empty:
                 self.logger.debug("Queue is empty after {}s".format(wait))
+                self.flush()
+
+
+class SummaryPublisher(Publisher):
+    """publishes the tickers summaries of each window to exchange"""
+    def merge(self, older, newer):
+        """Coalesces two pending lists of summaries, the newest ones win"""
+        merged = dict((summary.ticker, summary) for summary in older)
+        merged.update((summary.ticker, summary) for summary in newer)
+        return merged.values()
+
+    def encode(self, summaries):
+        """Serializes a list of quote summaries"""
+        return utils.serialize(summaries, self.codec)
+
+
+def shard_bucket(ticker, buckets):
+    """Returns the bucket of a ticker, stable across processes and restarts"""
+    return (zlib.crc32(ticker.encode("utf-8")) & 0xffffffff) % buckets
+
+
+class ShardedPublisher(Publisher):
+    """publishes aggregated data updates to a consistent hash exchange
+    The tickers of a window are split in buckets published as one message
+    each, with the bucket as routing key: the exchange hashes the buckets
+    over the bound queues, so that every ticker goes to a single consumer,
+    in order. There should be many more buckets than consumers for the load
+    to spread evenly.
+    """
+    def __init__(self, logger, exchange, connector, settings=None, codec="json",
+                 handoff_size=16, handoff_policy=mt.BoundedQueue.COALESCE, buckets=64):
+        super(ShardedPublisher, self).__init__(
+            logger, exchange, connector, settings, codec, handoff_size, handoff_policy,
+            "x-consistent-hash")
+        self.buckets = buckets
+
+    def messages(self, window):
+        """Returns one message per bucket of the window"""
+        shards = collections.defaultdict(dict)
+        for ticker, quote in window.items():
+            shards[shard_bucket(ticker, self.buckets)][ticker] = quote
+        return [mq.routed(self.encode(quotes), str(bucket))
+                for bucket, quotes in sorted(shards.items())]
+
+
+class AsyncSubscriber(amq.AsyncSubscriber, Subscriber):
+    """Subscriber running on a shared event loop"""
+    pass
+
+
+class AsyncPublisher(amq.AsyncPublisher, Publisher):
+    """Publisher running on a shared event loop"""
+    pass
+
+
+class AsyncSummaryPublisher(amq.AsyncPublisher, SummaryPublisher):
+    """Summary publisher running on a shared event loop"""
+    pass
+
+
+class AsyncShardedPublisher(amq.AsyncPublisher, ShardedPublisher):
+    """Sharded publisher running on a shared event loop"""
+    pass
 
 def main():
     """Application entry-point"""
@@ -127,23 +311,80 @@ def main():
 
     logger.info("Initializing mktagg")
 
+    threads = []
+    publisher_type, subscriber_type = Publisher, Subscriber
+    summary_publisher_type = SummaryPublisher
+    sharded_publisher_type = ShardedPublisher
+    connector = mq.Connector(settings.mq)
+    if settings.mq.transport == "async":
+        logger.info("Subscriber and publisher will share an event loop")
+        loop = amq.EventLoop(connector)
+        threads.append(loop)
+        publisher_type, subscriber_type = AsyncPublisher, AsyncSubscriber
+        summary_publisher_type = AsyncSummaryPublisher
+        sharded_publisher_type = AsyncShardedPublisher
+        connector = amq.Connector(loop)
+
     logger.info("Initializing market data publisher")
-    publisher = Publisher(
+    publisher = publisher_type(
         logger.getChild("pub"),
         settings.pub_exchange,
-        mq.Connector(settings.mq))
+        connector,
+        settings.publisher,
+        settings.mq.codec,
+        settings.handoff_size,
+        settings.handoff_policy)
+    threads.append(publisher)
+    callback = publisher.notify
+
+    if settings.shard_exchange is not None:
+        logger.info("Initializing sharded market data publisher")
+        sharded_publisher = sharded_publisher_type(
+            logger.getChild("shd"),
+            settings.shard_exchange,
+            connector,
+            settings.publisher,
+            settings.mq.codec,
+            settings.handoff_size,
+            settings.handoff_policy,
+            settings.shard_buckets)
+        threads.append(sharded_publisher)
+
+        def callback(quotes):
+            publisher.notify(quotes)
+            sharded_publisher.notify(quotes)
+
+    summary_callback = None
+    if settings.summary_exchange is not None:
+        logger.info("Initializing quote summaries publisher")
+        summary_publisher = summary_publisher_type(
+            logger.getChild("sum"),
+            settings.summary_exchange,
+            connector,
+            settings.publisher,
+            settings.mq.codec,
+            settings.handoff_size,
+            settings.handoff_policy)
+        summary_callback = summary_publisher.notify
+        threads.append(summary_publisher)
+
+    aggregator = WindowAggregator(
+        logger.getChild("wagg"),
+        settings.aggregation_window,
+        callback,
+        settings.aggregation_slide,
+        summary_callback)
 
     logger.info("Initializing market data subscriber")
-    subscriber = Subscriber(
+    subscriber = subscriber_type(
         logger.getChild("sub"),
         settings.sub_exchange,
-        WindowAggregator(
-            logger.getChild("wagg"),
-            settings.aggregation_window,
-            publisher.notify),
-        mq.Connector(settings.mq))
+        aggregator,
+        connector)
 
-    mt.ThreadManager(subscriber, publisher).start()
+    threads.extend([subscriber, WindowTimer(logger.getChild("tmr"), aggregator)])
+    threads.extend(metrics.exporters(logger.getChild("mtr"), settings.metrics))
+    mt.ThreadManager(*threads, logger=logger.getChild("sup")).start()
 
 if __name__ == "__main__":
     main()
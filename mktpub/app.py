@@ -4,9 +4,11 @@ import sys
 import yaml
 import pika
 
+import quotesource
 import quotesrequester
+import simulation
 from saifu.core import models, runtime, utils
-from saifu.core.system import mq, mt
+from saifu.core.system import mq, amq, mt, metrics
 
 
 class Settings(object):
@@ -17,7 +19,7 @@ class Settings(object):
         app = conf["app"]
         self.pull_delay = app["pull_delay"]
         self.exchange = app["exchange"]
-        self.resource = app["res"]
+        self.resource = app.get("res")
 
         log = conf["logging"]
         self.logging = models.LoggingSettings()
@@ -26,27 +28,72 @@ class Settings(object):
         self.mq = models.MQSettings()
         self.mq.from_json(app["mq"])
 
+        self.metrics = models.MetricsSettings()
+        self.metrics.from_json(app.get("metrics", {}))
+
+        self.publisher = models.PublisherSettings()
+        self.publisher.from_json(app.get("publisher", {}))
+
+        self.requester = models.RequesterSettings()
+        self.requester.from_json(app.get("requester", {}))
+
+        self.source = models.QuoteSourceSettings()
+        self.source.from_json(app.get("source", {}))
+
 
 class Publisher(mq.GenericPublisher):
-    """Publishes quote updates"""
-    def __init__(self, logger, settings, connector, requester):
-        super(Publisher, self).__init__(settings.exchange, connector)
+    """Publishes quote updates
+    The quotes of each pull are published as one message.
+    """
+    def __init__(self, logger, settings, connector, source):
+        super(Publisher, self).__init__(
+            settings.exchange, connector, settings=settings.publisher)
         self.logger = logger
-        self.requester = requester
+        self.source = source
         self.settings = settings
 
     def work(self):
         while self.running():
             try:
-                for quote in self.requester.get():
+                quotes = list(self.source.get())
+                for quote in quotes:
                     self.logger.debug("Publishing quote to exchange {}@{}".format(
                         quote.ticker,
                         quote.price))
-                    self.publish(utils.serialize(quote))
-                time.sleep(self.settings.pull_delay)
-            except quotesrequester.RequesterException as error:
+                if quotes:
+                    self.publish(utils.serialize(quotes, self.settings.mq.codec))
+                self.logger.debug("Publisher stats: {}".format(self.stats()))
+                self.sleep(self.settings.pull_delay)
+            except quotesource.QuoteSourceException as error:
                 self.logger.warn("Failed to get quotes ({})".format(error))
-                time.sleep(self.settings.pull_delay)
+                self.sleep(self.settings.pull_delay)
+        # Closed from the publishing thread, once no get is in progress
+        self.source.close()
+
+
+class AsyncPublisher(amq.AsyncPublisher, Publisher):
+    """Publisher running on a shared event loop"""
+    pass
+
+
+def create_source(logger, settings, pairs):
+    """Creates the quote source described by the settings"""
+    source = settings.source
+    if source.kind == "http":
+        return quotesrequester.Requester(
+            logger, settings.resource, pairs, settings.requester)
+    if source.kind == "replay":
+        return simulation.ReplaySource(logger, source.path, source.speed, source.loop)
+    if source.kind == "random":
+        tickers = source.tickers or ["{}{}".format(*pair) for pair in pairs]
+        return simulation.RandomWalkSource(
+            logger,
+            tickers,
+            source.rate,
+            source.start_price,
+            source.volatility,
+            source.seed)
+    raise ValueError("Unknown quote source type {}".format(source.kind))
 
 
 def main():
@@ -61,16 +108,23 @@ def main():
 
     logger.info("Initializing mktpub")
 
-    publisher = Publisher(
+    threads = []
+    publisher_type = Publisher
+    connector = mq.Connector(settings.mq)
+    if settings.mq.transport == "async":
+        loop = amq.EventLoop(connector)
+        threads.append(loop)
+        publisher_type = AsyncPublisher
+        connector = amq.Connector(loop)
+
+    threads.append(publisher_type(
         logger.getChild("pub"),
         settings,
-        mq.Connector(settings.mq),
-        quotesrequester.Requester(
-            logger.getChild("req"),
-            settings.resource,
-            pairs))
+        connector,
+        create_source(logger.getChild("src"), settings, pairs)))
 
-    mt.ThreadManager(publisher).start()
+    threads.extend(metrics.exporters(logger.getChild("mtr"), settings.metrics))
+    mt.ThreadManager(*threads, logger=logger.getChild("sup")).start()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,18 @@
+"""Quote sources abstraction"""
+
+
+class QuoteSourceException(Exception):
+    """Thrown when a quote source fails to provide quotes"""
+    def __init__(self, message):
+        super(QuoteSourceException, self).__init__(message)
+
+
+class QuoteSource(object):
+    """Source of quotes polled by the publisher on every cycle"""
+    def get(self):
+        """Returns the quotes available since the previous call"""
+        raise RuntimeError("get is not implemented")
+
+    def close(self):
+        """Releases the source resources"""
+        pass
@@ -1,10 +1,15 @@
 """Quotes request abstraction"""
 import time
+import threading
+from multiprocessing.pool import ThreadPool
 import requests
+from requests.adapters import HTTPAdapter
 
-from saifu.core.models import Quote
+from saifu.core.models import Quote, RequesterSettings
 from saifu.core import utils
 
+import quotesource
+
 
 def _extract_pairs(timestamp, data):
     """Extract the currency pairs from a response"""
@@ -41,45 +46,135 @@ def _extract_sources_targets(pairs):
         targets.add(target)
     return sources, targets
 
-class RequesterException(Exception):
+def _shard_pairs(pairs, shard_size):
+    """Splits the pairs in shards of at most shard_size pairs
+    Pairs are sorted by source then target currency, so the pairs of a
+    source currency are contiguous and span as few shards as possible.
+    """
+    ordered = sorted(pairs)
+    return [ordered[i:i + shard_size] for i in range(0, len(ordered), shard_size)]
+
+class RequesterException(quotesource.QuoteSourceException):
     """Thrown when an error occurs in quotes requester"""
     def __init__(self, message):
         super(RequesterException, self).__init__(message)
 
 
-class Requester(object):
-    """Requests quotes for a given list of source and target currencies"""
+class RateLimiter(object):
+    """Thread safe token bucket allowing rate requests per second"""
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or rate)
+        self._tokens = self.capacity
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a request is allowed"""
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class Requester(quotesource.QuoteSource):
+    """Requests quotes for a given list of source and target currencies
+    Pairs are split in shards fetched concurrently over a keep-alive HTTP
+    session. A shard that still fails after its retries is skipped for the
+    cycle, the cycle only fails when no shard could be fetched.
+    """
 
     _HTTP_STATUS_CODE_OK = 200
 
-    def __init__(self, logger, resource, pairs):
+    def __init__(self, logger, resource, pairs, settings=None):
         self.resource = resource
         self.pairs = pairs
         self.logger = logger
+        self.settings = settings or RequesterSettings()
+        self.shards = _shard_pairs(pairs, self.settings.shard_size)
+        self.limiter = None
+        if self.settings.rate_limit:
+            self.limiter = RateLimiter(self.settings.rate_limit)
+
+        concurrency = max(1, min(self.settings.concurrency, len(self.shards)))
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.pool = ThreadPool(concurrency)
+
+    def _request(self, resource):
+        """Sends one request, returns the decoded response"""
+        if self.limiter is not None:
+            self.limiter.acquire()
+        response = self.session.post(resource, timeout=self.settings.timeout)
+        if response.status_code != Requester._HTTP_STATUS_CODE_OK:
+            raise RequesterException(
+                "Service responded with unexpected http code ({})".format(
+                    response.status_code))
 
-    def get(self):
-        """Gets the quotes for the sources and targets currency pairs"""
-        sources, targets = _extract_sources_targets(self.pairs)
-        resource = _build_uri(self.resource, sources, targets)
-        self.logger.debug("Will fetch quotes from {}".format(resource))
-        try:
-            response = requests.post(resource)
-            if response.status_code != Requester._HTTP_STATUS_CODE_OK:
-                raise RequesterException(
-                    "Service responded with unexpected http code ({})".format(
-                        response.status_code))
-
-            data = response.json()
-
-            if _is_error_response(response):
-                raise RequesterException(
-                    "Service responded with an error ({})".format(
-                        _get_message_from_response(data)))
+        data = response.json()
 
-            for pair in _extract_pairs(utils.utc_time(), data):
-                yield pair
+        if _is_error_response(data):
+            raise RequesterException(
+                "Service responded with an error ({})".format(
+                    _get_message_from_response(data)))
+        return data
+
+    def _fetch_shard(self, pairs):
+        """Fetches the quotes of a shard, retrying with exponential backoff
+        Returns a (quotes, error) tuple, error being None unless all the
+        attempts failed (there are no quotes then).
+        """
+        sources, targets = _extract_sources_targets(pairs)
+        resource = _build_uri(self.resource, sources, targets)
+        wanted = set("{}{}".format(source, target) for source, target in pairs)
+        attempt = 0
+        while True:
+            self.logger.debug("Will fetch quotes from {}".format(resource))
+            try:
+                data = self._request(resource)
+                return [quote for quote in _extract_pairs(utils.utc_time(), data)
+                        if quote.ticker in wanted], None
+            except (RequesterException, requests.exceptions.RequestException, ValueError) as error:
+                if attempt >= self.settings.retries:
+                    return [], RequesterException(
+                        "Unable to get quotes from service ({})".format(str(error)))
+                delay = self.settings.backoff * 2 ** attempt
+                self.logger.debug("Request to {} failed ({}), retrying in {}s".format(
+                    resource, error, delay))
+                time.sleep(delay)
+                attempt += 1
 
-        except requests.exceptions.RequestException as error:
+    def get(self):
+        """Gets the quotes for the sources and targets currency pairs"""
+        fetched = 0
+        errors = []
+        for quotes, error in self.pool.imap_unordered(self._fetch_shard, self.shards):
+            if error is not None:
+                self.logger.warn("Failed to fetch a quotes shard ({})".format(error))
+                errors.append(error)
+                continue
+            fetched += 1
+            for quote in quotes:
+                yield quote
+
+        if errors and not fetched:
             raise RequesterException(
-                "Unable to send request to service ({})".format(
-                    str(error)))
+                "All {} shard(s) failed ({})".format(len(errors), errors[-1]))
+
+    def close(self):
+        """Releases the HTTP connections and the fetching threads, once the
+        fetches in progress are over (not to be called during a get)
+        """
+        self.pool.close()
+        self.pool.join()
+        self.session.close()
@@ -0,0 +1,122 @@
+"""Offline quote sources used to drive the pipeline without the provider"""
+import csv
+import math
+import time
+import random
+import datetime
+
+from saifu.core.models import Quote
+from saifu.core import utils
+
+import quotesource
+
+
+class ReplaySource(quotesource.QuoteSource):
+    """Replays recorded ticks at speed times their original pace
+    The file is a CSV of ticker,price,timestamp rows (timestamp in seconds
+    since epoch) ordered by timestamp, e.g. exported with:
+
+        \\copy (SELECT ticker, price, extract(epoch FROM quote_time)
+               FROM saifu_ccy_historical_prices ORDER BY quote_time)
+              TO 'ticks.csv' CSV
+
+    Each call returns the ticks recorded since the previous call (scaled by
+    speed), time stamped as if they were received now. When looping, the
+    replay starts over at most once per call.
+    """
+    def __init__(self, logger, path, speed=1.0, loop=True):
+        self.logger = logger
+        self.path = path
+        self.speed = float(speed)
+        self.loop = loop
+        self._file = None
+        self._reader = None
+        self._pending = None
+        self._start_wall = None
+        self._start_tick = None
+
+    def _open(self):
+        """(Re)starts the replay from the beginning of the file"""
+        self.close()
+        self._file = open(self.path)
+        self._reader = csv.reader(self._file)
+        self._pending = self._next_row()
+        self._start_wall = time.time()
+        self._start_tick = self._pending[2] if self._pending else None
+
+    def _next_row(self):
+        for row in self._reader:
+            if row:
+                return row[0], float(row[1]), float(row[2])
+        return None
+
+    def get(self):
+        if self._reader is None:
+            self._open()
+
+        quotes = []
+        now = utils.utc_time()
+        reopened = False
+        while True:
+            if self._pending is None:
+                if not self.loop or reopened:
+                    break
+                reopened = True
+                self.logger.info("End of replay file {}, starting over".format(self.path))
+                self._open()
+                if self._pending is None:
+                    break
+            replay_time = self._start_tick + (time.time() - self._start_wall) * self.speed
+            ticker, price, tick_time = self._pending
+            if tick_time > replay_time:
+                break
+            lag = datetime.timedelta(seconds=(replay_time - tick_time) / self.speed)
+            quotes.append(Quote(ticker, price, now - lag))
+            self._pending = self._next_row()
+        return quotes
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        self._file = None
+        self._reader = None
+
+
+class RandomWalkSource(quotesource.QuoteSource):
+    """Generates quotes following a geometric random walk
+    About rate quotes per second are generated, spread round robin over the
+    tickers.
+    """
+    def __init__(self, logger, tickers, rate=100, start_price=100.0, volatility=0.001, seed=None):
+        self.logger = logger
+        self.tickers = list(tickers)
+        self.rate = float(rate)
+        self.volatility = volatility
+        self.prices = dict((ticker, float(start_price)) for ticker in self.tickers)
+        self.random = random.Random(seed)
+        self._next = 0
+        self._owed = 0.0
+        self._last = None
+
+    def get(self):
+        clock = time.time()
+        if self._last is None:
+            self._last = clock
+        self._owed += (clock - self._last) * self.rate
+        self._last = clock
+
+        count = int(self._owed)
+        self._owed -= count
+        if not self.tickers:
+            return []
+
+        quotes = []
+        now = utils.utc_time()
+        for _ in range(count):
+            ticker = self.tickers[self._next]
+            self._next = (self._next + 1) % len(self.tickers)
+            price = self.prices[ticker] * math.exp(
+                self.volatility * self.random.gauss(0, 1))
+            self.prices[ticker] = price
+            quotes.append(Quote(ticker, price, now))
+        return quotes
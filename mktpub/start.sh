@@ -1,7 +1,6 @@
 #!/bin/bash
 CFG_FILE_PATH=./cfg.yaml
 START_WAIT_TIME=20
-WAIT_INTERVAL=2
 
 
 if [ "$MKTPUB_ENV" = "dev" ]
@@ -12,11 +11,6 @@ fi
 
 export CFG_FILE_PATH
 
-if [ -z "$MKTPUB_PROCS" ]
-then
-    MKTPUB_PROCS=1
-fi
-
 SOURCES=$(head -n1 tickers)
 TARGETS=$(tail -n1 tickers)
 
@@ -28,28 +22,8 @@ do
     done
 done
 
-PAIRS=( $PAIRS )
-
-PAIRS_COUNT=${#PAIRS[@]}
-POOL_SIZE=$(($PAIRS_COUNT / $MKTPUB_PROCS))
-
 echo "[ WARN ] Will wait ${START_WAIT_TIME}s before starting"
 sleep $START_WAIT_TIME
 
-echo "[ INFO ] Starting $MKTPUB_PROCS mktpub instances (pool size: $POOL_SIZE)"
-
-POOLS=$(echo "${PAIRS[@]}" | xargs -n$POOL_SIZE)
-while IFS= read -r POOL
-do
-    echo "[ INFO ] Starting pool $POOL"
-    python ./app.py "$CFG_FILE_PATH" $POOL &
-    PIDS="$PIDS $!"
-    sleep $WAIT_INTERVAL
-done <<< "$POOLS"
-
-echo "[ INFO ] Waiting for termination of all started instances"
-
-for PID in $PIDS
-do
-    wait $PID
-done
+echo "[ INFO ] Starting mktpub for pairs $PAIRS"
+exec python ./app.py "$CFG_FILE_PATH" $PAIRS
@@ -7,8 +7,8 @@ import pika
 import yaml
 import terminaltables
 
-from saifu.core import models, runtime, dbac, utils
-from saifu.core.system import db, mq, mt
+from saifu.core import models, runtime, dbac, utils, pricing, quotecache
+from saifu.core.system import db, mq, amq, mt, metrics
 
 
 class Settings(object):
@@ -25,34 +25,45 @@ class Settings(object):
         self.mq = models.MQSettings()
         self.mq.from_json(app["mq"])
 
+        self.metrics = models.MetricsSettings()
+        self.metrics.from_json(app.get("metrics", {}))
+
         self.database = models.DatabaseSettings()
         self.database.from_json(app["database"])
 
+        self.worker = models.WorkerSettings()
+        self.worker.from_json(app.get("worker", {}))
+
+        cache = app.get("quote_cache", {})
+        self.cache_exchange = cache.get("exchange")
+        self.cache_ring_size = cache.get("ring_size", 64)
+
+        self.portfolio_cache = app.get("portfolio_cache", False)
+
 class Worker(mq.GenericWorker):
-    def __init__(self, logger, pricingrepo, queue, connector):
-        super(Worker, self).__init__(queue, connector)
+    def __init__(self, logger, pricer, queue, connector, settings=None):
+        super(Worker, self).__init__(queue, connector, settings=settings)
         self.logger = logger
-        self.pricingrepo = pricingrepo
+        self.pricer = pricer
 
     def handle(self, job):
-        job = utils.unserialize(job, models.PricingJob)
-        self.logger.debug("Received pricing job {} for portfolio {}".format(
-            job.identifier, job.portfolio_id))
+        jobs = utils.unserialize(job, models.PricingJob)
+        if not isinstance(jobs, list):
+            jobs = [jobs]
+        self.logger.debug("Received {} pricing job(s)".format(len(jobs)))
+
+        for job, balance in self.pricer.price(jobs):
+            self.logger.debug("Finished calculating balance for job {}: {} {}".format(
+                job.identifier, balance, job.target_ccy))
 
-        results = self.pricingrepo.get_portfolio_positions_prices(
-            job.portfolio_id,
-            job.snapshot_time,
-            job.target_ccy)
+    def failed(self, job, exc_info):
+        self.logger.error("Failed to handle pricing job {}".format(job),
+                          exc_info=exc_info)
 
-        balance = sum(pos[3] for pos in results)
-        self.logger.debug("Finished calculating balance for job {}: {} {}".format(
-            job.identifier, balance, job.target_ccy))
 
-        self.pricingrepo.persist_portfolio_pricing(
-            job.portfolio_id,
-            job.snapshot_time,
-            balance,
-            job.target_ccy)
+class AsyncWorker(amq.AsyncWorker, Worker):
+    """Worker running on a shared event loop"""
+    pass
 
 def main():
     """Application entry-point"""
@@ -65,13 +76,47 @@ def main():
 
     logger.debug("Initializing portprice")
 
-    worker = Worker(
+    threads = []
+    worker_type = Worker
+    connector = mq.Connector(settings.mq)
+    if settings.mq.transport == "async":
+        loop = amq.EventLoop(connector)
+        threads.append(loop)
+        worker_type = AsyncWorker
+        connector = amq.Connector(loop)
+
+    cache = None
+    if settings.cache_exchange is not None:
+        cache = quotecache.QuoteCache(settings.cache_ring_size)
+        feeder_type = quotecache.Feeder
+        if settings.mq.transport == "async":
+            feeder_type = quotecache.AsyncFeeder
+        threads.append(feeder_type(
+            logger.getChild("qch"),
+            settings.cache_exchange,
+            connector,
+            cache))
+
+    pricingrepo = dbac.PricingRepository(db.Pool(settings.database))
+    portfolios = None
+    if settings.portfolio_cache:
+        portfolios = dbac.PortfolioCache(
+            logger.getChild("pfc"), settings.database, pricingrepo)
+        threads.append(portfolios)
+
+    threads.append(worker_type(
         logger.getChild("prc"),
-        dbac.PricingRepository(db.Connector(settings.database)),
+        pricing.BatchPricer(
+            logger.getChild("bpr"),
+            pricingrepo,
+            cache,
+            portfolios=portfolios),
         settings.work_queue,
-        mq.Connector(settings.mq))
+        connector,
+        settings.worker))
 
-    mt.ThreadManager(worker).start()
+    threads.extend(metrics.exporters(logger.getChild("mtr"), settings.metrics))
+    mt.ThreadManager(*threads, logger=logger.getChild("sup")).start()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,107 @@
+"""Reprices portfolios over a time range
+
+    python backfill.py cfg.yaml --from 2018-01-01 --to 2019-01-01 \\
+        --interval 3600 [--portfolios 1 2 3] [--ccy USD] [--procs 4]
+
+The balances of the portfolios are recomputed every interval seconds with
+their current positions and replace the ones stored in the range. Portfolios
+are priced in their pricing settings currency unless --ccy is given, and
+are split in chunks priced in parallel by --procs processes.
+"""
+import sys
+import datetime
+import argparse
+import multiprocessing
+import yaml
+
+from saifu.core import runtime, dbac, pricing
+from saifu.core.system import db
+
+import app
+
+_TIME_FORMATS = ("%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%d")
+
+_pricer = None
+
+
+def _parse_time(value):
+    """Parses a (UTC) time argument"""
+    for time_format in _TIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, time_format)
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError("Invalid time {}".format(value))
+
+
+def _parse_args(args):
+    parser = argparse.ArgumentParser(description="Reprices portfolios over a time range")
+    parser.add_argument("config", help="portprice configuration file")
+    parser.add_argument("--from", dest="from_time", type=_parse_time, required=True)
+    parser.add_argument("--to", dest="to_time", type=_parse_time, required=True)
+    parser.add_argument("--interval", type=int, default=3600,
+                        help="seconds between two balances")
+    parser.add_argument("--portfolios", type=int, nargs="+",
+                        help="portfolios to reprice (all the priced ones by default)")
+    parser.add_argument("--ccy", help="target currency (overrides the pricing settings)")
+    parser.add_argument("--procs", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--chunk-size", type=int, default=100,
+                        help="portfolios priced by one sweep of the ticks")
+    return parser.parse_args(args)
+
+
+def _init_process(settings):
+    """Creates the pricer of a backfill process"""
+    global _pricer
+    # A sweep reads the ticks and writes the balances on two connections
+    settings.database.pool.max_size = max(2, settings.database.pool.max_size)
+    _pricer = pricing.HistoricalPricer(
+        runtime.create_logger(settings.logging).getChild("bkf"),
+        dbac.PricingRepository(db.Pool(settings.database)))
+
+
+def _backfill(task):
+    portfolio_ids, target_ccy, from_time, to_time, interval = task
+    return _pricer.backfill(portfolio_ids, target_ccy, from_time, to_time, interval)
+
+
+def _tasks(targets, options):
+    """Splits the (portfolio_id, target_ccy) targets in chunks by currency"""
+    by_ccy = {}
+    for portfolio_id, target_ccy in targets:
+        by_ccy.setdefault(target_ccy, []).append(portfolio_id)
+    interval = datetime.timedelta(seconds=options.interval)
+    for target_ccy, portfolio_ids in sorted(by_ccy.items()):
+        for start in range(0, len(portfolio_ids), options.chunk_size):
+            yield (portfolio_ids[start:start + options.chunk_size], target_ccy,
+                   options.from_time, options.to_time, interval)
+
+
+def main():
+    """Application entry-point"""
+    options = _parse_args(sys.argv[1:])
+    with open(options.config) as settings_file:
+        settings = app.Settings(yaml.load(settings_file))
+    logger = runtime.create_logger(settings.logging)
+
+    if options.portfolios is not None and options.ccy is not None:
+        targets = [(portfolio_id, options.ccy) for portfolio_id in options.portfolios]
+    else:
+        schedule = dbac.PricingRepository(db.Pool(settings.database)).find_pricing_schedule()
+        targets = [(row[0], options.ccy or row[1]) for row in schedule
+                   if options.portfolios is None or row[0] in options.portfolios]
+    tasks = list(_tasks(targets, options))
+    logger.info("Backfilling {} portfolio(s) from {} to {} in {} chunk(s)".format(
+        len(targets), options.from_time, options.to_time, len(tasks)))
+
+    workers = multiprocessing.Pool(
+        max(1, min(options.procs, len(tasks))), _init_process, (settings,))
+    try:
+        written = sum(workers.imap_unordered(_backfill, tasks))
+    finally:
+        workers.close()
+        workers.join()
+    logger.info("Backfilled {} balance(s)".format(written))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+"""Streaming portfolio revaluation (Keeps the latest balances up to date
+from the aggregated quotes, the balances history is left to portprice)
+"""
+import sys
+import threading
+import psycopg2
+import yaml
+
+from saifu.core import models, runtime, dbac, utils, pricing
+from saifu.core.system import mq, amq, db, mt, metrics
+
+_metrics = metrics.scope("revaluator")
+
+
+class Settings(object):
+    """Configuration for the current application"""
+    def __init__(self, store):
+        conf = store["conf"]
+
+        app = conf["app"]
+        self.exchange = app["exchange"]
+        self.flush_interval = app.get("flush_interval", 5)
+        self.reload_interval = app.get("reload_interval", 300)
+
+        self.logging = models.LoggingSettings()
+        self.logging.from_json(conf["logging"])
+
+        self.database = models.DatabaseSettings()
+        self.database.from_json(app["database"])
+
+        self.mq = models.MQSettings()
+        self.mq.from_json(app["mq"])
+
+        self.metrics = models.MetricsSettings()
+        self.metrics.from_json(app.get("metrics", {}))
+
+
+class Revaluator(object):
+    """Thread safe incremental balances of the priced portfolios
+    Balances are kept by (portfolio_id, target_ccy), a portfolio priced in
+    several currencies has one balance per currency. Assets are valued with
+    the price model of a pricing.PricingKernel (direct pair, else the cross
+    rate through the pivot currency, and 1 in their own currency), so the
+    balances match the ones written by portprice.
+    An inverted index maps each ticker to the (asset, currency) prices it
+    is a leg of, and each of these to the balances holding the asset, with
+    the position size. When a ticker moves, only its legs are repriced and
+    the balances of their holders updated, by size x the price change, and
+    marked dirty until drained.
+    Balances are recomputed from scratch on every load, which also bounds the
+    rounding drift of the incremental updates.
+    """
+    def __init__(self):
+        self._kernel = None
+        self._legs = {}
+        self._holders = {}
+        self._leg_prices = {}
+        self._prices = {}
+        self._price_times = {}
+        self._balances = {}
+        self._as_of = {}
+        self._dirty = set()
+        self._stale = True
+        self._lock = threading.Lock()
+        _metrics.gauge("balances", lambda: len(self._balances))
+        _metrics.gauge("tickers", lambda: len(self._legs))
+        self._updates = _metrics.counter("updates")
+
+    def stale(self):
+        """Determines if the balances must be reloaded"""
+        return self._stale
+
+    def invalidate(self):
+        """Flags the balances for reload (quotes may have been missed)"""
+        self._stale = True
+
+    def load(self, kernel, targets, prices, now):
+        """Rebuilds the index and the balances of the (portfolio_id,
+        target_ccy) targets from the kernel of their positions and the latest
+        prices
+        """
+        rows = dict((portfolio_id, row)
+                    for row, portfolio_id in enumerate(kernel.portfolio_ids))
+        balances = kernel.balances(prices, set(ccy for _, ccy in targets))
+        balances = dict((key, balances[key]) for key in targets)
+        legs = {}
+        holders = {}
+        leg_prices = {}
+        for portfolio_id, target_ccy in targets:
+            sizes = kernel.sizes[rows[portfolio_id]]
+            for column, asset in enumerate(kernel.assets):
+                size = float(sizes[column])
+                if not size:
+                    continue
+                leg = (asset, target_ccy)
+                if leg not in leg_prices:
+                    leg_prices[leg] = kernel.price(prices, asset, target_ccy)
+                    for ticker in kernel.leg_tickers(asset, target_ccy):
+                        legs.setdefault(ticker, set()).add(leg)
+                holders.setdefault(leg, []).append(((portfolio_id, target_ccy), size))
+        with self._lock:
+            self._kernel = kernel
+            self._legs = legs
+            self._holders = holders
+            self._leg_prices = leg_prices
+            self._prices = dict(prices)
+            self._price_times = {}
+            self._balances = balances
+            now_us = utils.to_microseconds(now)
+            self._as_of = dict((key, now_us) for key in balances)
+            self._dirty = set(balances)
+            self._stale = False
+
+    def update(self, quotes):
+        """Applies the price changes of a batch of quotes (times are kept in
+        microseconds since epoch, as in the batch columns)
+        """
+        tickers = quotes.tickers
+        rows = zip(quotes.ids, quotes.prices, quotes.timestamps)
+        with self._lock:
+            moved = {}
+            for ticker_id, price, timestamp in rows:
+                ticker = tickers[ticker_id]
+                legs = self._legs.get(ticker)
+                if legs is None:
+                    continue
+                last_time = self._price_times.get(ticker)
+                if last_time is not None and timestamp < last_time:
+                    continue
+                self._price_times[ticker] = timestamp
+                self._prices[ticker] = price
+                for leg in legs:
+                    moved[leg] = max(timestamp, moved.get(leg, timestamp))
+
+            for leg, timestamp in moved.items():
+                price = self._kernel.price(self._prices, *leg)
+                delta = price - self._leg_prices[leg]
+                if not delta:
+                    continue
+                self._leg_prices[leg] = price
+                holders = self._holders[leg]
+                for key, size in holders:
+                    # Balances are never negative, the rounding drift of the
+                    # updates could make an emptied one slightly so
+                    self._balances[key] = max(0.0, self._balances[key] + size * delta)
+                    self._as_of[key] = timestamp
+                    self._dirty.add(key)
+                self._updates.inc(len(holders))
+
+    def drain(self):
+        """Returns the (portfolio_id, snapshot_time, balance, target_ccy)
+        pricings of the balances changed since the last drain
+        """
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            return [(key[0], utils.utc_from_microseconds(self._as_of[key]),
+                     self._balances[key], key[1])
+                    for key in dirty]
+
+
+class Writer(threading.Thread):
+    """Periodically records the changed balances as the latest ones (one row
+    per portfolio and currency, the history is only written by portprice),
+    and reloads the positions every reload_interval seconds or when the
+    balances are stale
+    """
+    def __init__(self, logger, settings, revaluator, pricingrepo):
+        super(Writer, self).__init__()
+        self.logger = logger
+        self.settings = settings
+        self.revaluator = revaluator
+        self.pricingrepo = pricingrepo
+        self._last_reload = None
+        self._stopped = threading.Event()
+
+    def _reload(self):
+        """Reloads the priced portfolios, their positions and latest prices"""
+        now = utils.utc_time()
+        targets = [(row[0], row[1]) for row in self.pricingrepo.find_pricing_schedule()]
+        kernel = pricing.PricingKernel(self.pricingrepo.get_portfolios_positions(
+            set(portfolio_id for portfolio_id, _ in targets)))
+        prices = self.pricingrepo.get_latest_prices(
+            kernel.tickers(set(ccy for _, ccy in targets)), now)
+        self.revaluator.load(kernel, targets, prices, now)
+        self._last_reload = utils.to_timestamp(now)
+        self.logger.debug("Loaded {} portfolio balance(s)".format(len(targets)))
+
+    def _reload_due(self):
+        if self.revaluator.stale() or self._last_reload is None:
+            return True
+        now = utils.to_timestamp(utils.utc_time())
+        return now - self._last_reload >= self.settings.reload_interval
+
+    def write(self):
+        """Records the balances changed since the last write"""
+        pricings = self.revaluator.drain()
+        if not pricings:
+            return
+        self.pricingrepo.persist_latest_portfolio_pricings(pricings)
+        _metrics.counter("written").inc(len(pricings))
+        self.logger.debug("Persisted {} balance(s)".format(len(pricings)))
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                if self._reload_due():
+                    self._reload()
+                self.write()
+            except psycopg2.Error as err:
+                self.logger.warn("Failed to revalue portfolios: {}".format(str(err)))
+                # Rewrites every balance once the database is back
+                self.revaluator.invalidate()
+            self._stopped.wait(self.settings.flush_interval)
+
+    def stop(self):
+        self._stopped.set()
+
+
+class Subscriber(mq.GenericSubscriber):
+    """Subscribes to quote updates and revalues the holding portfolios
+    The balances are reloaded on every (re)connection as quotes published
+    while disconnected are lost.
+    """
+    def __init__(self, logger, exchange, connector, revaluator):
+        super(Subscriber, self).__init__(exchange, connector)
+        self.logger = logger
+        self.revaluator = revaluator
+
+    def _initialize(self):
+        self.revaluator.invalidate()
+        super(Subscriber, self)._initialize()
+
+    def received(self, message):
+        self.revaluator.update(
+            utils.unserialize(message, models.QuoteBatch))
+
+
+class AsyncSubscriber(amq.AsyncSubscriber, Subscriber):
+    """Subscriber running on a shared event loop"""
+    def _initialize(self):
+        self.revaluator.invalidate()
+        amq.AsyncSubscriber._initialize(self)
+
+
+def main():
+    """Application entry-point"""
+    path = sys.argv[1]
+    with open(path) as settings_file:
+        settings_data = yaml.load(settings_file)
+
+    settings = Settings(settings_data)
+    logger = runtime.create_logger(settings.logging)
+
+    revaluator = Revaluator()
+
+    threads = []
+    subscriber_type = Subscriber
+    connector = mq.Connector(settings.mq)
+    if settings.mq.transport == "async":
+        loop = amq.EventLoop(connector)
+        threads.append(loop)
+        subscriber_type = AsyncSubscriber
+        connector = amq.Connector(loop)
+
+    threads.append(subscriber_type(
+        logger.getChild("sub"),
+        settings.exchange,
+        connector,
+        revaluator))
+
+    threads.append(Writer(
+        logger.getChild("wrt"),
+        settings,
+        revaluator,
+        dbac.PricingRepository(db.Pool(settings.database))))
+
+    threads.extend(metrics.exporters(logger.getChild("mtr"), settings.metrics))
+    mt.ThreadManager(*threads, logger=logger.getChild("sup")).start()
+
+if __name__ == '__main__':
+    main()
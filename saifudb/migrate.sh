@@ -0,0 +1,28 @@
+#!/bin/sh
+# Applies the pending schema migrations, in version order.
+# New databases are migrated on init (docker-entrypoint-initdb.d). Existing
+# databases are migrated with `make migrate-db`, which runs this script in
+# the running saifudb container (docker-compose exec saifudb saifudb-migrate).
+set -e
+
+MIGRATIONS_DIR=${MIGRATIONS_DIR:-/usr/local/share/saifudb/migrations}
+PSQL="psql -v ON_ERROR_STOP=1 --username ${POSTGRES_USER:-saifudb} --dbname ${POSTGRES_DB:-saifudb}"
+
+$PSQL -c "CREATE TABLE IF NOT EXISTS saifu_schema_version (
+              version int PRIMARY KEY,
+              name VARCHAR(255) NOT NULL,
+              applied_at TIMESTAMP NOT NULL DEFAULT NOW())"
+
+for MIGRATION in $(ls "$MIGRATIONS_DIR"/V*__*.sql | sort)
+do
+    NAME=$(basename "$MIGRATION" .sql)
+    VERSION=$(echo "$NAME" | sed -E 's/^V0*([0-9]+)__.*/\1/')
+    APPLIED=$($PSQL -tAc "SELECT 1 FROM saifu_schema_version WHERE version = $VERSION")
+    if [ "$APPLIED" != "1" ]
+    then
+        echo "[ INFO ] Applying migration $NAME"
+        $PSQL --single-transaction \
+              -f "$MIGRATION" \
+              -c "INSERT INTO saifu_schema_version (version, name) VALUES ($VERSION, '$NAME')"
+    fi
+done
@@ -0,0 +1,132 @@
+-- Time partitioned, indexed market data history with downsampling support.
+
+ALTER TABLE saifu_ccy_historical_prices RENAME TO saifu_ccy_historical_prices_old;
+
+CREATE TABLE saifu_ccy_historical_prices (
+    ticker VARCHAR(30) NOT NULL,
+    price DOUBLE PRECISION NOT NULL CHECK(price >= 0),
+    quote_time TIMESTAMP NOT NULL
+) PARTITION BY RANGE (quote_time);
+
+CREATE TABLE saifu_ccy_historical_prices_default
+    PARTITION OF saifu_ccy_historical_prices DEFAULT;
+
+CREATE INDEX saifu_ccy_historical_prices_ticker_time
+    ON saifu_ccy_historical_prices (ticker, quote_time DESC);
+
+-- Creates the monthly partitions covering [from_time, to_time). Ticks written
+-- while their partition was missing land in the default partition, and a
+-- partition cannot be created over rows of the default one: missing
+-- partitions are created detached, filled with the matching rows moved out
+-- of the default partition, then attached.
+CREATE FUNCTION saifu_create_ccy_prices_partitions(from_time TIMESTAMP, to_time TIMESTAMP)
+RETURNS void AS $$
+DECLARE
+    month_start TIMESTAMP := date_trunc('month', from_time);
+    partition_name TEXT;
+BEGIN
+    WHILE month_start < to_time LOOP
+        partition_name := 'saifu_ccy_historical_prices_' || to_char(month_start, 'YYYYMM');
+        IF to_regclass(partition_name) IS NULL THEN
+            EXECUTE format(
+                'CREATE TABLE %I (LIKE saifu_ccy_historical_prices
+                     INCLUDING DEFAULTS INCLUDING CONSTRAINTS)',
+                partition_name);
+            EXECUTE format(
+                'WITH moved AS (
+                     DELETE FROM saifu_ccy_historical_prices_default
+                           WHERE quote_time >= %L
+                             AND quote_time < %L
+                       RETURNING ticker, price, quote_time)
+                 INSERT INTO %I (ticker, price, quote_time)
+                      SELECT ticker, price, quote_time FROM moved',
+                month_start,
+                month_start + interval '1 month',
+                partition_name);
+            EXECUTE format(
+                'ALTER TABLE saifu_ccy_historical_prices ATTACH PARTITION %I
+                     FOR VALUES FROM (%L) TO (%L)',
+                partition_name,
+                month_start,
+                month_start + interval '1 month');
+        END IF;
+        month_start := month_start + interval '1 month';
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TABLE saifu_ccy_prices_downsampling (
+    id boolean PRIMARY KEY DEFAULT true CHECK (id),
+    last_cutoff TIMESTAMP NOT NULL
+);
+
+-- Rolls the ticks older than older_than into buckets of bucket_seconds,
+-- keeping the last tick of each ticker in each bucket (as of lookups on the
+-- bucket boundaries are unchanged). Returns the number of ticks removed.
+-- Each run only processes [last cutoff, cutoff), the cutoff of the previous
+-- run being recorded in saifu_ccy_prices_downsampling: a tick inserted late,
+-- with a quote_time before the last cutoff, is never downsampled and is kept
+-- at full resolution.
+CREATE FUNCTION saifu_downsample_ccy_prices(older_than TIMESTAMP, bucket_seconds int)
+RETURNS bigint AS $$
+DECLARE
+    cutoff TIMESTAMP := to_timestamp(
+        floor(extract(EPOCH FROM older_than) / bucket_seconds) * bucket_seconds)
+        AT TIME ZONE 'UTC';
+    previous_cutoff TIMESTAMP;
+    removed bigint;
+    kept bigint;
+BEGIN
+    SELECT last_cutoff INTO previous_cutoff
+      FROM saifu_ccy_prices_downsampling
+       FOR UPDATE;
+    previous_cutoff := coalesce(previous_cutoff, '-infinity'::timestamp);
+    IF cutoff <= previous_cutoff THEN
+        RETURN 0;
+    END IF;
+
+    CREATE TEMPORARY TABLE saifu_downsampled_ticks ON COMMIT DROP AS
+        SELECT DISTINCT ON (ticker, bucket)
+               ticker,
+               price,
+               quote_time
+          FROM (SELECT ticker,
+                       price,
+                       quote_time,
+                       floor(extract(EPOCH FROM quote_time) / bucket_seconds) AS bucket
+                  FROM saifu_ccy_historical_prices
+                 WHERE quote_time >= previous_cutoff
+                   AND quote_time < cutoff) ticks
+      ORDER BY ticker, bucket, quote_time DESC;
+
+    DELETE FROM saifu_ccy_historical_prices
+          WHERE quote_time >= previous_cutoff
+            AND quote_time < cutoff;
+    GET DIAGNOSTICS removed = ROW_COUNT;
+
+    INSERT INTO saifu_ccy_historical_prices (ticker, price, quote_time)
+         SELECT ticker, price, quote_time FROM saifu_downsampled_ticks;
+    GET DIAGNOSTICS kept = ROW_COUNT;
+
+    INSERT INTO saifu_ccy_prices_downsampling (id, last_cutoff)
+         VALUES (true, cutoff)
+    ON CONFLICT (id) DO UPDATE SET last_cutoff = EXCLUDED.last_cutoff;
+
+    DROP TABLE saifu_downsampled_ticks;
+    RETURN removed - kept;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT saifu_create_ccy_prices_partitions(
+    coalesce((SELECT MIN(quote_time) FROM saifu_ccy_historical_prices_old), now()::timestamp),
+    now()::timestamp + interval '3 months');
+
+INSERT INTO saifu_ccy_historical_prices (ticker, price, quote_time)
+     SELECT ticker, price, quote_time
+       FROM saifu_ccy_historical_prices_old
+      WHERE quote_time IS NOT NULL;
+
+DROP TABLE saifu_ccy_historical_prices_old;
+
+CREATE INDEX saifu_portfolio_historical_prices_lookup
+    ON saifu_portfolio_historical_prices (portfolio_id, currency, quote_time DESC);
@@ -0,0 +1,4 @@
+-- Last pricing job lookup by portfolio (scheduler seeding).
+
+CREATE INDEX saifu_portfolio_pricing_jobs_portfolio_start
+    ON saifu_portfolio_pricing_jobs (portfolio_id, start_time DESC);
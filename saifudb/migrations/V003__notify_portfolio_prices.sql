@@ -0,0 +1,25 @@
+-- Notifies the listeners on saifu_portfolio_prices of the portfolios whose
+-- balances were just inserted (comma separated ids, one notification per
+-- statement). An empty payload means "any portfolio" (too many ids to fit).
+
+CREATE FUNCTION saifu_notify_portfolio_prices() RETURNS trigger AS $$
+DECLARE
+    ids text;
+BEGIN
+    SELECT string_agg(DISTINCT portfolio_id::text, ',') INTO ids FROM new_rows;
+    IF ids IS NULL THEN
+        RETURN NULL;
+    END IF;
+    IF octet_length(ids) > 7000 THEN
+        ids := '';
+    END IF;
+    PERFORM pg_notify('saifu_portfolio_prices', ids);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER saifu_portfolio_prices_notify
+    AFTER INSERT ON saifu_portfolio_historical_prices
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT
+    EXECUTE PROCEDURE saifu_notify_portfolio_prices();
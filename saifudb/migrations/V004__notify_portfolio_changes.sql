@@ -0,0 +1,41 @@
+-- Notifies the listeners on saifu_portfolio_changes of the edits of the
+-- positions and pricing settings. The payload is <kind>:<portfolio_id>
+-- (kind is positions or settings), identical payloads are folded by
+-- pg_notify within a transaction. An empty id (truncate) means "any
+-- portfolio".
+
+CREATE FUNCTION saifu_notify_portfolio_changes() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'TRUNCATE' THEN
+        PERFORM pg_notify('saifu_portfolio_changes', TG_ARGV[0] || ':');
+        RETURN NULL;
+    END IF;
+    IF TG_OP <> 'INSERT' THEN
+        PERFORM pg_notify('saifu_portfolio_changes', TG_ARGV[0] || ':' || OLD.portfolio_id);
+    END IF;
+    IF TG_OP <> 'DELETE' THEN
+        PERFORM pg_notify('saifu_portfolio_changes', TG_ARGV[0] || ':' || NEW.portfolio_id);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER saifu_portfolio_positions_notify
+    AFTER INSERT OR UPDATE OR DELETE ON saifu_portfolio_positions
+    FOR EACH ROW
+    EXECUTE PROCEDURE saifu_notify_portfolio_changes('positions');
+
+CREATE TRIGGER saifu_portfolio_positions_truncate_notify
+    AFTER TRUNCATE ON saifu_portfolio_positions
+    FOR EACH STATEMENT
+    EXECUTE PROCEDURE saifu_notify_portfolio_changes('positions');
+
+CREATE TRIGGER saifu_portfolio_pricing_settings_notify
+    AFTER INSERT OR UPDATE OR DELETE ON saifu_portfolio_pricing_settings
+    FOR EACH ROW
+    EXECUTE PROCEDURE saifu_notify_portfolio_changes('settings');
+
+CREATE TRIGGER saifu_portfolio_pricing_settings_truncate_notify
+    AFTER TRUNCATE ON saifu_portfolio_pricing_settings
+    FOR EACH STATEMENT
+    EXECUTE PROCEDURE saifu_notify_portfolio_changes('settings');
@@ -0,0 +1,24 @@
+-- Latest balance of each (portfolio, currency), kept up to date by revalue
+-- between the pricings written to saifu_portfolio_historical_prices (which
+-- portprice owns). Updates notify saifu_portfolio_prices like the inserts
+-- into the history.
+
+CREATE TABLE saifu_portfolio_latest_prices (
+    portfolio_id int REFERENCES saifu_portfolios(id),
+    currency VARCHAR(30) NOT NULL,
+    balance DOUBLE PRECISION NOT NULL CHECK(balance >= 0),
+    quote_time TIMESTAMP NOT NULL,
+    PRIMARY KEY (portfolio_id, currency)
+);
+
+CREATE TRIGGER saifu_portfolio_latest_prices_insert_notify
+    AFTER INSERT ON saifu_portfolio_latest_prices
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT
+    EXECUTE PROCEDURE saifu_notify_portfolio_prices();
+
+CREATE TRIGGER saifu_portfolio_latest_prices_update_notify
+    AFTER UPDATE ON saifu_portfolio_latest_prices
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT
+    EXECUTE PROCEDURE saifu_notify_portfolio_prices();
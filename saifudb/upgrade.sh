@@ -0,0 +1,78 @@
+#!/bin/sh
+# Moves a saifudb database created with the postgres 9.6 image to the
+# saifudb-data volume used by the postgres 11 image (postgres 11 cannot start
+# on a 9.6 data directory). The old data directory is dumped with a 9.6
+# server, restored into the new volume with a 11 server, then the schema
+# migrations are applied by the saifudb service.
+#
+# Run from the repository root, before docker-compose recreates the saifudb
+# container, with the old container (see docker ps -a):
+#
+#     make upgrade-db OLD=saifu_saifudb_1
+#
+# If the container was already recreated, pass the anonymous volume holding
+# the 9.6 data directory instead (see docker volume ls, it is kept unless
+# removed explicitly).
+set -e
+
+OLD=${1:?"usage: $0 <old saifudb container or volume>"}
+PROJECT=${COMPOSE_PROJECT_NAME:-$(basename "$PWD" | tr '[:upper:]' '[:lower:]' | tr -cd 'a-z0-9_-')}
+VOLUME=${PROJECT}_saifudb-data
+DUMP=${DUMP:-saifudb-9.6.sql}
+DB_USER=${POSTGRES_USER:-saifudb}
+DB_NAME=${POSTGRES_DB:-saifudb}
+
+# Waits until a server accepts connections (after its init process, if any)
+wait_ready() {
+    while docker logs "$1" 2>&1 | grep -q "init process in progress" \
+            && ! docker logs "$1" 2>&1 | grep -q "init process complete"
+    do
+        sleep 1
+    done
+    until docker exec "$1" pg_isready --username "$DB_USER" --dbname "$DB_NAME" >/dev/null 2>&1
+    do
+        sleep 1
+    done
+}
+
+if docker volume inspect "$VOLUME" >/dev/null 2>&1
+then
+    echo "[ ERROR ] Volume $VOLUME already exists, remove it first (docker volume rm $VOLUME)"
+    exit 1
+fi
+
+if docker volume inspect "$OLD" >/dev/null 2>&1
+then
+    OLD_DATA="-v $OLD:/var/lib/postgresql/data"
+else
+    docker stop "$OLD" >/dev/null
+    OLD_DATA="--volumes-from $OLD"
+fi
+
+echo "[ INFO ] Dumping $DB_NAME from $OLD to $DUMP"
+docker run -d --name saifudb-upgrade-old $OLD_DATA postgres:9.6.3-alpine >/dev/null
+wait_ready saifudb-upgrade-old
+docker exec saifudb-upgrade-old pg_dump --username "$DB_USER" "$DB_NAME" > "$DUMP"
+docker stop saifudb-upgrade-old >/dev/null
+docker rm saifudb-upgrade-old >/dev/null
+
+echo "[ INFO ] Restoring $DUMP into $VOLUME"
+docker run -d --name saifudb-upgrade-new \
+       -v "$VOLUME:/var/lib/postgresql/data" \
+       -e POSTGRES_USER="$DB_USER" \
+       -e POSTGRES_DB="$DB_NAME" \
+       -e POSTGRES_PASSWORD="${POSTGRES_PASSWORD:-saifudb}" \
+       postgres:11-alpine >/dev/null
+wait_ready saifudb-upgrade-new
+docker exec -i saifudb-upgrade-new psql -v ON_ERROR_STOP=1 --username "$DB_USER" "$DB_NAME" < "$DUMP"
+docker stop saifudb-upgrade-new >/dev/null
+docker rm saifudb-upgrade-new >/dev/null
+
+echo "[ INFO ] Applying the schema migrations"
+docker-compose up -d saifudb
+until docker-compose exec -T saifudb pg_isready --username "$DB_USER" --dbname "$DB_NAME" >/dev/null 2>&1
+do
+    sleep 1
+done
+docker-compose exec -T saifudb saifudb-migrate
+echo "[ INFO ] Upgrade done, $DUMP can be removed"
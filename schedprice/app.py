@@ -1,13 +1,16 @@
 """Determines which portfolios need pricing and dispatchs pricing"""
 import sys
-import time
 import uuid
 import datetime
+import threading
 import pika
+import psycopg2
 import yaml
 
+import schedule
+
 from saifu.core import models, runtime, dbac, utils
-from saifu.core.system import db, mq, mt
+from saifu.core.system import db, mq, amq, mt, metrics
 
 class Settings(object):
     """Application settings"""
@@ -15,8 +18,11 @@ class Settings(object):
         conf = store["conf"]
         app = conf["app"]
 
-        self.pull_delay = app["pull_delay"]
+        self.max_sleep = app.get("max_sleep")
+        self.resync_interval = app.get("resync_interval", 300)
+        self.dispatch_batch_size = app.get("dispatch_batch_size", 1)
         self.work_queue = app["work_queue"]
+        self.portfolio_cache = app.get("portfolio_cache", False)
 
         self.logging = models.LoggingSettings()
         self.logging.from_json(conf["log"])
@@ -27,20 +33,87 @@ class Settings(object):
         self.mq = models.MQSettings()
         self.mq.from_json(app["mq"])
 
+        self.metrics = models.MetricsSettings()
+        self.metrics.from_json(app.get("metrics", {}))
+
+        maintenance = app.get("maintenance", {})
+        self.maintenance_interval = maintenance.get("interval")
+        self.partition_days_ahead = maintenance.get("partition_days_ahead", 62)
+        self.downsample_after = maintenance.get("downsample_after")
+        self.downsample_bucket = maintenance.get("downsample_bucket", 3600)
+
 
 class Dispatcher(mq.GenericDispatcher):
-    def __init__(self, logger, settings, pricingrepo, jobsrepo, connector):
+    def __init__(self, logger, settings, pricingrepo, jobsrepo, connector, portfolios=None):
         super(Dispatcher, self).__init__(settings.work_queue, connector)
         self.logger = logger
         self.settings = settings
         self.pricingrepo = pricingrepo
         self.jobsrepo = jobsrepo
+        self.portfolios = portfolios
+
+    def _sleep_time(self, pricing_schedule, now, next_sync):
+        """Time to sleep until the next due portfolio or the next schedule
+        synchronization, capped by max_sleep when set (the portfolio cache
+        edits are only applied on wake up)
+        """
+        wake_time = next_sync
+        next_due_time = pricing_schedule.next_due_time()
+        if next_due_time is not None:
+            wake_time = min(wake_time, next_due_time)
+        delay = (wake_time - now).total_seconds()
+        if self.settings.max_sleep is not None:
+            delay = min(delay, self.settings.max_sleep)
+        return max(0, delay)
+
+    def _dispatch_jobs(self, jobs):
+        """Dispatches jobs one per message, or in chunks of
+        dispatch_batch_size jobs per message
+        """
+        batch_size = self.settings.dispatch_batch_size
+        if batch_size <= 1:
+            for job in jobs:
+                self.dispatch(
+                    utils.serialize(job, self.settings.mq.codec))
+            return
+        for start in range(0, len(jobs), batch_size):
+            self.dispatch(
+                utils.serialize(jobs[start:start + batch_size], self.settings.mq.codec))
+
+    def _sync_schedule(self, pricing_schedule, snapshot, now, version):
+        """Applies the pricing settings edits of a portfolio cache snapshot,
+        returns the version of the snapshot applied
+        """
+        if snapshot.version == version:
+            return version
+        pricing_schedule.sync(snapshot.pricing_settings(), now)
+        self.logger.debug("Synchronized pricing schedule of {} portfolio(s) (version {})".format(
+            len(pricing_schedule), snapshot.version))
+        return snapshot.version
 
     def work(self):
+        pricing_schedule = schedule.Schedule()
+        next_sync = None
+        version = None
         while self.running():
+            now = utils.utc_time()
+            if next_sync is None or now >= next_sync:
+                pricing_schedule.load(self.pricingrepo.find_pricing_schedule(), now)
+                next_sync = now + datetime.timedelta(seconds=self.settings.resync_interval)
+                version = None
+                self.logger.debug("Loaded pricing schedule of {} portfolio(s)".format(
+                    len(pricing_schedule)))
+            snapshot = self.portfolios.snapshot() if self.portfolios is not None else None
+            if snapshot is not None:
+                # The cache keeps the schedule in sync, the schedule is only
+                # reloaded if the cache stays bypassed for resync_interval
+                version = self._sync_schedule(pricing_schedule, snapshot, now, version)
+                next_sync = now + datetime.timedelta(seconds=self.settings.resync_interval)
+
             snapshot_time = datetime.datetime.now()
+            due = pricing_schedule.due(now)
             new_jobs = []
-            for portfolio_id, target_ccy in self.pricingrepo.find_portfolios_to_price():
+            for portfolio_id, target_ccy in due:
                 new_jobs.append(models.PricingJob(
                     portfolio_id=portfolio_id,
                     snapshot_time=snapshot_time,
@@ -52,12 +125,63 @@ class Dispatcher(mq.GenericDispatcher):
             self.logger.debug("Will dispatch {} new pricing job(s)".format(
                 len(new_jobs)))
 
-            self.jobsrepo.persist_many(new_jobs)
-            for job in new_jobs:
-                self.dispatch(
-                    utils.serialize(job))
+            # The jobs are dispatched within their insert transaction, and
+            # only emitted jobs move their portfolio forward: a failure
+            # leaves them due for the next attempt (or the reload)
+            self.jobsrepo.persist_many(new_jobs, self._dispatch_jobs)
+            pricing_schedule.reschedule(due, now)
 
-            time.sleep(self.settings.pull_delay)
+            self.sleep(self._sleep_time(pricing_schedule, utils.utc_time(), next_sync))
+
+
+class Maintainer(threading.Thread):
+    """Periodically maintains the market data history
+    Creates the partitions ahead of time and downsamples the old ticks.
+    """
+    def __init__(self, logger, settings, maintenancerepo):
+        super(Maintainer, self).__init__()
+        self.logger = logger
+        self.settings = settings
+        self.maintenancerepo = maintenancerepo
+        self._stopped = threading.Event()
+
+    def _create_partitions(self, now):
+        self.maintenancerepo.create_ccy_prices_partitions(
+            now,
+            now + datetime.timedelta(days=self.settings.partition_days_ahead))
+
+    def _downsample(self, now):
+        if self.settings.downsample_after is None:
+            return
+        removed = self.maintenancerepo.downsample_ccy_prices(
+            now - datetime.timedelta(seconds=self.settings.downsample_after),
+            self.settings.downsample_bucket)
+        self.logger.info("Downsampling removed {} tick(s)".format(removed))
+
+    def maintain(self):
+        """Runs the maintenance tasks once, a failed task does not prevent
+        the others from running
+        """
+        now = utils.utc_time()
+        for task in (self._create_partitions, self._downsample):
+            try:
+                task(now)
+            except psycopg2.Error as err:
+                self.logger.warn("Maintenance task {} failed: {}".format(
+                    task.__name__.strip("_"), str(err)))
+
+    def run(self):
+        while not self._stopped.is_set():
+            self.maintain()
+            self._stopped.wait(self.settings.maintenance_interval)
+
+    def stop(self):
+        self._stopped.set()
+
+
+class AsyncDispatcher(amq.AsyncDispatcher, Dispatcher):
+    """Dispatcher running on a shared event loop"""
+    pass
 
 
 def main():
@@ -71,14 +195,39 @@ def main():
 
     logger.debug("Initializing pricing job scheduler")
 
-    dispatcher = Dispatcher(
+    threads = []
+    dispatcher_type = Dispatcher
+    connector = mq.Connector(settings.mq)
+    if settings.mq.transport == "async":
+        loop = amq.EventLoop(connector)
+        threads.append(loop)
+        dispatcher_type = AsyncDispatcher
+        connector = amq.Connector(loop)
+
+    pool = db.Pool(settings.database)
+    pricingrepo = dbac.PricingRepository(pool)
+    portfolios = None
+    if settings.portfolio_cache:
+        portfolios = dbac.PortfolioCache(
+            logger.getChild("pfc"), settings.database, pricingrepo)
+        threads.append(portfolios)
+
+    threads.append(dispatcher_type(
         logger.getChild("sch"),
         settings,
-        dbac.PricingRepository(db.Connector(settings.database)),
-        dbac.JobsRepository(db.Connector(settings.database)),
-        mq.Connector(settings.mq))
-
-    mt.ThreadManager(dispatcher).start()
+        pricingrepo,
+        dbac.JobsRepository(pool),
+        connector,
+        portfolios))
+
+    if settings.maintenance_interval is not None:
+        threads.append(Maintainer(
+            logger.getChild("mnt"),
+            settings,
+            dbac.MaintenanceRepository(pool)))
+
+    threads.extend(metrics.exporters(logger.getChild("mtr"), settings.metrics))
+    mt.ThreadManager(*threads, logger=logger.getChild("sup")).start()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,90 @@
+"""Portfolio pricing schedule"""
+import heapq
+import datetime
+
+
+class Schedule(object):
+    """Keeps the next due time of each (portfolio, target currency) in a heap
+    The heap is seeded from the pricing settings and the last pricing jobs,
+    then updated in memory as jobs are emitted, so finding the due portfolios
+    costs O(due portfolios).
+    """
+    def __init__(self):
+        self._heap = []
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def load(self, rows, now):
+        """Seeds the schedule from (portfolio_id, target_ccy, interval,
+        last_start_time) rows, replacing the current content
+        """
+        self._entries = {}
+        for portfolio_id, target_ccy, interval, last_start_time in rows:
+            due_time = now
+            if last_start_time is not None:
+                due_time = last_start_time + datetime.timedelta(seconds=interval)
+            self._entries[(portfolio_id, target_ccy)] = (due_time, interval)
+        self._heap = [(entry_due, entry_key)
+                      for entry_key, (entry_due, _) in self._entries.items()]
+        heapq.heapify(self._heap)
+
+    def sync(self, rows, now):
+        """Applies the (portfolio_id, target_ccy, interval) pricing settings
+        rows: new entries are due now, removed ones are dropped and the due
+        time of the others follows their interval change
+        """
+        entries = {}
+        for portfolio_id, target_ccy, interval in rows:
+            key = (portfolio_id, target_ccy)
+            entry = self._entries.get(key)
+            if entry is None:
+                due_time = now
+            else:
+                due_time = entry[0] + datetime.timedelta(seconds=interval - entry[1])
+            entries[key] = (due_time, interval)
+        self._entries = entries
+        self._heap = [(entry_due, entry_key)
+                      for entry_key, (entry_due, _) in self._entries.items()]
+        heapq.heapify(self._heap)
+
+    def _discard_stale(self):
+        """Pops the heap entries superseded by a reschedule or a reload"""
+        while self._heap:
+            due_time, key = self._heap[0]
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == due_time:
+                return
+            heapq.heappop(self._heap)
+
+    def next_due_time(self):
+        """Returns the earliest due time (None if the schedule is empty)"""
+        self._discard_stale()
+        return self._heap[0][0] if self._heap else None
+
+    def due(self, now):
+        """Returns the (portfolio_id, target_ccy) due at now, they stay due
+        until rescheduled
+        """
+        due = []
+        while True:
+            self._discard_stale()
+            if not self._heap or self._heap[0][0] > now:
+                break
+            due.append(heapq.heappop(self._heap)[1])
+        for key in due:
+            heapq.heappush(self._heap, (self._entries[key][0], key))
+        return due
+
+    def reschedule(self, keys, now):
+        """Schedules the (portfolio_id, target_ccy) keys one interval after
+        now (once their pricing jobs are emitted)
+        """
+        for key in keys:
+            entry = self._entries.get(key)
+            if entry is None:
+                continue
+            next_due_time = now + datetime.timedelta(seconds=entry[1])
+            self._entries[key] = (next_due_time, entry[1])
+            heapq.heappush(self._heap, (next_due_time, key))
@@ -0,0 +1,66 @@
+"""Tests of the portfolio pricing schedule"""
+import datetime
+
+from saifu.schedprice import schedule
+
+_NOW = datetime.datetime(2018, 1, 1, 12)
+
+
+def _seconds(seconds):
+    return datetime.timedelta(seconds=seconds)
+
+
+def _schedule(*rows):
+    pricing_schedule = schedule.Schedule()
+    pricing_schedule.load(rows, _NOW)
+    return pricing_schedule
+
+
+def test_never_priced_portfolios_are_due_now():
+    pricing_schedule = _schedule((1, "USD", 60, None))
+    assert pricing_schedule.due(_NOW) == [(1, "USD")]
+
+
+def test_portfolios_are_due_one_interval_after_their_last_job():
+    pricing_schedule = _schedule(
+        (1, "USD", 60, _NOW - _seconds(30)),
+        (2, "USD", 60, _NOW - _seconds(90)))
+    assert pricing_schedule.due(_NOW) == [(2, "USD")]
+    assert pricing_schedule.next_due_time() == _NOW - _seconds(30)
+    assert sorted(pricing_schedule.due(_NOW + _seconds(30))) == [(1, "USD"), (2, "USD")]
+
+
+def test_due_portfolios_stay_due_until_rescheduled():
+    pricing_schedule = _schedule((1, "USD", 60, None), (1, "EUR", 60, None))
+    due = pricing_schedule.due(_NOW)
+    assert sorted(pricing_schedule.due(_NOW)) == sorted(due)
+
+    pricing_schedule.reschedule(due, _NOW)
+    assert pricing_schedule.due(_NOW) == []
+    assert pricing_schedule.next_due_time() == _NOW + _seconds(60)
+    assert sorted(pricing_schedule.due(_NOW + _seconds(60))) == [(1, "EUR"), (1, "USD")]
+
+
+def test_reschedule_only_moves_the_given_portfolios():
+    pricing_schedule = _schedule((1, "USD", 60, None), (2, "USD", 120, None))
+    pricing_schedule.reschedule([(2, "USD")], _NOW)
+    assert pricing_schedule.due(_NOW) == [(1, "USD")]
+    pricing_schedule.reschedule([(1, "USD")], _NOW)
+    assert pricing_schedule.due(_NOW + _seconds(60)) == [(1, "USD")]
+    assert pricing_schedule.next_due_time() == _NOW + _seconds(60)
+
+
+def test_reschedule_ignores_unknown_portfolios():
+    pricing_schedule = _schedule((1, "USD", 60, None))
+    pricing_schedule.reschedule([(2, "USD")], _NOW)
+    assert len(pricing_schedule) == 1
+    assert pricing_schedule.due(_NOW) == [(1, "USD")]
+
+
+def test_sync_applies_the_pricing_settings_edits():
+    pricing_schedule = _schedule((1, "USD", 60, _NOW), (2, "USD", 60, _NOW))
+    pricing_schedule.sync([(1, "USD", 120), (3, "USD", 60)], _NOW)
+    assert len(pricing_schedule) == 2
+    assert pricing_schedule.due(_NOW) == [(3, "USD")]
+    assert pricing_schedule.due(_NOW + _seconds(60)) == [(3, "USD")]
+    assert sorted(pricing_schedule.due(_NOW + _seconds(120))) == [(1, "USD"), (3, "USD")]
@@ -1,37 +1,185 @@
-import psycopg2
-from flask import Flask
+"""Portfolios read API"""
+import os
+import math
+import json
+import threading
+import yaml
+from flask import Flask, Response, request, abort
+
+import cache
+from saifu.core import models, runtime, dbac, utils, pricing
+from saifu.core.system import db
+
+
+class Settings(object):
+    """Application settings"""
+    def __init__(self, store):
+        conf = store["conf"]
+        app = conf["app"]
+
+        self.logging = models.LoggingSettings()
+        self.logging.from_json(conf["logging"])
+
+        self.database = models.DatabaseSettings()
+        self.database.from_json(app["database"])
+
+        self.cache_ttl = app.get("cache_ttl", 30)
+        self.positions_ttl = app.get("positions_ttl", 5)
+        self.default_currency = app.get("default_currency", "USD")
+        self.history_max_points = app.get("history_max_points", 500)
+
+
+with open(os.environ.get("WEBSRV_CFG", "./cfg.yaml")) as settings_file:
+    _settings = Settings(yaml.load(settings_file))
+
+_logger = runtime.create_logger(_settings.logging)
+_pool = db.Pool(_settings.database)
+_portfolios = dbac.PortfolioRepository(_pool)
+_pricing = dbac.PricingRepository(_pool)
+_cache = cache.TTLCache(_settings.cache_ttl)
+_invalidator = None
+_invalidator_lock = threading.Lock()
+
 app = Flask(__name__)
 
 
-@app.route("/portfolios/<portfolio_id>")
-def get_price(portfolio_id):
-    conn = psycopg2.connect(
-        database="saifudb",
-        user="saifudb",
-        password="saifudb",
-        host="saifudb")
-
-    with conn.cursor() as cur:
-        cur.execute("""
-            SELECT balance,
-                   quote_time
-              FROM saifu_portfolio_historical_prices
-             WHERE portfolio_id = %s
-               AND currency = 'USD'
-          ORDER BY quote_time DESC
-             LIMIT 1
-        """, (portfolio_id))
-        row = cur.fetchone()
-        conn.commit()
-        return """
-            <h3>Balance</h3>
-            <p>
-              <strong>{}</strong> USD (As of: {})
-            </p>
-        """.format(row[0], row[1])
+@app.before_request
+def _start_invalidator():
+    """Starts the cache invalidator of the (worker) process on first use"""
+    global _invalidator
+    if _invalidator is not None:
+        return
+    with _invalidator_lock:
+        if _invalidator is None:
+            _invalidator = cache.invalidator(
+                _logger.getChild("inv"), _settings.database, _cache)
+            _invalidator.start()
+
+
+def _cached(key, build, ttl=None):
+    """Returns the JSON response of key, built by build() on a cache miss
+    Responses carry an ETag and conditional requests are answered with 304.
+    """
+    body = _cache.get(key)
+    if body is None:
+        # Not cached if the portfolio is invalidated while building
+        generation = _cache.generation(key)
+        payload = build()
+        if payload is None:
+            abort(404)
+        body = json.dumps(payload, sort_keys=True)
+        _cache.put(key, body, ttl, generation)
+    response = Response(body, mimetype="application/json")
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+def _currency():
+    return request.args.get("ccy", _settings.default_currency).upper()
+
+
+@app.route("/portfolios/<int:portfolio_id>")
+@app.route("/portfolios/<int:portfolio_id>/balance")
+def get_balance(portfolio_id):
+    """Latest balance of a portfolio"""
+    currency = _currency()
+
+    def build():
+        latest = _portfolios.get_latest_balance(portfolio_id, currency)
+        if latest is None:
+            return None
+        balance, quote_time = latest
+        return {
+            "portfolio_id": portfolio_id,
+            "currency": currency,
+            "balance": balance,
+            "as_of": utils.to_timestamp(quote_time)
+        }
+    return _cached((portfolio_id, "balance", currency), build)
+
+
+@app.route("/portfolios/<int:portfolio_id>/history")
+def get_history(portfolio_id):
+    """Balance history of a portfolio, downsampled to at most
+    history_max_points buckets (from/to are epoch seconds, last 24h by
+    default)
+    """
+    currency = _currency()
+    try:
+        to_time = float(request.args.get("to", utils.to_timestamp(utils.utc_time())))
+        from_time = float(request.args.get("from", to_time - 86400))
+        bucket = int(request.args.get("bucket", 0))
+    except ValueError:
+        abort(400)
+    if from_time >= to_time:
+        abort(400)
+    min_bucket = int(math.ceil((to_time - from_time) / _settings.history_max_points))
+    bucket = max(1, bucket, min_bucket)
+    # Aligns the range on buckets so that equivalent requests share entries
+    from_time = math.floor(from_time / bucket) * bucket
+    to_time = math.ceil(to_time / bucket) * bucket
+
+    def build():
+        rows = _portfolios.get_balance_history(
+            portfolio_id,
+            currency,
+            utils.utc_from_timestamp(from_time),
+            utils.utc_from_timestamp(to_time),
+            bucket)
+        return {
+            "portfolio_id": portfolio_id,
+            "currency": currency,
+            "bucket": bucket,
+            "points": [{
+                "time": utils.to_timestamp(bucket_time),
+                "balance": last,
+                "low": low,
+                "high": high
+            } for bucket_time, last, low, high in rows]
+        }
+    return _cached((portfolio_id, "history", currency, from_time, to_time, bucket), build)
+
+
+@app.route("/portfolios/<int:portfolio_id>/positions")
+def get_positions(portfolio_id):
+    """Positions of a portfolio valued at the latest prices"""
+    currency = _currency()
+
+    def build():
+        positions = _pricing.get_portfolios_positions([portfolio_id])[portfolio_id]
+        if not positions:
+            return None
+        kernel = pricing.PricingKernel({portfolio_id: positions})
+        prices = _pricing.get_latest_prices(kernel.tickers([currency]), utils.utc_time())
+        breakdown = []
+        total = 0.0
+        for ticker, size in positions:
+            price = kernel.price(prices, ticker, currency, None)
+            value = price * size if price is not None else None
+            total += value or 0.0
+            breakdown.append({
+                "ticker": ticker,
+                "size": size,
+                "price": price,
+                "value": value
+            })
+        for position in breakdown:
+            value = position["value"]
+            position["weight"] = value / total if value is not None and total else None
+        return {
+            "portfolio_id": portfolio_id,
+            "currency": currency,
+            "total": total,
+            "positions": breakdown
+        }
+    # Positions follow the market prices, they only expire with their ttl
+    return _cached(
+        (portfolio_id, "positions", currency), build, _settings.positions_ttl)
+
 
 def main():
-    app.run(debug=True, host='0.0.0.0')
+    """Development server (production runs under gunicorn, see start.sh)"""
+    app.run(host='0.0.0.0', threaded=True)
 
 if __name__ == '__main__':
     main()
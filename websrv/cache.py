@@ -0,0 +1,101 @@
+"""Portfolio read cache"""
+import time
+import threading
+
+from saifu.core.system import db
+
+CHANNEL = "saifu_portfolio_prices"
+
+
+class TTLCache(object):
+    """Thread safe cache of responses by (portfolio_id, ...) key
+    Entries expire after ttl seconds and the entries of a portfolio are
+    dropped as soon as new balances are stored for it.
+    Every invalidation bumps the generation of the portfolio (clear bumps
+    them all): a value built while an invalidation happened is not cached,
+    see generation and put.
+    """
+    def __init__(self, ttl, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = {}
+        self._epoch = 0
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def generation(self, key):
+        """Returns the generation of the portfolio of a key, to be read before
+        building its value
+        """
+        with self._lock:
+            return self._epoch, self._generations.get(key[0], 0)
+
+    def get(self, key):
+        """Returns the cached value of a key (None if missing or expired)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.time():
+                del self._entries[key]
+                return None
+            return value
+
+    def put(self, key, value, ttl=None, generation=None):
+        """Caches a value, unless its portfolio was invalidated since
+        generation was read
+        """
+        with self._lock:
+            if (generation is not None
+                    and generation != (self._epoch, self._generations.get(key[0], 0))):
+                return
+            if len(self._entries) >= self.max_entries:
+                self._evict()
+            self._entries[key] = (time.time() + (ttl or self.ttl), value)
+
+    def _evict(self):
+        """Drops the expired entries, or everything if none expired (lock
+        must be held)
+        """
+        now = time.time()
+        expired = [key for key, (expires_at, _) in self._entries.items()
+                   if expires_at < now]
+        if not expired:
+            self._entries.clear()
+        for key in expired:
+            del self._entries[key]
+
+    def invalidate(self, portfolio_ids):
+        """Drops the entries of the given portfolios"""
+        portfolio_ids = set(portfolio_ids)
+        with self._lock:
+            for portfolio_id in portfolio_ids:
+                self._generations[portfolio_id] = self._generations.get(portfolio_id, 0) + 1
+            for key in [key for key in self._entries if key[0] in portfolio_ids]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._generations.clear()
+            self._entries.clear()
+
+
+def invalidator(logger, settings, cache):
+    """Creates the (daemon) listener invalidating the cache on the
+    notifications of new balances. The cache is cleared whenever the listener
+    (re)connects, as notifications may have been missed meanwhile.
+    """
+    def invalidate(payloads):
+        if not all(payloads):
+            cache.clear()
+            return
+        cache.invalidate(int(portfolio_id)
+                         for payload in payloads
+                         for portfolio_id in payload.split(","))
+
+    listener = db.Listener(
+        logger, settings, CHANNEL, on_connect=cache.clear, on_notify=invalidate)
+    listener.daemon = True
+    return listener
@@ -1,6 +1,21 @@
 #!/bin/bash
 WAIT_TIME=20
+
+WEBSRV_CFG=./cfg.yaml
+if [[ "$WEBSRV_ENV" = "dev" ]]
+then
+    echo "[ WARN ] Will run websrv in DEV mode."
+    WEBSRV_CFG=./cfg_dev.yaml
+fi
+export WEBSRV_CFG
+
+if [[ -z "$WEBSRV_WORKERS" ]]
+then
+    WEBSRV_WORKERS=4
+fi
+
 echo "[ WARN ] Waiting ${WAIT_TIME}s"
 sleep $WAIT_TIME
 
-python ./app.py
+echo "[ INFO ] Starting websrv with $WEBSRV_WORKERS workers"
+exec gunicorn --workers "$WEBSRV_WORKERS" --bind 0.0.0.0:5000 app:app